@@ -10,6 +10,18 @@ class ValidateCopyArtifact(argparse.Action):
         setattr(namespace, self.dest, values)
 
 
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f"must be a positive integer, not {value!r}"
+        )
+    return number
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description="Run commands on remote devices provisioned on Torizon Cloud."
@@ -71,6 +83,34 @@ def parse_arguments():
             "Instructs Aval to not update the board to the latest specified release. Uses whatever is installed in the device."
         ),
     )
+    parser.add_argument(
+        "--candidate-order",
+        choices=["update-cost", "fleet"],
+        default="update-cost",
+        help=(
+            "Order in which possible devices are tried. `update-cost` (default) tries devices already on the latest build first, then those whose hardware updated the fastest in past runs. `fleet` keeps the order of the fleet list."
+        ),
+    )
+    parser.add_argument(
+        "--warm-fleet",
+        action="store_true",
+        help=(
+            "Maintenance mode: instead of running a command, updates every idle device matching SOC_UDT or --device-config to the latest TARGET_BUILD_TYPE build. Devices locked by other jobs are skipped."
+        ),
+    )
+    parser.add_argument(
+        "--warm-concurrency",
+        type=positive_int,
+        default=4,
+        help="How many devices --warm-fleet updates at the same time.",
+    )
+    parser.add_argument(
+        "--sync-inventory",
+        action="store_true",
+        help=(
+            "Maintenance mode: instead of running a command, syncs the fleet inventory at AVAL_INVENTORY_FILE with Torizon Cloud and exits."
+        ),
+    )
     # This is a temporary argument, to be removed when Aktualizr fixes TOR-3518
     parser.add_argument(
         "--remove-databases",
@@ -0,0 +1,97 @@
+import async_http
+
+
+async def _run(steps):
+    """cloud._run() for asyncio code, the requests are sent with async_http."""
+    res = error = None
+    while True:
+        try:
+            request = steps.send(res) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+
+        try:
+            res, error = await async_http.endpoint_call(**request), None
+        except Exception as e:
+            res, error = None, e
+
+
+class AsyncCloudAPI:
+    """A CloudAPI for asyncio code, with the same methods as coroutines.
+
+    It shares the token, delegation filters and fleet listing of `cloud_api`
+    and sends the same requests, from the running event loop on the
+    connections of its async_http pool. One loop can thus follow hundreds of
+    devices, with as many requests in flight as the pool allows and no
+    thread per device.
+    """
+
+    def __init__(self, cloud_api):
+        self._cloud_api = cloud_api
+
+    @property
+    def provisioned_devices(self):
+        """The whole fleet, listed on first use, to be awaited."""
+        return self._get_provisioned_devices()
+
+    async def _get_provisioned_devices(self):
+        cloud_api = self._cloud_api
+        if cloud_api._provisioned_devices is None:
+            cloud_api._provisioned_devices = await _run(
+                cloud_api._get_provisioned_devices()
+            )
+        return cloud_api._provisioned_devices
+
+    async def refresh_packages(self, release_type, hardware_id):
+        return await _run(
+            self._cloud_api._refresh_packages(release_type, hardware_id)
+        )
+
+    async def get_latest_build(self, release_type, hardware_id):
+        return await _run(
+            self._cloud_api._get_latest_build(release_type, hardware_id)
+        )
+
+    async def get_package_metadata_for_device(self, uuid):
+        return await _run(
+            self._cloud_api._get_package_metadata_for_device(uuid)
+        )
+
+    async def launch_update(self, package_id, device_uuids):
+        """Updates every device of `device_uuids` to `package_id` at once."""
+        return await _run(
+            self._cloud_api._launch_update(package_id, device_uuids)
+        )
+
+    async def get_current_builds(self, hardware_ids):
+        """The build each device of `hardware_ids`, uuid -> hardware id, is on.
+
+        Devices whose build can't be found are left out.
+        """
+        return await _run(self._cloud_api._get_current_builds(hardware_ids))
+
+    async def get_network_info(self, uuid):
+        return await _run(self._cloud_api._get_network_info(uuid))
+
+    async def get_remote_session(self, uuid):
+        return await _run(self._cloud_api._get_remote_session(uuid))
+
+    async def create_remote_session(self, uuid, public_key, duration="43200s"):
+        return await _run(
+            self._cloud_api._create_remote_session(uuid, public_key, duration)
+        )
+
+    async def delete_remote_session(self, uuid):
+        return await _run(self._cloud_api._delete_remote_session(uuid))
+
+    def extract_in_flight(self, data):
+        return self._cloud_api.extract_in_flight(data)
+
+    async def get_assigment_status_for_device(self, uuid):
+        return await _run(
+            self._cloud_api._get_assigment_status_for_device(uuid)
+        )
+
+    async def close(self):
+        """Closes the connections kept open by the running event loop."""
+        await async_http.pool().close()
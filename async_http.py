@@ -0,0 +1,377 @@
+import asyncio
+import datetime
+import os
+import ssl
+import time
+import weakref
+import zlib
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import http_wrapper
+import logging_setup
+import metrics
+
+logger = logging_setup.setup_logging()
+
+CONNECT_TIMEOUT_SECONDS = 15
+READ_TIMEOUT_SECONDS = 120
+DEFAULT_PORTS = {"http": 80, "https": 443}
+# Statuses whose responses never have a body.
+NO_BODY_STATUSES = (204, 304)
+
+
+class _StaleConnection(Exception):
+    """A kept-alive connection the server closed before the request got in."""
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.requests = 0
+
+    def usable(self):
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections for one event loop.
+
+    At most `max_connections` requests are in flight per host, each on its
+    own connection, the others wait for one of them to be done. Connections
+    are kept open and reused by the next requests to the same host.
+
+    Like the requests session of http_wrapper, TLS certificates are checked
+    against REQUESTS_CA_BUNDLE, or the bundle requests ships with. Proxies
+    aren't supported.
+    """
+
+    def __init__(
+        self,
+        max_connections=http_wrapper.POOL_CONNECTIONS,
+        connect_timeout=CONNECT_TIMEOUT_SECONDS,
+        read_timeout=READ_TIMEOUT_SECONDS,
+    ):
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self._idle = {}
+        self._limits = {}
+        self._ssl_context = None
+
+    def _context(self):
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context(
+                cafile=os.getenv("REQUESTS_CA_BUNDLE")
+                or os.getenv("CURL_CA_BUNDLE")
+                or requests.certs.where()
+            )
+        return self._ssl_context
+
+    async def _connect(self, key, prepared):
+        scheme, host, port = key
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    host,
+                    port,
+                    ssl=self._context() if scheme == "https" else None,
+                ),
+                self.connect_timeout,
+            )
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ConnectTimeout(
+                f"Connection to {host}:{port} timed out after {self.connect_timeout}s",
+                request=prepared,
+            )
+        except ssl.SSLError as e:
+            raise requests.exceptions.SSLError(e, request=prepared)
+        except OSError as e:
+            # Wrapped like urllib3 does, so that http_wrapper knows the
+            # request wasn't sent.
+            raise requests.exceptions.ConnectionError(
+                MaxRetryError(
+                    None,
+                    prepared.url,
+                    NewConnectionError(
+                        None, f"Failed to establish a new connection: {e}"
+                    ),
+                ),
+                request=prepared,
+            )
+        logger.debug("Opened a connection to %s:%s", host, port)
+        return _Connection(reader, writer)
+
+    async def _exchange(self, connection, prepared, parts):
+        """Sends `prepared` on `connection`, returns its response.
+
+        Also returns whether the connection can be used again.
+        """
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        lines = [
+            f"{prepared.method} {target} HTTP/1.1",
+            f"Host: {parts.netloc}",
+        ]
+        lines.extend(
+            f"{name}: {value}" for name, value in prepared.headers.items()
+        )
+        body = prepared.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        reader = connection.reader
+        try:
+            connection.writer.write(
+                ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+            )
+            await connection.writer.drain()
+            status_line = await reader.readline()
+        except (ConnectionResetError, BrokenPipeError) as e:
+            if connection.requests:
+                raise _StaleConnection() from e
+            raise
+        if not status_line:
+            if connection.requests:
+                raise _StaleConnection()
+            raise ConnectionError(
+                "Remote end closed connection without response"
+            )
+
+        while True:
+            version, status, reason = _parse_status_line(status_line)
+            headers = await _read_headers(reader)
+            # Interim responses, such as 100 Continue, are followed by the real one.
+            if not 100 <= status < 200:
+                break
+            status_line = await reader.readline()
+
+        keep_alive = version == "HTTP/1.1" and "close" not in (
+            headers.get("Connection", "").lower()
+        )
+        if prepared.method == "HEAD" or status in NO_BODY_STATUSES:
+            content = b""
+        elif "chunked" in headers.get("Transfer-Encoding", "").lower():
+            content = await _read_chunked(reader)
+        elif "Content-Length" in headers:
+            content = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            content = await reader.read()
+            keep_alive = False
+
+        res = requests.Response()
+        res.status_code = status
+        res.reason = reason
+        res.headers = headers
+        res._content = _decode(content, headers.get("Content-Encoding", ""))
+        res.encoding = requests.utils.get_encoding_from_headers(headers)
+        res.url = prepared.url
+        res.request = prepared
+        res.connection_reused = connection.requests > 0
+        return res, keep_alive
+
+    async def request(self, method, url, headers=None, data=None, json=None):
+        """Sends a request, returns its response as a requests.Response.
+
+        Errors are raised as the requests exceptions requests would raise.
+        """
+        merged = requests.utils.default_headers()
+        merged.update(headers or {})
+        prepared = requests.Request(
+            method.upper(), url, headers=merged, data=data, json=json
+        ).prepare()
+        parts = urlsplit(prepared.url)
+        if parts.scheme not in DEFAULT_PORTS:
+            raise requests.exceptions.InvalidSchema(
+                f"No connection adapters were found for {url!r}"
+            )
+        key = (
+            parts.scheme,
+            parts.hostname,
+            parts.port or DEFAULT_PORTS[parts.scheme],
+        )
+
+        limit = self._limits.setdefault(
+            key, asyncio.Semaphore(self.max_connections)
+        )
+        started = time.perf_counter()
+        async with limit:
+            while True:
+                connection = self._take(key) or await self._connect(
+                    key, prepared
+                )
+                try:
+                    res, keep_alive = await asyncio.wait_for(
+                        self._exchange(connection, prepared, parts),
+                        self.read_timeout,
+                    )
+                except _StaleConnection:
+                    # The server closed it while it was idle, the request
+                    # never got in and can be sent on a new connection.
+                    connection.close()
+                    continue
+                except asyncio.TimeoutError:
+                    connection.close()
+                    raise requests.exceptions.ReadTimeout(
+                        f"No response from {parts.netloc} after {self.read_timeout}s",
+                        request=prepared,
+                    )
+                except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                    connection.close()
+                    raise requests.exceptions.ConnectionError(
+                        e, request=prepared
+                    )
+                except BaseException:
+                    # Cancelled or failed halfway, what's left of the
+                    # response would be read by the next request.
+                    connection.close()
+                    raise
+
+                res.elapsed = datetime.timedelta(
+                    seconds=time.perf_counter() - started
+                )
+                connection.requests += 1
+                if keep_alive:
+                    self._idle.setdefault(key, []).append(connection)
+                else:
+                    connection.close()
+                return res
+
+    def _take(self, key):
+        idle = self._idle.get(key, [])
+        while idle:
+            connection = idle.pop()
+            if connection.usable():
+                return connection
+            connection.close()
+        return None
+
+    async def close(self):
+        """Closes the connections kept open."""
+        connections = [c for idle in self._idle.values() for c in idle]
+        self._idle.clear()
+        for connection in connections:
+            connection.close()
+        for connection in connections:
+            try:
+                await connection.writer.wait_closed()
+            except OSError:
+                pass
+
+
+def _parse_status_line(line):
+    try:
+        version, status, *reason = line.decode("latin-1").split(None, 2)
+        status = int(status)
+    except ValueError:
+        raise ValueError(f"Bad status line {line!r}")
+    return version, status, reason[0].strip() if reason else ""
+
+
+async def _read_headers(reader):
+    headers = CaseInsensitiveDict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n"):
+            return headers
+        if not line:
+            raise asyncio.IncompleteReadError(b"", None)
+
+        name, _, value = line.decode("latin-1").partition(":")
+        name, value = name.strip(), value.strip()
+        # Repeated headers are joined, as requests does.
+        headers[name] = (
+            f"{headers[name]}, {value}" if name in headers else value
+        )
+
+
+async def _read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if not size:
+            # Trailers, if any, up to the final empty line.
+            await _read_headers(reader)
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+def _decode(content, encoding):
+    encoding = encoding.strip().lower()
+    if not content or encoding not in ("gzip", "deflate"):
+        return content
+    try:
+        if encoding == "gzip":
+            return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            # Some servers send raw deflate data, without the zlib header.
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    except zlib.error as e:
+        raise requests.exceptions.ContentDecodingError(
+            f"Received a response body that failed to decode with {encoding}: {e}"
+        )
+
+
+_pools = weakref.WeakKeyDictionary()
+
+
+def pool():
+    """The connection pool of the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _pools:
+        _pools[loop] = ConnectionPool()
+    return _pools[loop]
+
+
+async def endpoint_call(
+    url,
+    request_type,
+    headers=None,
+    body=None,
+    json_data=None,
+    retry=http_wrapper.DEFAULT_RETRY,
+    max_stale=None,
+):
+    """http_wrapper.endpoint_call for asyncio code.
+
+    The request is sent on a connection of pool(), without blocking the event
+    loop, and is cached, recorded, throttled and retried the same way.
+    """
+    if request_type not in ("get", "head", "post", "delete"):
+        raise ValueError(f"request type {request_type} not supported")
+
+    call = http_wrapper.CallState(url, request_type, headers, retry, max_stale)
+    res = call.cached_response()
+    if res is not None:
+        return res
+
+    while True:
+        waited = await call.bucket.acquire_async()
+        if waited:
+            metrics.API_RATE_LIMIT_WAIT_SECONDS.inc(waited)
+
+        res = None
+        started = time.perf_counter()
+        try:
+            res = await pool().request(
+                request_type, url, call.headers, body, json_data
+            )
+            return call.response(res, started)
+        except requests.exceptions.RequestException as e:
+            delay = call.retry_delay(e, res, started)
+            if delay is None:
+                raise
+            if delay:
+                await asyncio.sleep(delay)
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+"""End-to-end benchmark of the device-acquisition path.
+
+Runs aval's own matching and locking code against the cloud simulator and a
+real Postgres (see postgresql/docker-compose.yml), for several fleet sizes, and
+stores the results as JSON so they can be compared between commits.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from pathlib import Path
+from unittest.mock import patch
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import logging_setup  # noqa: E402
+
+logger = logging_setup.setup_logging()
+
+RESULTS_FORMAT_VERSION = 1
+
+# Metrics compared against a baseline; lower is better for all of them.
+COMPARED_METRICS = (
+    "time_to_first_lock_seconds",
+    "wall_time_seconds",
+    "api_calls_per_device",
+    "db_connections_per_lock",
+)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark aval's device-acquisition path against the simulator."
+    )
+    parser.add_argument(
+        "--fleet-sizes",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="Number of simulated devices of each run.",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Runs per fleet size, the median of each metric is kept.",
+    )
+    parser.add_argument(
+        "--soc-udt",
+        default="arm64",
+        help="SOC_UDT aval matches the fleet against, a SoC or an architecture.",
+    )
+    parser.add_argument(
+        "--locked-ratio",
+        type=float,
+        default=0.5,
+        help="Fraction of the matching devices already locked by someone else.",
+    )
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--output",
+        help="Where to write the results. Defaults to acquisition-<commit>.json.",
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="BASELINE",
+        help="Results of a previous run to compare against.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative increase of a metric over the baseline considered a regression.",
+    )
+    return parser.parse_args(argv)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PROJECT_ROOT,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def candidate_uuids(fleet, pid_map, soc_udt):
+    """Devices aval is expected to match, in the order it will try them."""
+    import convolute
+
+    if pid_map.is_architecture(soc_udt):
+        pid4s = convolute.get_pid4_list_from_architecture(
+            soc_udt, pid_map, False
+        )
+    else:
+        pid4s = convolute.get_pid4_list(soc_udt, pid_map)
+
+    pid4s = set(pid4s)
+    return [
+        device.uuid for device in fleet.devices.values() if device.pid4 in pid4s
+    ]
+
+
+def seed_database(device_uuids, locked_uuids):
+    import database
+
+    with database.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO devices (device_uuid, is_locked, timestamp) VALUES (%s, %s, NOW()) "
+                "ON CONFLICT (device_uuid) DO UPDATE SET is_locked = EXCLUDED.is_locked",
+                [(uuid, uuid in locked_uuids) for uuid in device_uuids],
+            )
+        conn.commit()
+
+
+def clean_database(device_uuids):
+    import database
+
+    with database.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM devices WHERE device_uuid = ANY(%s::uuid[])",
+                (list(device_uuids),),
+            )
+        conn.commit()
+
+
+def run_once(simulator, fleet, args, pid_map_path):
+    """Runs aval's acquisition path once and returns its metrics."""
+    import database
+    import device_handler
+    import device_matcher
+    from cloud import CloudAPI
+
+    env_vars = {
+        "TORIZON_API_CLIENT_ID": "benchmark",
+        "TORIZON_API_SECRET_ID": "benchmark",
+        "PUBLIC_KEY": "ssh-ed25519 benchmark",
+        "DEVICE_PASSWORD": "benchmark",
+        "TARGET_BUILD_TYPE": "nightly",
+        "TEST_WHOLE_FLEET": False,
+        "USE_RAC": True,
+        "USE_COMMON_DEVICES": False,
+        "SOC_UDT": args.soc_udt,
+    }
+    aval_args = Namespace(
+        command="true",
+        before=None,
+        copy_artifact=None,
+        delegation_config=str(PROJECT_ROOT / "delegation_config.toml"),
+        device_config=None,
+        run_before_on_host=None,
+        pid_map=pid_map_path,
+        ignore_different_secondaries_between_updates=False,
+        do_not_update=True,
+        remove_databases=False,
+        hacking_session=False,
+    )
+
+    connect = database.psycopg.connect
+    acquire_lock = database.acquire_lock
+    db_connections = 0
+    locks = []
+
+    def counting_connect(*a, **kw):
+        nonlocal db_connections
+        db_connections += 1
+        return connect(*a, **kw)
+
+    def timed_acquire_lock(device_uuid):
+        locked = acquire_lock(device_uuid)
+        if locked:
+            locks.append(time.perf_counter())
+        return locked
+
+    simulator.stats.reset()
+    started = time.perf_counter()
+    with patch.object(
+        database.psycopg, "connect", counting_connect
+    ), patch.object(database, "acquire_lock", timed_acquire_lock):
+        cloud = CloudAPI(
+            api_client=env_vars["TORIZON_API_CLIENT_ID"],
+            api_secret=env_vars["TORIZON_API_SECRET_ID"],
+            delegation_config_path=aval_args.delegation_config,
+        )
+        possible_duts = device_matcher.find_possible_devices(
+            cloud, aval_args, env_vars
+        )
+        locked = device_handler.process_devices(
+            possible_duts, cloud, env_vars, aval_args
+        )
+    wall_time = time.perf_counter() - started
+
+    if not locked or not locks:
+        raise RuntimeError("aval did not lock any device")
+
+    api_calls = simulator.stats.to_json()
+    return {
+        "time_to_first_lock_seconds": locks[0] - started,
+        "wall_time_seconds": wall_time,
+        "api_calls": api_calls["total"],
+        "api_calls_per_device": api_calls["total"] / len(fleet.devices),
+        "api_calls_by_route": api_calls["requests"],
+        "db_connections": db_connections,
+        "db_connections_per_lock": db_connections / len(locks),
+        "candidates": len(possible_duts),
+    }
+
+
+def summarize(runs):
+    """Median of every numeric metric over repeated runs."""
+    summary = {}
+    for name, value in runs[0].items():
+        if isinstance(value, (int, float)):
+            summary[name] = statistics.median(run[name] for run in runs)
+        else:
+            summary[name] = value
+    summary["runs"] = len(runs)
+    return summary
+
+
+def benchmark_fleet(simulator, ssh_port, size, args):
+    import pid4_map
+    import rule_table
+    from simulator.torizon_cloud import Fleet, SimulatorConfig
+
+    pid_map_path = pid4_map.default_pid_map_path()
+    pid_map = pid4_map.load(pid_map_path)
+
+    fleet = Fleet(
+        SimulatorConfig(
+            latency_ms=args.latency_ms, ssh_port=ssh_port, seed=args.seed
+        )
+    )
+    fleet.populate(size, pid_map, rule_table.load_hardware_id_resolver())
+    simulator.fleet = fleet
+
+    candidates = candidate_uuids(fleet, pid_map, args.soc_udt)
+    if not candidates:
+        raise RuntimeError(
+            f"No device of a {size} devices fleet matches {args.soc_udt}"
+        )
+    # The last candidate stays free, otherwise aval busy-waits on it.
+    locked = set(
+        candidates[
+            : min(int(len(candidates) * args.locked_ratio), len(candidates) - 1)
+        ]
+    )
+
+    runs = []
+    try:
+        for _ in range(args.repeat):
+            seed_database(list(fleet.devices), locked)
+            for device in fleet.devices.values():
+                device.session = None
+            runs.append(run_once(simulator, fleet, args, pid_map_path))
+    finally:
+        clean_database(list(fleet.devices))
+
+    summary = summarize(runs)
+    summary["locked_ahead"] = len(locked)
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    """Returns the lines of a comparison report and the regressed metrics."""
+    lines = []
+    regressions = []
+    for size, metrics in results["fleets"].items():
+        previous = baseline["fleets"].get(size)
+        if previous is None:
+            continue
+        for name in COMPARED_METRICS:
+            old, new = previous.get(name), metrics.get(name)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            regressed = change > tolerance
+            lines.append(
+                f"{size:>6} {name:<28} {old:>12.4f} {new:>12.4f} {change:>+8.1%}"
+                + (" REGRESSION" if regressed else "")
+            )
+            if regressed:
+                regressions.append((size, name))
+    return lines, regressions
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    missing = [
+        name
+        for name in (
+            "POSTGRES_DB",
+            "POSTGRES_USER",
+            "POSTGRES_PASSWORD",
+            "POSTGRES_HOST",
+            "POSTGRES_PORT",
+        )
+        if name not in os.environ
+    ]
+    if missing and not os.environ.get("AWS_RDS_HOST"):
+        logger.error(
+            "Missing environment variables for the benchmark database: %s",
+            ", ".join(missing),
+        )
+        sys.exit(1)
+
+    from simulator.ssh_target import SshTarget
+    from simulator.torizon_cloud import (
+        Fleet,
+        SimulatorConfig,
+        TorizonCloudSimulator,
+    )
+
+    ssh_target = SshTarget(password="benchmark").start()
+    simulator = TorizonCloudSimulator(Fleet(SimulatorConfig())).start()
+    # cloud and device read these when they are first imported.
+    os.environ.update(simulator.environment())
+
+    results = {
+        "format_version": RESULTS_FORMAT_VERSION,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "soc_udt": args.soc_udt,
+            "locked_ratio": args.locked_ratio,
+            "latency_ms": args.latency_ms,
+            "repeat": args.repeat,
+            "seed": args.seed,
+        },
+        "fleets": {},
+    }
+
+    cwd = os.getcwd()
+    output = os.path.abspath(
+        args.output or f"acquisition-{results['commit']}.json"
+    )
+    try:
+        # process_devices writes device_information.json to the current
+        # directory.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.chdir(tmp_dir)
+            for size in args.fleet_sizes:
+                results["fleets"][str(size)] = benchmark_fleet(
+                    simulator, ssh_target.port, size, args
+                )
+    finally:
+        os.chdir(cwd)
+        simulator.stop()
+        ssh_target.stop()
+        import database
+
+        database.shutdown_database_access()
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(
+        f"{'fleet':>6} {'first lock (s)':>15} {'wall (s)':>10} {'API/device':>11} {'DB/lock':>8}"
+    )
+    for size, metrics in results["fleets"].items():
+        print(
+            f"{size:>6} {metrics['time_to_first_lock_seconds']:>15.4f} "
+            f"{metrics['wall_time_seconds']:>10.4f} "
+            f"{metrics['api_calls_per_device']:>11.3f} "
+            f"{metrics['db_connections_per_lock']:>8.1f}"
+        )
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print(f"\nCompared with {baseline.get('commit', args.compare)}:")
+        print("\n".join(lines))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
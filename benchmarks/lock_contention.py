@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+"""Lock contention harness for the Postgres lock table.
+
+Spawns many workers, each standing in for a CI runner, that keep locking one
+of a handful of boards, holding it for a while and releasing it. Every worker is
+a separate process, as aval's database module keeps its heartbeat per process.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+import uuid as uuid_lib
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import logging_setup  # noqa: E402
+from benchmarks.acquisition import (  # noqa: E402
+    clean_database,
+    git_commit,
+    seed_database,
+)
+
+logger = logging_setup.setup_logging()
+
+
+def _lock_in_order(device_uuids, retry_seconds, rng):
+    """aval's strategy: fail fast on every board, then busy-wait on the last."""
+    import database
+
+    for index, device_uuid in enumerate(device_uuids):
+        is_last_device = index == len(device_uuids) - 1
+        if database.try_until_locked(
+            device_uuid,
+            max_attempts=sys.maxsize,
+            sleep=retry_seconds,
+            fail_fast=not is_last_device,
+        ):
+            return device_uuid
+    return None
+
+
+def _lock_shuffled(device_uuids, retry_seconds, rng):
+    """Like aval, but every worker walks the boards in its own order."""
+    device_uuids = list(device_uuids)
+    rng.shuffle(device_uuids)
+    return _lock_in_order(device_uuids, retry_seconds, rng)
+
+
+def _lock_skip_locked(device_uuids, retry_seconds, rng):
+    """Picks any free board in a single statement, polling while none is."""
+    import database
+
+    while True:
+        with database.get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE devices SET is_locked = TRUE, timestamp = NOW() "
+                    "WHERE device_uuid = ("
+                    "SELECT device_uuid FROM devices "
+                    "WHERE device_uuid = ANY(%s::uuid[]) AND NOT is_locked "
+                    "LIMIT 1 FOR UPDATE SKIP LOCKED) "
+                    "RETURNING device_uuid",
+                    (list(device_uuids),),
+                )
+                row = cursor.fetchone()
+            conn.commit()
+
+        if row:
+            return str(row[0])
+        time.sleep(retry_seconds)
+
+
+STRATEGIES = {
+    "aval": _lock_in_order,
+    "shuffled": _lock_shuffled,
+    "skip-locked": _lock_skip_locked,
+}
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure how workers competing for a few boards behave on the Postgres lock table."
+    )
+    parser.add_argument("--workers", type=int, default=50)
+    parser.add_argument("--devices", type=int, default=5)
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=60,
+        help="Seconds during which workers keep asking for boards.",
+    )
+    parser.add_argument(
+        "--hold-seconds",
+        type=float,
+        nargs=2,
+        default=[1.0, 5.0],
+        metavar=("MIN", "MAX"),
+        help="Range of time a worker keeps its board locked.",
+    )
+    parser.add_argument(
+        "--retry-seconds",
+        type=float,
+        default=1.0,
+        help="Sleep between attempts on a busy board, 90 seconds in aval.",
+    )
+    parser.add_argument(
+        "--strategies",
+        nargs="+",
+        choices=sorted(STRATEGIES),
+        default=sorted(STRATEGIES),
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--output",
+        help="Where to write the results. Defaults to lock-contention-<commit>.json.",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Keep aval's logging in the workers.",
+    )
+    return parser.parse_args(argv)
+
+
+def worker(worker_id, strategy, device_uuids, args, results):
+    import database
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    connect = database.psycopg.connect
+    connections = 0
+
+    def counting_connect(*a, **kw):
+        nonlocal connections
+        connections += 1
+        return connect(*a, **kw)
+
+    database.psycopg.connect = counting_connect
+
+    rng = random.Random(f"{args.seed}-{worker_id}")
+    deadline = time.time() + args.duration
+    acquisitions = []
+
+    while time.time() < deadline:
+        connections = 0
+        requested = time.time()
+        device_uuid = STRATEGIES[strategy](
+            device_uuids, args.retry_seconds, rng
+        )
+        acquired = time.time()
+        acquire_connections = connections
+
+        time.sleep(rng.uniform(*args.hold_seconds))
+        database.release_lock(device_uuid)
+
+        acquisitions.append(
+            {
+                "worker": worker_id,
+                "device": device_uuid,
+                "requested": requested,
+                "acquired": acquired,
+                "released": time.time(),
+                "connections": acquire_connections,
+            }
+        )
+
+    results.put(acquisitions)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return {"p50": value, "p90": value, "p99": value, "max": value}
+
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": cuts[49],
+        "p90": cuts[89],
+        "p99": cuts[98],
+        "max": max(values),
+    }
+
+
+def jain_index(values):
+    """Jain's fairness index: 1 when all values are equal, 1/n at worst."""
+    if not values or not any(values):
+        return 1.0
+    return sum(values) ** 2 / (len(values) * sum(v * v for v in values))
+
+
+def idle_device_seconds(acquisitions, devices):
+    """Time boards stayed free while some worker was waiting for one.
+
+    Counted as the sum over time of min(free boards, waiting workers).
+    """
+    events = []
+    for a in acquisitions:
+        events.append((a["requested"], 0, 1))
+        events.append((a["acquired"], 0, -1))
+        events.append((a["acquired"], -1, 0))
+        events.append((a["released"], 1, 0))
+    events.sort()
+
+    idle = 0.0
+    free, waiting = devices, 0
+    previous = events[0][0] if events else 0.0
+    for timestamp, free_delta, waiting_delta in events:
+        idle += (timestamp - previous) * min(free, waiting)
+        free += free_delta
+        waiting += waiting_delta
+        previous = timestamp
+    return idle
+
+
+def summarize(acquisitions, workers, devices, elapsed, db_transactions):
+    waits = [a["acquired"] - a["requested"] for a in acquisitions]
+    per_worker = {worker_id: [] for worker_id in range(workers)}
+    for a, wait in zip(acquisitions, waits):
+        per_worker[a["worker"]].append(wait)
+
+    busy = sum(a["released"] - a["acquired"] for a in acquisitions)
+    connections = sum(a["connections"] for a in acquisitions)
+    return {
+        "acquisitions": len(acquisitions),
+        "wait_seconds": percentiles(waits),
+        "fairness_acquisitions": jain_index(
+            [len(w) for w in per_worker.values()]
+        ),
+        "fairness_wait": jain_index([sum(w) for w in per_worker.values()]),
+        "starved_workers": sum(1 for w in per_worker.values() if not w),
+        "utilization": busy / (devices * elapsed) if elapsed else 0.0,
+        "idle_device_seconds_while_waiting": idle_device_seconds(
+            acquisitions, devices
+        ),
+        "db_connections_per_acquisition": (
+            connections / len(acquisitions) if acquisitions else 0.0
+        ),
+        "db_transactions_per_second": (
+            db_transactions / elapsed if elapsed else 0.0
+        ),
+    }
+
+
+def database_transactions():
+    import database
+
+    with database.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT xact_commit + xact_rollback FROM pg_stat_database "
+                "WHERE datname = current_database()"
+            )
+            return cursor.fetchone()[0]
+
+
+def run_strategy(strategy, device_uuids, args):
+    seed_database(device_uuids, set())
+
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(
+            target=worker,
+            args=(worker_id, strategy, device_uuids, args, results),
+        )
+        for worker_id in range(args.workers)
+    ]
+
+    transactions_before = database_transactions()
+    started = time.time()
+    for process in processes:
+        process.start()
+
+    acquisitions = []
+    for _ in processes:
+        acquisitions.extend(results.get())
+    for process in processes:
+        process.join()
+
+    elapsed = time.time() - started
+    # Statistics are only flushed to pg_stat_database every so often.
+    time.sleep(1)
+    db_transactions = database_transactions() - transactions_before
+
+    return summarize(
+        acquisitions, args.workers, len(device_uuids), elapsed, db_transactions
+    )
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    rng = random.Random(args.seed)
+    device_uuids = [
+        str(uuid_lib.UUID(int=rng.getrandbits(128)))
+        for _ in range(args.devices)
+    ]
+
+    results = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "workers": args.workers,
+            "devices": args.devices,
+            "duration": args.duration,
+            "hold_seconds": args.hold_seconds,
+            "retry_seconds": args.retry_seconds,
+            "seed": args.seed,
+        },
+        "strategies": {},
+    }
+
+    try:
+        for strategy in args.strategies:
+            logger.info(
+                "Running %d workers against %d boards with the %s strategy",
+                args.workers,
+                args.devices,
+                strategy,
+            )
+            results["strategies"][strategy] = run_strategy(
+                strategy, device_uuids, args
+            )
+    finally:
+        clean_database(device_uuids)
+        import database
+
+        database.shutdown_database_access()
+
+    output = args.output or f"lock-contention-{results['commit']}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(
+        f"{'strategy':<12} {'locks':>6} {'p50 (s)':>8} {'p99 (s)':>8} "
+        f"{'fair':>5} {'util':>5} {'idle (s)':>9} {'DB/lock':>8}"
+    )
+    for strategy, metrics in results["strategies"].items():
+        print(
+            f"{strategy:<12} {metrics['acquisitions']:>6} "
+            f"{metrics['wait_seconds']['p50']:>8.2f} "
+            f"{metrics['wait_seconds']['p99']:>8.2f} "
+            f"{metrics['fairness_acquisitions']:>5.2f} "
+            f"{metrics['utilization']:>5.0%} "
+            f"{metrics['idle_device_seconds_while_waiting']:>9.1f} "
+            f"{metrics['db_connections_per_acquisition']:>8.1f}"
+        )
+    print(f"Results written to {os.path.abspath(output)}")
+
+
+if __name__ == "__main__":
+    main()
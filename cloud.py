@@ -1,32 +1,85 @@
+import json
+import math
+import os
 import toml
-import re
 from datetime import datetime
 import email.utils
+from urllib.parse import urlencode
 
-from http_wrapper import endpoint_call
+from http_wrapper import IDEMPOTENT_RETRY, endpoint_call
+import http_cache
+from rule_table import RuleTable
+import common
 import logging_setup
 
-API_BASE_URL = "https://app.torizon.io/api/v2"
+# Overridable so that aval can be pointed at a local simulator (see simulator/).
+API_BASE_URL = os.environ.get(
+    "TORIZON_API_BASE_URL", "https://app.torizon.io/api/v2"
+)
+AUTH_URL = os.environ.get(
+    "TORIZON_AUTH_URL",
+    "https://kc.torizon.io/auth/realms/ota-users/protocol/openid-connect/token",
+)
+# Devices asked about per request by the batched lookups, which keeps their
+# URLs well under common length limits.
+DEVICES_PER_REQUEST = 50
+PAGE_SIZE = 100
 logger = logging_setup.setup_logging()
 
 
+def _run(steps):
+    """Sends the requests `steps` yields, returns what it returns.
+
+    `steps` is a generator yielding the endpoint_call arguments of each
+    request and getting back its response, or its error raised in it.
+    """
+    res = error = None
+    while True:
+        try:
+            request = steps.send(res) if error is None else steps.throw(error)
+        except StopIteration as e:
+            return e.value
+
+        try:
+            res, error = endpoint_call(**request), None
+        except Exception as e:
+            res, error = None, e
+
+
 class CloudAPI:
+    """The Torizon Cloud API.
+
+    The requests of each method are written once, as a generator of request
+    steps run by _run(), so that AsyncCloudAPI sends the same requests from
+    an event loop.
+    """
 
     def __init__(self, api_client, api_secret, delegation_config_path):
         self._log = logger
 
         self.api_client = api_client
         self.api_secret = api_secret
+        http_cache.set_namespace(api_client)
 
         self._config = toml.load(delegation_config_path)
+        self._delegation_filters = RuleTable(
+            self._config["delegation_filter"]["filter"], "hardware_id_pattern"
+        )
 
         self.token = self._get_bearer_token()[0]
-        self.provisioned_devices = self._get_provisioned_devices()
+        self._provisioned_devices = None
+
+    @property
+    def provisioned_devices(self):
+        """The whole fleet, listed on first use."""
+        if self._provisioned_devices is None:
+            self._provisioned_devices = _run(self._get_provisioned_devices())
+        return self._provisioned_devices
 
     def _get_bearer_token(self):
         tokens = []
         res = endpoint_call(
-            url="https://kc.torizon.io/auth/realms/ota-users/protocol/openid-connect/token",
+            url=AUTH_URL,
             request_type="post",
             body={
                 "grant_type": "client_credentials",
@@ -35,6 +88,8 @@ class CloudAPI:
             },
             headers=None,
             json_data=None,
+            # Asking for another token is harmless.
+            retry=IDEMPOTENT_RETRY,
         )
 
         tokens.append(res.json()["access_token"])
@@ -43,7 +98,7 @@ class CloudAPI:
         return tuple(tokens)
 
     def _get_provisioned_devices(self):
-        res = endpoint_call(
+        res = yield dict(
             url=API_BASE_URL + "/devices",
             request_type="get",
             body=None,
@@ -52,27 +107,32 @@ class CloudAPI:
                 "accept": "application/json",
             },
             json_data=None,
+            max_stale=0,
         )
 
-        self._log.debug(res.json()["values"])
+        provisioned_devices = res.json()["values"]
+
+        self._log.debug("Provisioned devices: %s", provisioned_devices)
         self._log.debug("Got provisioned devices on platform")
-        return res.json()["values"]
+        return provisioned_devices
 
     def refresh_packages(self, release_type, hardware_id):
+        return _run(self._refresh_packages(release_type, hardware_id))
+
+    def _refresh_packages(self, release_type, hardware_id):
         delegation_prefix = None
         namespace = None
 
         self._log.info("Refreshing package source")
 
-        for filter_entry in self._config["delegation_filter"]["filter"]:
-            if re.search(filter_entry["hardware_id_pattern"], hardware_id):
-                namespace = filter_entry["namespace"]
+        filter_entry = self._delegation_filters.lookup(hardware_id)
+        if filter_entry:
+            namespace = filter_entry["namespace"]
 
-                if namespace in ("torizon", "torizon-upstream"):
-                    delegation_prefix = "tdx"
-                elif namespace == "common-torizon":
-                    delegation_prefix = "common-torizon"
-                break
+            if namespace in ("torizon", "torizon-upstream"):
+                delegation_prefix = "tdx"
+            elif namespace == "common-torizon":
+                delegation_prefix = "common-torizon"
 
         if not delegation_prefix:
             raise Exception(
@@ -92,16 +152,17 @@ class CloudAPI:
             )
 
         external_source = f"{delegation_prefix}-{delegation_release_type}"
-        self._log.debug(f"external_source: {external_source}")
+        self._log.debug("external_source: %s", external_source)
 
         try:
-            info = endpoint_call(
+            info = yield dict(
                 url=API_BASE_URL + "/packages_external/info",
                 request_type="get",
                 headers={
                     "Authorization": f"Bearer {self.token}",
                     "accept": "*/*",
                 },
+                max_stale=0,
             )
         except Exception as e:
             self._log.error(
@@ -112,7 +173,7 @@ class CloudAPI:
         info_json = info.json()
 
         self._log.debug("Received /packages_external/info response")
-        self._log.debug(f"info_json content: {info_json}")
+        self._log.debug("info_json content: %s", info_json)
 
         if external_source not in info_json:
             self._log.error(
@@ -121,7 +182,7 @@ class CloudAPI:
             return
 
         source_data = info_json[external_source]
-        self._log.debug(f"Source data: {source_data}")
+        self._log.debug("Source data: %s", source_data)
 
         try:
             remote_uri = source_data["remoteUri"]
@@ -136,9 +197,9 @@ class CloudAPI:
             f"Source {external_source} - lastFetched={last_fetched} remoteUri={remote_uri}"
         )
 
-        self._log.debug(f"Sending HEAD request to {remote_uri}")
+        self._log.debug("Sending HEAD request to %s", remote_uri)
         try:
-            head = endpoint_call(
+            head = yield dict(
                 url=remote_uri,
                 request_type="head",
             )
@@ -169,7 +230,10 @@ class CloudAPI:
             return
 
         self._log.debug(
-            f"Parsed dates for {external_source} - lastFetched={lf_dt} lastModified={lm_dt}"
+            "Parsed dates for %s - lastFetched=%s lastModified=%s",
+            external_source,
+            lf_dt,
+            lm_dt,
         )
 
         if lm_dt > lf_dt:
@@ -180,10 +244,10 @@ class CloudAPI:
             refresh_url = (
                 f"{API_BASE_URL}/packages_external/refresh/{external_source}"
             )
-            self._log.debug(f"Calling refresh endpoint: {refresh_url}")
+            self._log.debug("Calling refresh endpoint: %s", refresh_url)
 
             try:
-                refresh = endpoint_call(
+                refresh = yield dict(
                     url=refresh_url,
                     request_type="get",
                     headers={
@@ -210,24 +274,30 @@ class CloudAPI:
         )
 
     def get_latest_build(self, release_type, hardware_id):
-        self.refresh_packages(release_type, hardware_id)
+        return _run(self._get_latest_build(release_type, hardware_id))
+
+    def _get_latest_build(self, release_type, hardware_id):
+        yield from self._refresh_packages(release_type, hardware_id)
+
+        filter_entry = self._delegation_filters.lookup(hardware_id)
+        if not filter_entry:
+            raise Exception(
+                f"Couldn't find a delegation filter for hardware_id={hardware_id}"
+            )
 
-        for filter_entry in self._config["delegation_filter"]["filter"]:
-            if re.search(filter_entry["hardware_id_pattern"], hardware_id):
-                name_prefix = filter_entry["name_prefix"]
-                namespace = filter_entry["namespace"]
-                name_suffix = filter_entry["name_suffix"]
+        name_prefix = filter_entry["name_prefix"]
+        namespace = filter_entry["namespace"]
+        name_suffix = filter_entry["name_suffix"]
 
-                name_contains = f"{name_prefix}/{hardware_id}/{namespace}/{name_suffix}/{release_type}"
-                break
+        name_contains = f"{name_prefix}/{hardware_id}/{namespace}/{name_suffix}/{release_type}"
 
         url = (
             API_BASE_URL
             + f"/packages?nameContains={name_contains}&hardwareIds={hardware_id}&sortBy=Filename&sortDirection=Desc"
         )
 
-        res = endpoint_call(
-            url,
+        res = yield dict(
+            url=url,
             request_type="get",
             body=None,
             headers={
@@ -235,13 +305,13 @@ class CloudAPI:
                 "accept": "application/json",
             },
             json_data=None,
+            max_stale=0,
         )
 
-        self._log.debug(res.json()["values"])
+        packages = res.json()["values"]
+        self._log.debug("Packages: %s", packages)
 
-        latest_build = next(
-            (item["packageId"] for item in res.json().get("values", [])), None
-        )
+        latest_build = next((item["packageId"] for item in packages), None)
         if latest_build:
             self._log.info(f"Latest build is {latest_build}")
             return latest_build
@@ -251,7 +321,10 @@ class CloudAPI:
             )
 
     def get_package_metadata_for_device(self, uuid):
-        res = endpoint_call(
+        return _run(self._get_package_metadata_for_device(uuid))
+
+    def _get_package_metadata_for_device(self, uuid):
+        res = yield dict(
             url=API_BASE_URL + f"/devices/packages?deviceUuid={uuid}",
             request_type="get",
             body=None,
@@ -262,16 +335,190 @@ class CloudAPI:
             json_data=None,
         )
 
-        self._log.debug(res.json()["values"])
+        metadata = res.json()["values"]
+
+        self._log.debug("Package metadata: %s", metadata)
         self._log.info(f"Got package metadata for device {uuid}")
-        return res.json()["values"]
+        return metadata
+
+    def launch_update(self, package_id, device_uuids):
+        """Updates every device of `device_uuids` to `package_id` at once."""
+        return _run(self._launch_update(package_id, device_uuids))
+
+    def _launch_update(self, package_id, device_uuids):
+        res = yield dict(
+            url=API_BASE_URL + "/updates",
+            request_type="post",
+            body=None,
+            headers={
+                "accept": "application/json",
+                "Authorization": f"Bearer {self.token}",
+                "Content-Type": "application/json",
+            },
+            json_data={
+                "packageIds": [package_id],
+                "devices": list(device_uuids),
+            },
+        )
+
+        # FIXME: currently a bug on the Cloud side. Returns 201 when succesfull.
+        if res.status_code == 200 or res.status_code == 201:
+            self._log.info(
+                f"Update to {package_id} issued for {len(device_uuids)} device(s)"
+            )
+        else:
+            self._log.error(
+                f"Update launch request failed with status code: {res.status_code}"
+            )
+            self._log.info(json.dumps(res.json(), indent=2))
+
+        res.raise_for_status()
+
+    def _get_all_values(self, path, params):
+        """Every value of a paginated list endpoint."""
+        values = []
+        while True:
+            query = urlencode(
+                params + [("offset", len(values)), ("limit", PAGE_SIZE)]
+            )
+            res = yield dict(
+                url=f"{API_BASE_URL}{path}?{query}",
+                request_type="get",
+                body=None,
+                headers={
+                    "Authorization": f"Bearer {self.token}",
+                    "accept": "application/json",
+                },
+                json_data=None,
+            )
+            page = res.json()
+            values.extend(page["values"])
+            if not page["values"] or len(values) >= page.get("total", 0):
+                return values
+
+    def get_current_builds(self, hardware_ids):
+        """The build each device of `hardware_ids`, uuid -> hardware id, is on.
+
+        The package metadata of many devices is fetched per request. Devices
+        whose build can't be found are left out.
+        """
+        return _run(self._get_current_builds(hardware_ids))
+
+    def _get_current_builds(self, hardware_ids):
+        uuids = list(hardware_ids)
+        # Listing the whole fleet, unfiltered, takes fewer requests when
+        # asking for most of it. Only worth knowing when it's listed already.
+        fleet_pages = (
+            math.ceil(len(self._provisioned_devices) / PAGE_SIZE)
+            if self._provisioned_devices is not None
+            else math.inf
+        )
+        if math.ceil(len(uuids) / DEVICES_PER_REQUEST) > fleet_pages:
+            batches = [[]]
+        else:
+            batches = []
+            for start in range(0, len(uuids), DEVICES_PER_REQUEST):
+                end = start + DEVICES_PER_REQUEST
+                batches.append(uuids[start:end])
+
+        builds = {}
+        for batch in batches:
+            values = yield from self._get_all_values(
+                "/devices/packages", [("deviceUuid", uuid) for uuid in batch]
+            )
+            for metadata in values:
+                uuid = metadata["deviceUuid"]
+                if uuid not in hardware_ids:
+                    continue
+                build = common.find_installed_package(
+                    [metadata], hardware_ids[uuid]
+                )
+                if build is not None:
+                    builds[uuid] = build
+
+        self._log.info(
+            f"Got the current build of {len(builds)} of {len(uuids)} devices in {len(batches)} batch(es)"
+        )
+        return builds
+
+    def get_network_info(self, uuid):
+        return _run(self._get_network_info(uuid))
+
+    def _get_network_info(self, uuid):
+        res = yield dict(
+            url=API_BASE_URL + f"/devices/network/{uuid}",
+            request_type="get",
+            body=None,
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "accept": "application/json",
+            },
+            json_data=None,
+            max_stale=0,
+        )
+        if res is None:
+            raise Exception("Failed to get network info")
+
+        return res.json()
+
+    def get_remote_session(self, uuid):
+        return _run(self._get_remote_session(uuid))
+
+    def _get_remote_session(self, uuid):
+        res = yield dict(
+            url=API_BASE_URL + f"/remote-access/device/{uuid}/sessions",
+            request_type="get",
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "accept": "application/json",
+            },
+        )
+        return res.json()
+
+    def create_remote_session(self, uuid, public_key, duration="43200s"):
+        return _run(self._create_remote_session(uuid, public_key, duration))
+
+    def _create_remote_session(self, uuid, public_key, duration):
+        yield dict(
+            url=API_BASE_URL + f"/remote-access/device/{uuid}/sessions",
+            request_type="post",
+            body=None,
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "accept": "*/*",
+                "Content-Type": "application/json",
+            },
+            json_data={
+                "publicKeys": [
+                    f"{public_key}\n",
+                ],
+                "sessionDuration": duration,
+            },
+        )
+
+    def delete_remote_session(self, uuid):
+        return _run(self._delete_remote_session(uuid))
+
+    def _delete_remote_session(self, uuid):
+        yield dict(
+            url=API_BASE_URL + f"/remote-access/device/{uuid}/sessions",
+            request_type="delete",
+            body=None,
+            headers={
+                "Authorization": f"Bearer {self.token}",
+                "accept": "*/*",
+            },
+        )
 
     def extract_in_flight(self, data):
         for item in data:
             return item.get("inFlight")
 
     def get_assigment_status_for_device(self, uuid):
-        res = endpoint_call(
+        return _run(self._get_assigment_status_for_device(uuid))
+
+    def _get_assigment_status_for_device(self, uuid):
+        res = yield dict(
             url=f"{API_BASE_URL}/devices/uptane/{uuid}/assignment",
             request_type="get",
             body=None,
@@ -282,8 +529,10 @@ class CloudAPI:
             json_data=None,
         )
 
-        self._log.debug(res.json())
+        assignment = res.json()
+
+        self._log.debug("Assignment: %s", assignment)
         self._log.debug(
-            f"Got package update assignment status for device {uuid}"
+            "Got package update assignment status for device %s", uuid
         )
-        return res.json()
+        return assignment
@@ -1,9 +1,50 @@
-from prettytable import PrettyTable
+import os
+import re
+import tempfile
+
 import config_loader
+import rule_table
+from pid4_map import compile_pid_map
 import logging_setup
 
 logger = logging_setup.setup_logging()
 
+PID4_PATTERN = re.compile(r"\d{4}")
+
+
+def cache_dir():
+    """Where aval keeps its local caches."""
+    if os.getenv("AVAL_CACHE_DIR"):
+        return os.environ["AVAL_CACHE_DIR"]
+
+    base = os.getenv("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "aval")
+
+
+def atomic_write(path, data, mode=0o600):
+    """Replaces the file at `path` with `data` in one step.
+
+    Readers, other aval processes included, see the old file or the new one,
+    never part of it. The temporary file is unique to each call, so
+    concurrent writers don't trip over each other.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=f"{os.path.basename(path)}.",
+        suffix=".tmp",
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        if mode != 0o600:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
 
 def parse_device_id(device_id):
     parts = device_id.split("-")
@@ -11,22 +52,40 @@ def parse_device_id(device_id):
 
 
 def parse_hardware_id(device_id):
-    parts = device_id.split("-")
-    if "emmc" in device_id or "smarc" in device_id:
-        return parts[0] + "-" + parts[1] + "-" + parts[2]
-    elif "imx93frdm" in device_id:
-        return parts[0]
-    elif "torizon-x86" in device_id:
-        return "intel-corei7-64"
-    elif "torizon-sl1680" in device_id:
-        return parts[1]
-    elif "torizon" in device_id:
-        return parts[1] + "-" + parts[2]
-    else:
-        return parts[0] + "-" + parts[1]
+    return rule_table.load_hardware_id_resolver().resolve(device_id)
+
+
+def parse_hardware_ids(devices):
+    """deviceUuid -> hardware id, leaving out the devices no rule fits."""
+    resolver = rule_table.load_hardware_id_resolver()
+    hardware_ids = {}
+    for device in devices:
+        try:
+            hardware_ids[device["deviceUuid"]] = resolver.resolve(
+                device.get("deviceId") or ""
+            )
+        except ValueError as e:
+            logger.error(f"Skipping device {device['deviceUuid']}: {e}")
+    return hardware_ids
+
+
+def find_installed_package(metadata, hardware_id):
+    """The package installed for `hardware_id` in a /devices/packages reply."""
+    for device in metadata:
+        for pkg in device["installedPackages"]:
+            logger.debug(
+                "Installed package %s, looking for component %s",
+                pkg,
+                hardware_id,
+            )
+            if pkg["component"] == hardware_id:
+                return pkg["installed"]["packageId"]
+    return None
 
 
 def pretty_print_devices(devices):
+    from prettytable import PrettyTable
+
     table = PrettyTable(["Device UUID", "Device Name"])
     for device in devices:
         table.add_row([device["deviceUuid"], device["deviceName"]])
@@ -37,12 +96,6 @@ def pretty_print_devices(devices):
 
 
 def get_architectures_from_pid_map(pid_map):
-    pid4_map = config_loader.load_pid_map(pid_map_path=pid_map)
-
-    return {
-        pid["architecture"]
-        for machine in pid4_map.values()
-        if isinstance(machine, dict)
-        for pid in machine.get("pid4", [])
-        if isinstance(pid, dict) and pid.get("architecture")
-    }
+    pid4_map = compile_pid_map(config_loader.load_pid_map(pid_map_path=pid_map))
+
+    return set(pid4_map.architectures)
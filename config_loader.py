@@ -1,16 +1,15 @@
-import toml
-import yaml
-import os
+import pid4_map
+
+# toml is imported where it is used so that importing this module stays cheap
+# for code paths that never load a config file.
 
 
 def load_device_config(device_config_path):
+    import toml
+
     return toml.load(device_config_path)
 
 
 def load_pid_map(pid_map_path=None):
-    if not pid_map_path:
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        pid_map_path = os.path.join(script_dir, "pid_map.yaml")
-
-    with open(pid_map_path, "r") as f:
-        return yaml.safe_load(f)
+    # Returns a `pid4_map.Pid4Map`, which is also the plain parsed dict.
+    return pid4_map.load(pid_map_path)
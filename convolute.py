@@ -2,22 +2,17 @@
 # and most of us are EEs anyway.
 
 import logging_setup
+from pid4_map import compile_pid_map
 
 logger = logging_setup.setup_logging()
 
 
 def get_pid4_list(soc, pid4_map):
-    logger.debug(f"Getting PID4 list for SOC: {soc}")
+    logger.debug("Getting PID4 list for SOC: %s", soc)
 
-    soc_data = pid4_map.get(soc, {})
-    pid4s = soc_data.get("pid4", [])
+    pid4_list = compile_pid_map(pid4_map).pid4s_for_soc(soc)
 
-    logger.debug(f"Found PID4s: {pid4s}")
-    pid4_list = [
-        pid.get("id", pid) if isinstance(pid, dict) else pid for pid in pid4s
-    ]
-
-    logger.debug(f"PID4 list: {pid4_list}")
+    logger.debug("PID4 list: %s", pid4_list)
 
     return pid4_list
 
@@ -25,47 +20,88 @@ def get_pid4_list(soc, pid4_map):
 def get_pid4_list_from_architecture(
     soc_architecture, pid4_map, use_common_devices: bool
 ):
-    logger.debug(f"Getting PID4 list for architecture: {soc_architecture}")
-
-    matching_pid4s = []
-    for soc_name, soc_data in pid4_map.items():
-        for pid4_entry in soc_data.get("pid4", []):
-            if (
-                pid4_entry.get("architecture") == soc_architecture
-                and pid4_entry.get("common_device") == use_common_devices
-            ):
-                matching_pid4s.append(pid4_entry.get("id"))
-
-    logger.debug(f"Matching PID4 list: {matching_pid4s}")
+    logger.debug("Getting PID4 list for architecture: %s", soc_architecture)
+
+    matching_pid4s = compile_pid_map(pid4_map).pid4s_for_architecture(
+        soc_architecture, common_device=bool(use_common_devices)
+    )
+
+    logger.debug("Matching PID4 list: %s", matching_pid4s)
     return matching_pid4s
 
 
+def parse_soc_properties(soc_properties):
+    """Turns the `soc_properties` of a device config into predicates.
+
+    Accepted forms:
+      soc_properties = ["soc_npu", "!soc_dpu"]   # true / false
+      [soc_udt.soc_properties]
+      architecture = "arm64"                     # equal to
+      soc_gpu = { not = true }                   # different from
+      ram_mb = { min = 1024, max = 4096 }        # numeric range, both optional
+    """
+    if isinstance(soc_properties, dict):
+        items = soc_properties.items()
+    else:
+        items = []
+        for prop in soc_properties:
+            if not isinstance(prop, str) or not prop.lstrip("!"):
+                raise ValueError(f"Invalid SoC property {prop!r}")
+            if prop.startswith("!"):
+                items.append((prop[1:], False))
+            else:
+                items.append((prop, True))
+
+    predicates = []
+    for name, spec in items:
+        if not isinstance(spec, dict):
+            predicates.append((name, "equal", spec))
+        elif set(spec) == {"not"}:
+            predicates.append((name, "not_equal", spec["not"]))
+        elif spec and set(spec) <= {"min", "max"}:
+            predicates.append(
+                (name, "in_range", (spec.get("min"), spec.get("max")))
+            )
+        else:
+            raise ValueError(
+                f"Invalid predicate for SoC property {name}: {spec}"
+            )
+
+    return predicates
+
+
 def get_pid4_list_with_device_config(device_config, pid4_map):
     logger.debug("Getting PID4 list with device config")
 
     soc_udt, soc_properties = device_config
 
-    pid4_data = pid4_map.get(soc_udt, {}).get("pid4", [])
+    index = compile_pid_map(pid4_map).property_index
+    predicates = parse_soc_properties(soc_properties)
+
+    logger.debug("SoC property predicates: %s", predicates)
 
-    logger.debug(f"PID4 data: {pid4_data}")
+    # A missing SoC name means any SoC with matching properties will do.
+    mask = index.soc(soc_udt)
+    for name, operator, value in predicates:
+        if operator == "in_range":
+            mask &= index.in_range(name, *value)
+        else:
+            mask &= getattr(index, operator)(name, value)
 
-    pid4_list = []
-    for pid4 in pid4_data:
-        if all(prop in pid4 for prop in soc_properties):
-            pid4_list.append(pid4["id"])
+    pid4_list = index.to_pid4s(mask)
 
-    logger.debug(f"Filtered PID4 list: {pid4_list}")
+    logger.debug("Filtered PID4 list: %s", pid4_list)
 
     return pid4_list
 
 
 def get_device_config_data(device_config):
     logger.debug("Getting device config data")
-    logger.debug(f"Device config: {device_config}")
+    logger.debug("Device config: %s", device_config)
 
-    soc_udt = device_config["soc_udt"]["soc_udt_name"]
+    soc_udt = device_config["soc_udt"].get("soc_udt_name")
     soc_properties = device_config["soc_udt"]["soc_properties"]
 
-    logger.debug(f"SOC UDT: {soc_udt}, SOC Properties: {soc_properties}")
+    logger.debug("SOC UDT: %s, SOC Properties: %s", soc_udt, soc_properties)
 
     return (soc_udt, soc_properties)
@@ -5,21 +5,37 @@ from contextlib import contextmanager
 import threading
 from aws_database.ssm_tunnel import close_ssm_tunnel, ensure_ssm_tunnel
 import logging_setup
+import metrics
 
 logger = logging_setup.setup_logging()
 
 USE_AWS = bool(os.environ.get("AWS_RDS_HOST"))
 
-if USE_AWS:
-    from aws_database.generate_token import generate_token
+_connection_target = None
 
-    logger.info("AWS_RDS_HOST detected → using SSM tunnel + IAM authentication")
-    host = "localhost"  # Use localhost via SSM tunnel
-    port = int(os.environ["LOCAL_PORT"])
-else:
-    logger.info("AWS_RDS_HOST not set → using direct database connection")
-    host = os.environ["POSTGRES_HOST"]
-    port = int(os.environ["POSTGRES_PORT"])
+
+def _get_connection_target():
+    # Resolved on first use rather than at import, so that importing this
+    # module neither requires the database environment nor logs anything.
+    global _connection_target
+
+    if _connection_target is None:
+        if USE_AWS:
+            logger.info(
+                "AWS_RDS_HOST detected → using SSM tunnel + IAM authentication"
+            )
+            # Use localhost via SSM tunnel
+            _connection_target = ("localhost", int(os.environ["LOCAL_PORT"]))
+        else:
+            logger.info(
+                "AWS_RDS_HOST not set → using direct database connection"
+            )
+            _connection_target = (
+                os.environ["POSTGRES_HOST"],
+                int(os.environ["POSTGRES_PORT"]),
+            )
+
+    return _connection_target
 
 
 # Global excepthook: any error not handled in the THREAD will terminate the app
@@ -29,6 +45,7 @@ def _thread_crash_handler(args):
     )
 
     shutdown_database_access()
+    logging_setup.shutdown_logging()
 
     # Kill the process immediately, in that stage the release lock step won't work anyway
     os._exit(1)
@@ -39,7 +56,11 @@ threading.excepthook = _thread_crash_handler
 
 @contextmanager
 def get_db_connection():
+    host, port = _get_connection_target()
+
     if USE_AWS:
+        from aws_database.generate_token import generate_token
+
         ensure_ssm_tunnel()
         password = generate_token()
     else:
@@ -69,8 +90,9 @@ def shutdown_database_access():
         logger.error(f"Failed to close AWS SSM tunnel cleanly: {e}")
 
 
-_heartbeat_thread = None
-_heartbeat_stop_event = None
+# Heartbeat thread and its stop event for every device locked by this process.
+_heartbeats = {}
+_heartbeats_lock = threading.Lock()
 
 
 # Update the timestamp every 2 minutes
@@ -85,7 +107,7 @@ def _heartbeat_worker(device_uuid, stop_event, interval=120):
                 )
                 conn.commit()
 
-        logger.debug(f"Heartbeat updated for {device_uuid}")
+        logger.debug("Heartbeat updated for %s", device_uuid)
 
         # Waits for the interval, but exits sooner if stop_event is set
         stop_event.wait(interval)
@@ -94,8 +116,6 @@ def _heartbeat_worker(device_uuid, stop_event, interval=120):
 
 
 def acquire_lock(device_uuid):
-    global _heartbeat_thread, _heartbeat_stop_event
-
     logger.info(f"Attempting to acquire lock for device {device_uuid}")
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
@@ -114,13 +134,15 @@ def acquire_lock(device_uuid):
                     f"Lock acquired successfully for device {device_uuid}"
                 )
 
-                _heartbeat_stop_event = threading.Event()
-                _heartbeat_thread = threading.Thread(
+                stop_event = threading.Event()
+                heartbeat = threading.Thread(
                     target=_heartbeat_worker,
-                    args=(device_uuid, _heartbeat_stop_event),
+                    args=(device_uuid, stop_event),
                     daemon=True,
                 )
-                _heartbeat_thread.start()
+                with _heartbeats_lock:
+                    _heartbeats[device_uuid] = (heartbeat, stop_event)
+                heartbeat.start()
 
                 return True
             logger.info(
@@ -130,8 +152,6 @@ def acquire_lock(device_uuid):
 
 
 def release_lock(device_uuid):
-    global _heartbeat_thread, _heartbeat_stop_event
-
     logger.info(f"Attempting to release lock for device {device_uuid}")
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
@@ -142,12 +162,13 @@ def release_lock(device_uuid):
             conn.commit()
             logger.info(f"Lock released for device {device_uuid}")
 
-    if _heartbeat_thread and _heartbeat_stop_event:
-        _heartbeat_stop_event.set()
-        _heartbeat_thread.join(timeout=5)
+    with _heartbeats_lock:
+        heartbeat = _heartbeats.pop(device_uuid, None)
+    if heartbeat:
+        heartbeat_thread, stop_event = heartbeat
+        stop_event.set()
+        heartbeat_thread.join(timeout=5)
         logger.info(f"Heartbeat thread stopped for {device_uuid}")
-        _heartbeat_thread = None
-        _heartbeat_stop_event = None
 
 
 def device_exists(device_uuid):
@@ -177,13 +198,22 @@ def create_device(device_uuid):
 
 
 def try_until_locked(device_uuid, max_attempts=80, sleep=90, fail_fast=True):
+    started = time.monotonic()
+
     if fail_fast:
-        return acquire_lock(device_uuid)
+        locked = acquire_lock(device_uuid)
+        metrics.LOCK_WAIT_SECONDS.observe(
+            time.monotonic() - started, result="locked" if locked else "busy"
+        )
+        return locked
 
     attempts = 0
     while attempts < max_attempts:
         if acquire_lock(device_uuid):
             logger.info(f"Device {device_uuid} successfully locked.")
+            metrics.LOCK_WAIT_SECONDS.observe(
+                time.monotonic() - started, result="locked"
+            )
             return True
         else:
             logger.info(
@@ -192,6 +222,99 @@ def try_until_locked(device_uuid, max_attempts=80, sleep=90, fail_fast=True):
             time.sleep(sleep)
             attempts += 1
 
+    metrics.LOCK_WAIT_SECONDS.observe(
+        time.monotonic() - started, result="timeout"
+    )
     raise Exception(
         f"Wasn't able to lock the device {device_uuid} after {max_attempts} attempts. :("
     )
+
+
+# Consecutive connection failures after which a device is skipped, for a
+# cooldown that doubles with every further failure.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("AVAL_CIRCUIT_FAILURES", "2"))
+CIRCUIT_COOLDOWN_SECONDS = int(os.getenv("AVAL_CIRCUIT_COOLDOWN", "1800"))
+CIRCUIT_MAX_COOLDOWN_SECONDS = 24 * 60 * 60
+
+
+def circuit_cooldown(consecutive_failures):
+    """Seconds a device is skipped for after `consecutive_failures`."""
+    if consecutive_failures < CIRCUIT_FAILURE_THRESHOLD:
+        return 0
+    exponent = consecutive_failures - CIRCUIT_FAILURE_THRESHOLD
+    return min(
+        CIRCUIT_COOLDOWN_SECONDS * 2**exponent, CIRCUIT_MAX_COOLDOWN_SECONDS
+    )
+
+
+def record_connection_failure(device_uuid, failure):
+    """Counts a failed connection, opening the circuit of flaky devices."""
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE devices SET consecutive_failures = consecutive_failures + 1, "
+                    "last_failure = %s WHERE device_uuid = %s "
+                    "RETURNING consecutive_failures",
+                    (failure, device_uuid),
+                )
+                row = cursor.fetchone()
+                failures = row[0] if row else 0
+                cooldown = circuit_cooldown(failures)
+                if cooldown:
+                    cursor.execute(
+                        "UPDATE devices SET circuit_open_until = NOW() + make_interval(secs => %s) "
+                        "WHERE device_uuid = %s",
+                        (cooldown, device_uuid),
+                    )
+                conn.commit()
+    except Exception as e:
+        logger.error(
+            f"Failed to record the connection failure of {device_uuid}: {e}"
+        )
+        return
+
+    if cooldown:
+        logger.error(
+            f"Device {device_uuid} failed to connect {failures} times in a row, skipping it for {cooldown}s"
+        )
+    else:
+        logger.info(
+            f"Device {device_uuid} failed to connect {failures} times in a row"
+        )
+
+
+def record_connection_success(device_uuid):
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE devices SET consecutive_failures = 0, circuit_open_until = NULL "
+                    "WHERE device_uuid = %s AND consecutive_failures > 0",
+                    (device_uuid,),
+                )
+                conn.commit()
+    except Exception as e:
+        logger.error(
+            f"Failed to record the connection success of {device_uuid}: {e}"
+        )
+
+
+def open_circuits(device_uuids):
+    """The devices of `device_uuids` that are skipped for now."""
+    if not device_uuids:
+        return set()
+
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT device_uuid FROM devices "
+                    "WHERE device_uuid = ANY(%s::uuid[]) AND circuit_open_until > NOW()",
+                    (list(device_uuids),),
+                )
+                return {str(row[0]) for row in cursor.fetchall()}
+    except Exception as e:
+        # Only an optimization, never fail a run because of it.
+        logger.error(f"Failed to look up the devices to skip: {e}")
+        return set()
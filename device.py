@@ -1,16 +1,20 @@
 import dateutil
-import json
+import os
 import requests
+import socket
 import time
 from fabric import Connection, Config
 
 from cloud import CloudAPI
-from http_wrapper import endpoint_call
 from requests.exceptions import HTTPError
+import common
+import inventory
 import logging_setup
+import metrics
+import timeline
+import update_progress
 
-API_BASE_URL = "https://app.torizon.io/api/v2"
-RAC_IP = "ras.torizon.io"
+RAC_IP = os.environ.get("TORIZON_RAS_HOST", "ras.torizon.io")
 logger = logging_setup.setup_logging()
 
 
@@ -18,7 +22,9 @@ class Device:
     def __init__(self, cloud_api: CloudAPI, uuid, hardware_id, env_vars):
         self._log = logger
 
-        self._log.debug(f"Initializing Device object {hardware_id} for {uuid}")
+        self._log.debug(
+            "Initializing Device object %s for %s", hardware_id, uuid
+        )
 
         self._cloud_api = cloud_api
         self._hardware_id = hardware_id
@@ -37,6 +43,15 @@ class Device:
         self.remote_connection = None
         self.connection = None
 
+    @property
+    def current_build(self):
+        return self._current_build
+
+    @property
+    def latest_build(self):
+        return self._latest_build
+
+    @timeline.span("ssh_setup")
     def create_ssh_connnection(self):
         if self._env_vars["USE_RAC"]:
             self.setup_rac_session(RAC_IP)
@@ -64,7 +79,9 @@ class Device:
         )
 
         if self.test_connection():
-            self._log.debug(f"Connection test succeeded for device {self.uuid}")
+            self._log.debug(
+                "Connection test succeeded for device %s", self.uuid
+            )
         else:
             self._log.error(f"Connection test failed for device {self.uuid}")
             raise ConnectionError(
@@ -75,6 +92,7 @@ class Device:
         self.remote_session_ip = self.network_info["localIpV4"]
         self.remote_session_port = "22"
 
+    @timeline.span("ras_setup")
     def setup_rac_session(self, RAC_IP):
         try:
             self._log.info("Attempting to setup a ssh session over RAS...")
@@ -95,28 +113,16 @@ class Device:
                 f"Using ssh over RAS session on port {self.remote_session_port}"
             )
         except Exception as e:
-            self._log.error(f"{e}")
+            # A Cloud error here (say a 400 for a host that isn't allowed to
+            # use RAS) says nothing about the device, so it isn't turned into
+            # a ConnectionError and doesn't count against the device's health.
+            self._log.error(f"Failed to set up a RAS session: {e}")
+            raise
 
     def _create_remote_session(self):
         self._log.info(f"Creating a new remote session for device {self.uuid}")
         try:
-            endpoint_call(
-                url=API_BASE_URL
-                + f"/remote-access/device/{self.uuid}/sessions",
-                request_type="post",
-                body=None,
-                headers={
-                    "Authorization": f"Bearer {self._cloud_api.token}",
-                    "accept": "*/*",
-                    "Content-Type": "application/json",
-                },
-                json_data={
-                    "publicKeys": [
-                        f"{self._public_key}\n",
-                    ],
-                    "sessionDuration": "43200s",
-                },
-            )
+            self._cloud_api.create_remote_session(self.uuid, self._public_key)
 
         except HTTPError as e:
             if e.response is not None and e.response.status_code == 409:
@@ -137,17 +143,7 @@ class Device:
         )
 
         try:
-            res = endpoint_call(
-                url=API_BASE_URL
-                + f"/remote-access/device/{self.uuid}/sessions",
-                request_type="get",
-                headers={
-                    "Authorization": f"Bearer {self._cloud_api.token}",
-                    "accept": "application/json",
-                },
-            )
-
-            response_data = res.json()
+            response_data = self._cloud_api.get_remote_session(self.uuid)
             reverse_port = response_data.get("ssh", {}).get("reversePort")
 
             if not reverse_port:
@@ -180,16 +176,7 @@ class Device:
             f"Attempting to delete a remote sessions for {self.uuid}"
         )
         try:
-            _ = endpoint_call(
-                url=API_BASE_URL
-                + f"/remote-access/device/{self.uuid}/sessions",
-                request_type="delete",
-                body=None,
-                headers={
-                    "Authorization": f"Bearer {self._cloud_api.token}",
-                    "accept": "*/*",
-                },
-            )
+            self._cloud_api.delete_remote_session(self.uuid)
 
         except requests.RequestException as e:
             self._log.error(
@@ -203,22 +190,23 @@ class Device:
         delay_seconds = 30
 
         # FIXME: It was noticed that API-V2 sometimes return empty installedPackges for device packages.
-        # So this retry was introduced as a workaround (OTA-2980).
+        # So this retry was introduced as a workaround (OTA-2980). Request
+        # failures are already retried by endpoint_call.
         for attempt in range(1, max_attempts + 1):
             try:
                 metadata = self._cloud_api.get_package_metadata_for_device(
                     self.uuid
                 )
-                for device in metadata:
-                    for pkg in device["installedPackages"]:
-                        self._log.debug(pkg)
-                        self._log.debug(self._hardware_id)
-                        if pkg["component"] == self._hardware_id:
-                            current_build = pkg["installed"]["packageId"]
-                            self._log.info(
-                                f"Current build for {self._hardware_id} is: {current_build}"
-                            )
-                            return current_build
+                current_build = common.find_installed_package(
+                    metadata, self._hardware_id
+                )
+                if current_build:
+                    self._log.info(
+                        f"Current build for {self._hardware_id} is: {current_build}"
+                    )
+                    return current_build
+            except requests.exceptions.RequestException:
+                raise
             except Exception as e:
                 self._log.info(
                     f"Couldn't parse the current build for {self.uuid} at {attempt} attempt, failed with error: {e}"
@@ -232,38 +220,16 @@ class Device:
             f"Couldn't parse the current build for {self.uuid} after {max_attempts} attempts"
         )
 
+    @timeline.span("update_launch")
     def launch_update(self, build):
-        headers = {
-            "accept": "application/json",
-            "Authorization": f"Bearer {self._cloud_api.token}",
-            "Content-Type": "application/json",
-        }
-        data = {
-            "packageIds": [build],
-            "devices": [self.uuid],
-        }
-
-        res = endpoint_call(
-            url=API_BASE_URL + "/updates",
-            request_type="post",
-            body=None,
-            headers=headers,
-            json_data=data,
-        )
-
-        # FIXME: currently a bug on the Cloud side. Returns 201 when succesfull.
-        if res.status_code == 200 or res.status_code == 201:
-            self._log.info("Updating succesfully issued.")
-        else:
-            self._log.error(
-                f"Update launch request failed with status code: {res.status_code}"
-            )
-            self._log.info(json.dumps(res.json(), indent=2))
-
-        res.raise_for_status()
+        self._cloud_api.launch_update(build, [self.uuid])
 
+    @timeline.span("update_check")
     def is_os_updated_to_latest(self, release_type):
         current_build = self.get_current_build()
+        self._current_build = current_build
+        if current_build is not None and inventory.enabled():
+            inventory.record_current_build(self.uuid, current_build)
 
         self._latest_build = self._cloud_api.get_latest_build(
             release_type=release_type, hardware_id=self._hardware_id
@@ -311,6 +277,7 @@ class Device:
             "UpdateCheckComplete was not found in journalctl logs within timeout"
         )
 
+    @timeline.span("remove_databases")
     def remove_databases(self):
         # This is a temporary workaround for the aktualizr bug
         self._log.info("Attempting to remove local databases")
@@ -319,101 +286,125 @@ class Device:
         )
         self.wait_for_update_check()
 
+    @timeline.span("update")
     def update_to_latest(
         self,
         target_build_type,
         ignore_different_secondaries_between_updates=False,
         remove_databases=False,
+        launched=False,
     ):
-        if remove_databases:
-            self.remove_databases()
+        """Updates the device to the latest build, returns whether it got there.
 
-        self._log.info(
-            f"Launching update to {self._latest_build} with {target_build_type}"
-        )
-        self.launch_update(self._latest_build)
+        With `launched`, the update was launched already, along with those of
+        other devices, and is only waited for.
+        """
+        if not launched:
+            if remove_databases:
+                self.remove_databases()
+
+            self._log.info(
+                f"Launching update to {self._latest_build} with {target_build_type}"
+            )
+            self.launch_update(self._latest_build)
         self._log.info("Waiting until update is complete...")
 
-        inflight = self._cloud_api.extract_in_flight(
-            self._cloud_api.get_assigment_status_for_device(self.uuid)
+        progress = update_progress.UpdateProgress(
+            self._cloud_api,
+            self.uuid,
+            self._hardware_id,
+            self._latest_build,
+            watch_install=ignore_different_secondaries_between_updates,
+        )
+        state = progress.run(
+            on_installing=(
+                self._remove_fuse
+                if ignore_different_secondaries_between_updates
+                else None
+            )
         )
 
-        while inflight is not True:
-            inflight = self._cloud_api.extract_in_flight(
-                self._cloud_api.get_assigment_status_for_device(self.uuid)
+        if progress.current_build is not None:
+            self._current_build = progress.current_build
+            if inventory.enabled():
+                inventory.record_current_build(
+                    self.uuid, progress.current_build
+                )
+        return state == update_progress.VERIFIED
+
+    @timeline.span("fuse_removal")
+    def _remove_fuse(self):
+        try:
+            # The following update path: (image that has secondary) -> (image that does not have that secondary) -> (image that again has secondary)
+            # breaks due to an artificial limitation imposed by the platform to prevent security issues. Thus we must always make sure to remove
+            # secondaries that are not in the intersection between the images. In the current case, this is only the `fuses` secondary.
+            self.connection.run(
+                f"echo {self._password} | sudo -S sh -c 'systemctl stop aktualizr-torizon && rm -rf /var/sota/storage/fuse || true && systemctl start aktualizr-torizon'"
             )
-            time.sleep(15)
+            self._log.info("Fuse secondary was removed.")
+            return True
+        except Exception as e:
+            self._log.info(
+                f"Failed to remove fuse: {e}. Probably the module is rebooting"
+            )
+            return False
 
-        self._log.info(
-            "The device has seen the update request and will download and install it now"
-        )
+    def _get_network_info(self):
+        network_info = self._cloud_api.get_network_info(self.uuid)
+        self._log.info(f"Obtained network info for {self.uuid}")
+        return network_info
+
+    def wait_until_reachable(self, deadline=300, max_backoff=30):
+        """Waits until the device takes SSH connections, e.g. after a reboot.
 
-        if ignore_different_secondaries_between_updates:
-            max_attempts = 80
-            attempts = 0
+        Probes the SSH port, then does a full SSH handshake, backing off
+        between attempts. Returns whether it did within `deadline` seconds.
+        """
+        started = time.monotonic()
+        backoff = 1
 
-            while attempts < max_attempts:
+        while True:
+            try:
+                socket.create_connection(
+                    (self.remote_session_ip, int(self.remote_session_port)),
+                    timeout=5,
+                ).close()
+                # The transport from before the reboot is dead, start over.
+                self.connection.close()
+                self.connection.open()
+                metrics.SSH_CONNECT_ATTEMPTS.inc(result="ok")
                 self._log.info(
-                    "Waiting for the update to finish to remove fuse"
+                    f"Device {self.uuid} is reachable after {time.monotonic() - started:.0f}s"
                 )
+                return True
+            except Exception as e:
+                metrics.SSH_CONNECT_ATTEMPTS.inc(result="error")
+                self._log.debug("Device %s not reachable yet: %s", self.uuid, e)
 
-                if self.is_os_updated_to_latest(
-                    self._env_vars["TARGET_BUILD_TYPE"]
-                ):
-                    try:
-                        # The following update path: (image that has secondary) -> (image that does not have that secondary) -> (image that again has secondary)
-                        # breaks due to an artificial limitation imposed by the platform to prevent security issues. Thus we must always make sure to remove
-                        # secondaries that are not in the intersection between the images. In the current case, this is only the `fuses` secondary.
-                        self.connection.run(
-                            f"echo {self._password} | sudo -S sh -c 'systemctl stop aktualizr-torizon && rm -rf /var/sota/storage/fuse || true && systemctl start aktualizr-torizon'"
-                        )
-                        self._log.info("Fuse secondary was removed.")
-                        break
-                    except Exception as e:
-                        self._log.info(
-                            f"Failed to remove fuse at {attempts} attempt: {e}. Probably the module is rebooting"
-                        )
-                time.sleep(30)
-                attempts += 1
-
-            if attempts >= max_attempts:
-                raise Exception(
-                    f"Failed to remove fuse after {max_attempts} attempts."
+            remaining = deadline - (time.monotonic() - started)
+            if remaining <= 0:
+                self._log.error(
+                    f"Device {self.uuid} wasn't reachable within {deadline}s"
                 )
-
-        while self._cloud_api.get_assigment_status_for_device(self.uuid) != []:
-            self._log.info("Still updating...")
-            time.sleep(60)
-
-    def _get_network_info(self):
-        res = endpoint_call(
-            url=API_BASE_URL + f"/devices/network/{self.uuid}",
-            request_type="get",
-            body=None,
-            headers={
-                "Authorization": f"Bearer {self._cloud_api.token}",
-                "accept": "application/json",
-            },
-            json_data=None,
-        )
-        if res is None:
-            raise Exception("Failed to get network info")
-
-        self._log.info(f"Obtained network info for {self.uuid}")
-        return res.json()
+                return False
+            time.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, max_backoff)
 
     def test_connection(self, sleep_time=10):
         for tries in range(5):
             try:
                 res = self.connection.run("true", warn=True, hide=True)
                 if res.exited == 0:
+                    metrics.SSH_CONNECT_ATTEMPTS.inc(result="ok")
                     self._log.info("Remote connection test OK")
                     return True
                 else:
+                    metrics.SSH_CONNECT_ATTEMPTS.inc(result="failed")
                     self._log.error(
                         f"Testing remote connection failed on try {tries}. Retrying"
                     )
             except Exception as e:
+                metrics.SSH_CONNECT_ATTEMPTS.inc(result="error")
                 self._log.error(
                     f"Exception occurred while testing remote connection on try {tries}: {str(e)}"
                 )
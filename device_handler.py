@@ -1,4 +1,7 @@
 import sys
+import collections
+import concurrent.futures
+import contextvars
 import json
 import subprocess
 import time
@@ -7,18 +10,93 @@ import re
 
 import database
 import common
+import inventory
 import logging_setup
+import metrics
+import run_history
+import timeline
 from device import Device
 
-RAC_IP = "ras.torizon.io"
 logger = logging_setup.setup_logging()
 
+# How long a device may take to come back after a failed update.
+REBOOT_DEADLINE_SECONDS = 300
+
+
+def update_device(dut, hardware_id, env_vars, args, launched_at=None):
+    """Updates `dut` to the latest build, returns whether it got there.
+
+    With `launched_at`, the time.monotonic() launch_updates() launched the
+    update at, it is only waited for.
+    """
+    update_started = time.monotonic() if launched_at is None else launched_at
+    updated = dut.update_to_latest(
+        env_vars["TARGET_BUILD_TYPE"],
+        args.ignore_different_secondaries_between_updates,
+        args.remove_databases,
+        launched=launched_at is not None,
+    )
+    update_seconds = time.monotonic() - update_started
+
+    metrics.UPDATE_DURATION_SECONDS.observe(
+        update_seconds,
+        hardware_id=hardware_id,
+        result="success" if updated else "failed",
+    )
+    run_history.record_device(
+        dut.uuid,
+        update_outcome="success" if updated else "failed",
+        update_seconds=update_seconds,
+    )
+    return updated
+
+
+def launch_updates(cloud, duts):
+    """Launches the updates of `duts` to their latest build.
+
+    One request per build, so the devices start downloading at the same time.
+    Returns the error for each device whose update couldn't be launched.
+    """
+    by_build = collections.defaultdict(list)
+    for dut in duts:
+        by_build[dut.latest_build].append(dut.uuid)
+
+    failures = {}
+    for build, uuids in by_build.items():
+        try:
+            with timeline.span(
+                "update_launch", build=build, devices=len(uuids)
+            ):
+                cloud.launch_update(build, uuids)
+        except Exception as e:
+            logger.error(f"Couldn't launch the update to {build}: {e}")
+            failures.update((uuid, e) for uuid in uuids)
+    return failures
+
 
 def process_devices(devices, cloud, env_vars, args):
+    hardware_ids = common.parse_hardware_ids(devices)
+    devices = [d for d in devices if hardware_ids.get(d["deviceUuid"])]
+
+    open_circuits = database.open_circuits(
+        [device["deviceUuid"] for device in devices]
+    )
+    healthy = [d for d in devices if d["deviceUuid"] not in open_circuits]
+    if open_circuits:
+        logger.info(
+            f"Skipping {len(open_circuits)} devices that failed to connect recently: {', '.join(sorted(open_circuits))}"
+        )
+        metrics.DEVICES_SKIPPED.inc(len(open_circuits), reason="circuit_open")
+    if healthy:
+        devices = healthy
+    elif devices:
+        # Better a device that may have been fixed since than no device.
+        logger.info("No healthy device left, trying the skipped ones anyway")
+
     for index, device in enumerate(devices):
         uuid = device["deviceUuid"]
-        hardware_id = common.parse_hardware_id(device["deviceId"])
-        logger.debug(f"hardware_id: {hardware_id}")
+        hardware_id = hardware_ids[uuid]
+        logger.debug("hardware_id: %s", hardware_id)
 
         if not database.device_exists(uuid):
             database.create_device(uuid)
@@ -27,85 +105,122 @@ def process_devices(devices, cloud, env_vars, args):
         is_last_device = index == len(devices) - 1
         if is_last_device:
             logger.debug(
-                f"Wasn't able to lock any of the n - 1 devices, trying again but busy-waiting device number n ({uuid}) until this time."
+                "Wasn't able to lock any of the n - 1 devices, trying again but busy-waiting device number n (%s) until this time.",
+                uuid,
             )
 
         # Use fail_fast=False for the last device
-        if database.try_until_locked(uuid, fail_fast=not is_last_device):
+        with timeline.span("lock_wait", device=uuid) as lock_wait:
+            locked = database.try_until_locked(
+                uuid, fail_fast=not is_last_device
+            )
+            lock_wait.set_attribute("locked", locked)
+
+        if locked:
             logger.info(f"Lock acquired for device {uuid}")
+            run_history.record_lock(uuid, hardware_id)
             try:
-                dut = Device(cloud, uuid, hardware_id, env_vars)
-                dut.create_ssh_connnection()
+                try:
+                    with timeline.span("device_setup", device=uuid):
+                        dut = Device(cloud, uuid, hardware_id, env_vars)
+                        dut.create_ssh_connnection()
+                except ConnectionError as e:
+                    logger.error(
+                        f"Can't connect to device {uuid}, moving on to the next one: {e}"
+                    )
+                    run_history.record_device(uuid, failure=str(e))
+                    database.record_connection_failure(uuid, str(e))
+                    metrics.DEVICES_SKIPPED.inc(reason="unreachable")
+                    # The lock is released on the way out.
+                    continue
+                database.record_connection_success(uuid)
 
-                if not args.do_not_update:
-                    if not dut.is_os_updated_to_latest(
+                if args.do_not_update:
+                    run_history.record_device(uuid, update_outcome="skipped")
+                else:
+                    updated = dut.is_os_updated_to_latest(
                         env_vars["TARGET_BUILD_TYPE"]
-                    ):
-                        dut.update_to_latest(
-                            env_vars["TARGET_BUILD_TYPE"],
-                            args.ignore_different_secondaries_between_updates,
-                            args.remove_databases,
+                    )
+                    run_history.record_device(
+                        uuid,
+                        current_build=dut.current_build,
+                        target_build=dut.latest_build,
+                        update_outcome="not_needed" if updated else None,
+                    )
+                    if not updated:
+                        updated = update_device(
+                            dut, hardware_id, env_vars, args
                         )
-                        if not dut.is_os_updated_to_latest(
-                            env_vars["TARGET_BUILD_TYPE"]
-                        ):
+                        if not updated:
                             logger.error(
                                 f"Update unsuccessful for {uuid}: trying to get Aktualizr logs and raising an exception. This might take some time."
                             )
                             logger.info(
-                                f"Trying an early SSH connection to {dut.remote_session_ip}:{dut.remote_session_port}. If the device didn't roll back successfully this might not work."
+                                f"Waiting for SSH on {dut.remote_session_ip}:{dut.remote_session_port}. If the device didn't roll back successfully this might not work."
                             )
 
                             # Wait for the device to come back up
-                            time.sleep(300)
-
-                            try:
-                                dut.connection.run(
-                                    "journalctl -u aktualizr-torizon --no-pager"
+                            with timeline.span("reboot_wait"):
+                                reachable = dut.wait_until_reachable(
+                                    deadline=REBOOT_DEADLINE_SECONDS
                                 )
-                            except ConnectionError as e:
+
+                            if reachable:
+                                try:
+                                    dut.connection.run(
+                                        "journalctl -u aktualizr-torizon --no-pager"
+                                    )
+                                except ConnectionError as e:
+                                    logger.error(
+                                        f"Failed to connect to device {uuid} for log retrieval: {str(e)}"
+                                    )
+                            else:
                                 logger.error(
-                                    f"Failed to connect to device {uuid} for log retrieval: {str(e)}"
+                                    f"Device {uuid} didn't come back, can't get its Aktualizr logs"
                                 )
 
                             raise Exception(f"Update unsuccessful for {uuid}.")
 
-                logger.debug(dut.network_info)
+                logger.debug("Network info: %s", dut.network_info)
 
                 if dut.network_info:
                     with open("device_information.json", "w") as f:
                         json.dump(dut.network_info, f, ensure_ascii=False)
 
                 if args.run_before_on_host:
-                    logger.debug(f"Executing {args.run_before_on_host} on host")
+                    logger.debug(
+                        "Executing %s on host", args.run_before_on_host
+                    )
 
-                    if os.name == "nt":
-                        subprocess.check_call(
-                            [
-                                "powershell",
-                                "-Command",
+                    with timeline.span("host_hook"):
+                        if os.name == "nt":
+                            subprocess.check_call(
+                                [
+                                    "powershell",
+                                    "-Command",
+                                    args.run_before_on_host,
+                                ],
+                                stdout=sys.stdout,
+                                stderr=subprocess.STDOUT,
+                            )
+                        elif os.name == "posix":
+                            subprocess.check_call(
                                 args.run_before_on_host,
-                            ],
-                            stdout=sys.stdout,
-                            stderr=subprocess.STDOUT,
-                        )
-                    elif os.name == "posix":
-                        subprocess.check_call(
-                            args.run_before_on_host,
-                            shell=True,
-                            stdout=sys.stdout,
-                            stderr=subprocess.STDOUT,
-                        )
-                    else:
-                        logger.error(f"Unsupported {os.name} OS")
-                        raise Exception(f"Unsupported {os.name} OS")
+                                shell=True,
+                                stdout=sys.stdout,
+                                stderr=subprocess.STDOUT,
+                            )
+                        else:
+                            logger.error(f"Unsupported {os.name} OS")
+                            raise Exception(f"Unsupported {os.name} OS")
 
                 if args.hacking_session:
                     logger.info(
                         f"Opening interactive SSH terminal for device {uuid}"
                     )
                     try:
-                        dut.connection.shell()
+                        with timeline.span("interactive_session"):
+                            dut.connection.shell()
                         logger.info(
                             f"Interactive session finished for device {uuid}"
                         )
@@ -124,10 +239,12 @@ def process_devices(devices, cloud, env_vars, args):
                             )
 
                 if args.before:
-                    dut.connection.run(args.before)
+                    with timeline.span("before_command"):
+                        dut.connection.run(args.before)
 
                 if args.command:
-                    dut.connection.run(args.command)
+                    with timeline.span("command"):
+                        dut.connection.run(args.command)
                     logger.info(
                         f"Command '{args.command}' executed for device {uuid} via connection at {dut.remote_session_ip}/{dut.remote_session_port}"
                     )
@@ -139,18 +256,263 @@ def process_devices(devices, cloud, env_vars, args):
                         logger.info(
                             f"Copying artifact from {remote_path} to {local_output}"
                         )
-                        dut.connection.get(remote_path, local_output)
+                        with timeline.span(
+                            "artifact_copy", remote_path=remote_path
+                        ):
+                            dut.connection.get(remote_path, local_output)
                         logger.info(f"Artifact retrieved for device {uuid}")
 
+                        if os.path.isdir(local_output):
+                            local_output = os.path.join(
+                                local_output, os.path.basename(remote_path)
+                            )
+                        if os.path.isfile(local_output):
+                            metrics.ARTIFACT_BYTES.inc(
+                                os.path.getsize(local_output)
+                            )
+
             except Exception as e:
                 logger.error(
                     f"An error occurred while processing device {uuid}: {e}"
                 )
+                run_history.record_device(uuid, failure=str(e))
                 sys.exit(1)
             finally:
                 database.release_lock(uuid)
+                run_history.record_release(uuid)
                 logger.info(f"Lock released for device {uuid}")
 
             return True
 
     return False
+
+
+def _run_each(executor, function, items, uuid):
+    """Runs `function` on every item in `executor`.
+
+    Returns what each call returned or raised, by the `uuid` of its item.
+    """
+    futures = {
+        executor.submit(
+            # Keeps the device spans nested under the current one.
+            contextvars.copy_context().run,
+            function,
+            item,
+        ): uuid(item)
+        for item in items
+    }
+    results = {}
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            results[futures[future]] = future.result()
+        except Exception as e:
+            results[futures[future]] = e
+    return results
+
+
+def _release(uuid):
+    database.release_lock(uuid)
+    run_history.record_release(uuid)
+    logger.info(f"Lock released for device {uuid}")
+
+
+def _check_for_warming(devices, hardware_ids, cloud, env_vars):
+    """Sorts out the `devices` that aren't on the latest build.
+
+    Returns the outcome of the others by uuid, not_needed or failed, and a
+    Device for each outdated one. Takes one lookup per hardware id for the
+    latest builds and batched ones for the current builds. Devices whose
+    build can't be found are checked again once locked.
+    """
+    with timeline.span("warm_check"):
+        for device in devices:
+            if not database.device_exists(device["deviceUuid"]):
+                database.create_device(device["deviceUuid"])
+
+        latest_builds = {}
+        for hardware_id in set(hardware_ids.values()):
+            try:
+                latest_builds[hardware_id] = cloud.get_latest_build(
+                    release_type=env_vars["TARGET_BUILD_TYPE"],
+                    hardware_id=hardware_id,
+                )
+            except Exception as e:
+                logger.error(
+                    f"Couldn't resolve the latest build for {hardware_id}: {e}"
+                )
+
+        try:
+            current_builds = cloud.get_current_builds(hardware_ids)
+        except Exception as e:
+            logger.error(f"Couldn't resolve the current builds: {e}")
+            current_builds = {}
+        if inventory.enabled():
+            inventory.record_current_builds(current_builds)
+
+        outcomes = {}
+        outdated = []
+        for device in devices:
+            uuid = device["deviceUuid"]
+            hardware_id = hardware_ids[uuid]
+            if hardware_id not in latest_builds:
+                outcomes[uuid] = "failed"
+            elif current_builds.get(uuid) == latest_builds[hardware_id]:
+                logger.info(
+                    f"Device {uuid} is already on latest build {current_builds[uuid]}"
+                )
+                outcomes[uuid] = "not_needed"
+            else:
+                try:
+                    outdated.append(Device(cloud, uuid, hardware_id, env_vars))
+                except Exception as e:
+                    logger.error(f"Failed to warm device {uuid}: {e}")
+                    outcomes[uuid] = "failed"
+        return outcomes, outdated
+
+
+def _lock_for_warming(dut, hardware_id, env_vars, args):
+    """Locks `dut` and readies it for its update.
+
+    Returns None once it is ready, with the lock held, else its outcome.
+    """
+    uuid = dut.uuid
+
+    with timeline.span("warm_lock", device=uuid):
+        with timeline.span("lock_wait", device=uuid) as lock_wait:
+            locked = database.try_until_locked(uuid, fail_fast=True)
+            lock_wait.set_attribute("locked", locked)
+        if not locked:
+            logger.info(f"Device {uuid} is in use, not warming it")
+            return "busy"
+
+        run_history.record_lock(uuid, hardware_id)
+        try:
+            # It might have been updated while we weren't holding the lock.
+            updated = dut.is_os_updated_to_latest(env_vars["TARGET_BUILD_TYPE"])
+            run_history.record_device(
+                uuid,
+                current_build=dut.current_build,
+                target_build=dut.latest_build,
+                update_outcome="not_needed" if updated else None,
+            )
+            if not updated:
+                if (
+                    args.remove_databases
+                    or args.ignore_different_secondaries_between_updates
+                ):
+                    with timeline.span("device_setup", device=uuid):
+                        dut.create_ssh_connnection()
+                if args.remove_databases:
+                    dut.remove_databases()
+                return None
+            outcome = "not_needed"
+        except Exception as e:
+            logger.error(f"Failed to warm device {uuid}: {e}")
+            run_history.record_device(uuid, failure=str(e))
+            outcome = "failed"
+
+        _release(uuid)
+        return outcome
+
+
+def _wait_for_warming(dut, hardware_id, env_vars, args, launched_at):
+    uuid = dut.uuid
+
+    with timeline.span("warm_update", device=uuid):
+        try:
+            if update_device(
+                dut, hardware_id, env_vars, args, launched_at=launched_at
+            ):
+                return "success"
+            return "failed"
+        except Exception as e:
+            logger.error(f"Failed to warm device {uuid}: {e}")
+            run_history.record_device(uuid, failure=str(e))
+            return "failed"
+        finally:
+            _release(uuid)
+
+
+def _outcome(uuid, result):
+    if isinstance(result, Exception):
+        logger.error(f"Failed to warm device {uuid}: {result}")
+        return "failed"
+    return result
+
+
+def _warm_wave(executor, duts, hardware_ids, cloud, env_vars, args):
+    outcomes = {}
+
+    locking = _run_each(
+        executor,
+        lambda dut: _lock_for_warming(
+            dut, hardware_ids[dut.uuid], env_vars, args
+        ),
+        duts,
+        lambda dut: dut.uuid,
+    )
+    ready = []
+    for dut in duts:
+        if locking[dut.uuid] is None:
+            ready.append(dut)
+        else:
+            outcomes[dut.uuid] = _outcome(dut.uuid, locking[dut.uuid])
+
+    launched_at = time.monotonic()
+    failures = launch_updates(cloud, ready)
+    for uuid, e in failures.items():
+        run_history.record_device(uuid, failure=str(e))
+        _release(uuid)
+        outcomes[uuid] = "failed"
+
+    waiting = _run_each(
+        executor,
+        lambda dut: _wait_for_warming(
+            dut, hardware_ids[dut.uuid], env_vars, args, launched_at
+        ),
+        [dut for dut in ready if dut.uuid not in failures],
+        lambda dut: dut.uuid,
+    )
+    for uuid, result in waiting.items():
+        outcomes[uuid] = _outcome(uuid, result)
+    return outcomes
+
+
+def warm_devices(devices, cloud, env_vars, args):
+    """Updates the idle `devices` to the latest build, a few at a time.
+
+    Devices locked by running jobs are skipped, never waited for. Outdated
+    devices are updated in waves of --warm-concurrency: the updates of a wave
+    are launched together, then each device is followed on its own. Returns
+    the outcome for each device: success, failed, busy or not_needed.
+    """
+    hardware_ids = common.parse_hardware_ids(devices)
+    devices = [d for d in devices if hardware_ids.get(d["deviceUuid"])]
+
+    # Cheap checks first, so up to date devices are never locked.
+    outcomes, outdated = _check_for_warming(
+        devices, hardware_ids, cloud, env_vars
+    )
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=args.warm_concurrency, thread_name_prefix="warm"
+    ) as executor:
+        for start in range(0, len(outdated), args.warm_concurrency):
+            end = start + args.warm_concurrency
+            outcomes.update(
+                _warm_wave(
+                    executor,
+                    outdated[start:end],
+                    hardware_ids,
+                    cloud,
+                    env_vars,
+                    args,
+                )
+            )
+
+    for uuid, outcome in outcomes.items():
+        logger.info(f"Device {uuid}: {outcome}")
+    for outcome in ("success", "not_needed", "busy", "failed"):
+        logger.info(
+            f"{outcome}: {sum(1 for o in outcomes.values() if o == outcome)}"
+        )
+    return outcomes
@@ -2,12 +2,17 @@ import sys
 import convolute
 import common
 import config_loader
-import re
-from common import get_architectures_from_pid_map
+from common import PID4_PATTERN, get_architectures_from_pid_map
+import inventory
 import logging_setup
+import run_history
 
 logger = logging_setup.setup_logging()
 
+# Builds the inventory saw longer ago than this are looked up again, devices
+# may have been updated by someone else in the meantime.
+INVENTORY_BUILD_MAX_AGE_SECONDS = 15 * 60
+
 
 def find_possible_devices(cloud, args, env_vars):
     test_whole_fleet = env_vars["TEST_WHOLE_FLEET"]
@@ -50,31 +55,126 @@ def find_possible_devices(cloud, args, env_vars):
             else:
                 pid4_targets = convolute.get_pid4_list(soc_udt, pid4_map)
 
-        for device in cloud.provisioned_devices:
-            pid4 = device.get("notes")
+        # Set membership keeps matching linear in the size of the fleet.
+        pid4_targets = set(pid4_targets)
 
-            if not pid4:
-                logger.error(
-                    f"The following device has no PID4 set in the `notes` field: {device}"
-                )
-                continue
+        if inventory.enabled():
+            # The inventory has validated and indexed the PID4s already.
+            if inventory.is_fresh():
+                logger.info("Inventory synced recently, not listing the fleet")
+            else:
+                inventory.sync(cloud.provisioned_devices)
+            possible_duts = inventory.find(pid4s=pid4_targets)
+        else:
+            for device in cloud.provisioned_devices:
+                pid4 = device.get("notes")
 
-            if not re.fullmatch(r"\d{4}", pid4):
-                logger.error(
-                    f"The following device has an invalid PID4 '{pid4}' in the `notes` field: {device}"
-                )
-                continue
+                if not pid4:
+                    logger.error(
+                        f"The following device has no PID4 set in the `notes` field: {device}"
+                    )
+                    continue
+
+                if not PID4_PATTERN.fullmatch(pid4):
+                    logger.error(
+                        f"The following device has an invalid PID4 '{pid4}' in the `notes` field: {device}"
+                    )
+                    continue
 
-            # No need to reset pid4_targets inside the loop
-            if pid4 in pid4_targets:
-                possible_duts.append(device)
+                # No need to reset pid4_targets inside the loop
+                if pid4 in pid4_targets:
+                    possible_duts.append(device)
 
     if not possible_duts:
         logger.error("Couldn't find any possible devices to send tests to")
         sys.exit(1)
     else:
         logger.info("Found these devices to send tests to:")
-        logger.debug(possible_duts)
+        logger.debug("Possible devices: %s", possible_duts)
         logger.info(common.pretty_print_devices(possible_duts))
 
     return possible_duts
+
+
+def _update_durations():
+    # Informative only: without a history every update costs the same.
+    if not run_history.enabled():
+        return {}
+    try:
+        return {
+            row["hardware_id"]: row["median_seconds"]
+            for row in run_history.update_duration_by_hardware_id()
+        }
+    except Exception as e:
+        logger.info(f"No update history to rank devices with: {e}")
+        return {}
+
+
+def order_by_update_cost(devices, cloud, target_build_type):
+    """Orders `devices` by how cheap they are to bring to the latest build.
+
+    Devices already on the latest build come first, then the others by the
+    median duration of past updates of their hardware id. Devices whose
+    builds can't be resolved are kept, last, in fleet order.
+    """
+    hardware_ids = common.parse_hardware_ids(devices)
+
+    latest_builds = {}
+    for hardware_id in set(hardware_ids.values()):
+        try:
+            latest_builds[hardware_id] = cloud.get_latest_build(
+                release_type=target_build_type, hardware_id=hardware_id
+            )
+        except Exception as e:
+            logger.info(
+                f"Couldn't resolve the latest build for {hardware_id}: {e}"
+            )
+
+    durations = _update_durations()
+    current_builds = (
+        inventory.current_builds(
+            hardware_ids, max_age=INVENTORY_BUILD_MAX_AGE_SECONDS
+        )
+        if inventory.enabled()
+        else {}
+    )
+    unknown = {
+        uuid: hardware_id
+        for uuid, hardware_id in hardware_ids.items()
+        if uuid not in current_builds
+    }
+    if unknown:
+        try:
+            fetched = cloud.get_current_builds(unknown)
+        except Exception as e:
+            logger.info(f"Couldn't resolve the current builds: {e}")
+            fetched = {}
+        if inventory.enabled():
+            inventory.record_current_builds(fetched)
+        current_builds.update(fetched)
+
+    def cost(device):
+        hardware_id = hardware_ids.get(device["deviceUuid"])
+        current_build = current_builds.get(device["deviceUuid"])
+        latest_build = latest_builds.get(hardware_id)
+        if current_build is None or latest_build is None:
+            return (2, float("inf"))
+        if current_build == latest_build:
+            return (0, 0)
+        return (1, durations.get(hardware_id) or float("inf"))
+
+    costs = {device["deviceUuid"]: cost(device) for device in devices}
+    ordered = sorted(devices, key=lambda device: costs[device["deviceUuid"]])
+
+    up_to_date = sum(1 for c in costs.values() if c[0] == 0)
+    logger.info(
+        f"{up_to_date} of {len(devices)} possible devices are already on the latest build"
+    )
+    logger.debug(
+        "Devices by update cost: %s",
+        [
+            (device["deviceUuid"], costs[device["deviceUuid"]])
+            for device in ordered
+        ],
+    )
+    return ordered
@@ -0,0 +1,154 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import common
+import logging_setup
+
+logger = logging_setup.setup_logging()
+
+CACHE_FORMAT_VERSION = 1
+# Response headers kept in the cache, the others are dropped.
+STORED_HEADERS = (
+    "Cache-Control",
+    "Content-Type",
+    "Date",
+    "ETag",
+    "Last-Modified",
+)
+MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+_namespace = ""
+
+
+def enabled():
+    return os.getenv("AVAL_HTTP_CACHE", "true").lower() != "false"
+
+
+def set_namespace(namespace):
+    """Keeps the cached responses of different accounts apart."""
+    global _namespace
+    _namespace = hashlib.sha256(namespace.encode()).hexdigest()[:16]
+
+
+def _path(url):
+    key = hashlib.sha256(f"{_namespace} {url}".encode()).hexdigest()
+    return os.path.join(common.cache_dir(), "http", f"{key}.json")
+
+
+def _cache_control(headers):
+    return {
+        directive.strip().lower()
+        for directive in headers.get("Cache-Control", "").split(",")
+    }
+
+
+def _save(url, entry):
+    path = _path(url)
+    try:
+        # The responses are authenticated ones, only for our user to read.
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        common.atomic_write(path, json.dumps(entry))
+    except (OSError, TypeError, ValueError) as e:
+        # Caching is an optimization only, never fail a run because of it.
+        logger.debug("Could not cache the response of %s: %s", url, e)
+
+
+def lookup(url):
+    try:
+        with open(_path(url)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if entry.get("version") != CACHE_FORMAT_VERSION or entry.get("url") != url:
+        return None
+    return entry
+
+
+def is_fresh(entry, max_stale):
+    """Whether `entry` can be used without asking the server.
+
+    It can while it is younger than the max-age the server gave it, or than
+    `max_stale` seconds, which callers choose according to how outdated the
+    data may be for them.
+    """
+    age = time.time() - entry["stored_at"]
+    if age <= max_stale:
+        return True
+
+    cache_control = _cache_control(entry["headers"])
+    if "no-cache" in cache_control:
+        return False
+    match = MAX_AGE_PATTERN.search(entry["headers"].get("Cache-Control", ""))
+    return bool(match) and age <= int(match.group(1))
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry["headers"].get("ETag"):
+        headers["If-None-Match"] = entry["headers"]["ETag"]
+    if entry["headers"].get("Last-Modified"):
+        headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+    return headers
+
+
+def to_response(entry):
+    res = requests.Response()
+    res.status_code = entry["status"]
+    res.url = entry["url"]
+    res.headers = CaseInsensitiveDict(entry["headers"])
+    res._content = base64.b64decode(entry["content"])
+    res.encoding = "utf-8"
+    return res
+
+
+def store(url, res, max_stale):
+    if res.status_code != 200 or "no-store" in _cache_control(res.headers):
+        return
+
+    reusable = max_stale or any(
+        name in res.headers for name in ("ETag", "Last-Modified")
+    )
+    if not reusable and not MAX_AGE_PATTERN.search(
+        res.headers.get("Cache-Control", "")
+    ):
+        return
+
+    _save(
+        url,
+        {
+            "version": CACHE_FORMAT_VERSION,
+            "url": url,
+            "status": res.status_code,
+            "headers": {
+                name: res.headers[name]
+                for name in STORED_HEADERS
+                if name in res.headers
+            },
+            "content": base64.b64encode(res.content).decode(),
+            "stored_at": time.time(),
+        },
+    )
+
+
+def revalidated(url, entry, res):
+    """The cached response, confirmed current by the server's 304 `res`."""
+    entry = dict(entry, stored_at=time.time())
+    # A 304 carries the validators and freshness of the current response.
+    entry["headers"] = dict(
+        entry["headers"],
+        **{
+            name: res.headers[name]
+            for name in STORED_HEADERS
+            if name in res.headers
+        },
+    )
+    _save(url, entry)
+    return to_response(entry)
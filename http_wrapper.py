@@ -1,33 +1,488 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import os
+import random
+import re
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+import http_cache
 import logging_setup
+import metrics
+import rate_limit
 
 logger = logging_setup.setup_logging()
 
+UUID_PATTERN = re.compile(
+    r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+)
+NUMBER_PATTERN = re.compile(r"(?<=/)\d+(?=/|$)")
+
+# Statuses meaning the request wasn't processed and may be sent again later.
+THROTTLED_STATUSES = (429, 503)
+THROTTLED_RETRIES = 5
+MAX_RETRY_AFTER_SECONDS = 300
+
+# Server errors worth sending an idempotent request again for.
+RETRYABLE_STATUSES = (500, 502, 504)
+IDEMPOTENT_METHODS = ("get", "head", "delete")
+
+
+class RetryPolicy:
+    """How endpoint_call retries failed requests.
+
+    Requests are sent at most `attempts` times, waiting a random delay of up
+    to `backoff` * 2^attempt seconds (capped at `max_backoff`) in between, and
+    are given up once retrying would go past `budget` seconds overall.
+
+    GET, HEAD and DELETE are retried on connection errors, timeouts and
+    500/502/504 responses. Other methods are only retried when the request
+    never reached the server, unless `idempotent` says they are safe to repeat.
+    Throttling (429/503) is handled separately, see THROTTLED_STATUSES.
+    """
+
+    def __init__(
+        self, attempts=5, backoff=1, max_backoff=30, budget=300, idempotent=None
+    ):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.idempotent = idempotent
+
+    def delay(self, attempt):
+        # "Full jitter", so that processes failing together don't retry
+        # together.
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+
+    def retryable(self, request_type, error):
+        if not isinstance(
+            error,
+            (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+                requests.exceptions.HTTPError,
+            ),
+        ):
+            return False
+        if _not_sent(error):
+            return True
+
+        idempotent = self.idempotent
+        if idempotent is None:
+            idempotent = request_type in IDEMPOTENT_METHODS
+        if not idempotent:
+            return False
+
+        if isinstance(error, requests.exceptions.HTTPError):
+            status = getattr(error.response, "status_code", None)
+            return status in RETRYABLE_STATUSES
+        return True
+
+
+DEFAULT_RETRY = RetryPolicy()
+# For POSTs that can safely be repeated, such as getting a token.
+IDEMPOTENT_RETRY = RetryPolicy(idempotent=True)
+NO_RETRY = RetryPolicy(attempts=1)
+
+# Connections kept open per host, about as many as threads sending requests
+# at once.
+POOL_CONNECTIONS = 16
+
+# Shared by every request of the process, so they reuse the connections
+# (and TLS sessions) opened by the ones before.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_maxsize=POOL_CONNECTIONS))
+_session.mount("http://", HTTPAdapter(pool_maxsize=POOL_CONNECTIONS))
+
+_records = []
+_records_lock = threading.Lock()
+# Requests whose last attempt failed transiently (no response, 429 or 5xx),
+# so that the next one counts as a retry.
+_failed = set()
+# Connections opened by each urllib3 pool so far, to tell reused connections.
+_pool_connections = weakref.WeakKeyDictionary()
+
 
-def endpoint_call(url, request_type, headers=None, body=None, json_data=None):
-    headers = headers or {}
-    res = None
-    try:
-        if request_type == "get":
-            res = requests.get(url, headers=headers)
-        elif request_type == "head":
-            res = requests.head(url, headers=headers)
-        elif request_type == "post":
-            res = requests.post(url, headers=headers, data=body, json=json_data)
-        elif request_type == "delete":
-            res = requests.delete(url, headers=headers)
+def route_template(url):
+    """`url` without query and with ids replaced, to aggregate calls by route."""
+    parts = urlsplit(url)
+    path = UUID_PATTERN.sub("{uuid}", parts.path)
+    path = NUMBER_PATTERN.sub("{id}", path)
+    return f"{parts.netloc}{path}"
+
+
+def _connection_reused(res):
+    reused = getattr(res, "connection_reused", None)
+    if isinstance(reused, bool):
+        # Told by async_http, which has no urllib3 pool.
+        return reused
+
+    pool = getattr(getattr(res, "raw", None), "_pool", None)
+    opened = getattr(pool, "num_connections", None)
+    if not isinstance(opened, int):
+        return None
+
+    reused = _pool_connections.get(pool) == opened
+    _pool_connections[pool] = opened
+    return reused
+
+
+def _record(request_type, url, res, started, error=None, cache=None):
+    route = route_template(url)
+    status = getattr(res, "status_code", None)
+    content = getattr(res, "content", None)
+    request_body = getattr(getattr(res, "request", None), "body", None)
+    key = (request_type, url)
+
+    record = {
+        "timestamp": time.time(),
+        "method": request_type.upper(),
+        "route": route,
+        "status": status if isinstance(status, int) else None,
+        "latency_seconds": time.perf_counter() - started,
+        "request_bytes": (
+            len(request_body) if isinstance(request_body, (bytes, str)) else 0
+        ),
+        "response_bytes": (
+            len(content) if isinstance(content, bytes) and cache != "hit" else 0
+        ),
+        "retry": key in _failed,
+        "connection_reused": (
+            None if cache == "hit" else _connection_reused(res)
+        ),
+        "error": error,
+        # "hit" when answered from the cache without asking the server,
+        # "revalidated" when the server confirmed the cached response.
+        "cache": cache,
+    }
+
+    transient = error and (
+        record["status"] is None
+        or record["status"] == 429
+        or record["status"] >= 500
+    )
+    with _records_lock:
+        if transient:
+            _failed.add(key)
         else:
-            raise ValueError(f"request type {request_type} not supported")
+            _failed.discard(key)
+        _records.append(record)
+
+    metrics.API_REQUESTS.inc(
+        method=record["method"],
+        route=route,
+        status="cache_hit" if cache == "hit" else record["status"] or error,
+    )
+    metrics.API_REQUEST_DURATION_SECONDS.observe(
+        record["latency_seconds"], method=record["method"], route=route
+    )
+
+    logger.debug(
+        "%s %s -> %s in %.3fs",
+        record["method"],
+        route,
+        record["status"] or error,
+        record["latency_seconds"],
+    )
+
+    log_file = os.getenv("AVAL_HTTP_LOG_FILE")
+    if log_file:
+        try:
+            with open(log_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            logger.error(f"Failed to write to {log_file}: {e}")
+
+
+def _retry_after(res, attempt):
+    """Seconds to wait before sending a throttled request again, else None."""
+    if getattr(res, "status_code", None) not in THROTTLED_STATUSES:
+        return None
+
+    value = res.headers.get("Retry-After")
+    seconds = None
+    if isinstance(value, str):
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = (
+                    parsedate_to_datetime(value) - datetime.now(timezone.utc)
+                ).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    if seconds is None:
+        seconds = 2**attempt
+
+    return min(max(seconds, 0), MAX_RETRY_AFTER_SECONDS)
+
+
+def _not_sent(error):
+    """Whether `error` happened before the request could reach the server."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], "reason", None)
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    return False
+
+
+def _send(url, request_type, headers, body, json_data):
+    if request_type == "get":
+        return _session.get(url, headers=headers)
+    elif request_type == "head":
+        return _session.head(url, headers=headers)
+    elif request_type == "post":
+        return _session.post(url, headers=headers, data=body, json=json_data)
+    elif request_type == "delete":
+        return _session.delete(url, headers=headers)
+    else:
+        raise ValueError(f"request type {request_type} not supported")
+
+
+class CallState:
+    """What endpoint_call keeps track of while sending one request.
+
+    Also used by async_http, which sends requests its own way but caches,
+    records, throttles and retries them the same.
+    """
+
+    def __init__(self, url, request_type, headers, retry, max_stale):
+        self.url = url
+        self.request_type = request_type
+        self.headers = headers or {}
+        self.retry = retry
+        self.max_stale = max_stale
+        self.bucket = rate_limit.bucket()
+
+        self._cached = None
+        self._throttled = 0
+        self._failures = 0
+        self._deadline = time.monotonic() + retry.budget
+
+    def cached_response(self):
+        """The cached response, if fresh enough to be returned as is.
+
+        Otherwise the request is made conditional on the cached response
+        having changed, if there is one.
+        """
+        if (
+            self.max_stale is None
+            or self.request_type != "get"
+            or not http_cache.enabled()
+        ):
+            return None
+
+        cached = http_cache.lookup(self.url)
+        if cached and http_cache.is_fresh(cached, self.max_stale):
+            res = http_cache.to_response(cached)
+            _record(
+                self.request_type,
+                self.url,
+                res,
+                time.perf_counter(),
+                cache="hit",
+            )
+            return res
+        if cached:
+            self._cached = cached
+            self.headers = dict(
+                self.headers, **http_cache.conditional_headers(cached)
+            )
+        return None
+
+    def response(self, res, started):
+        """What to return for `res`, raises HTTPError if it's an error."""
+        if self._cached and res.status_code == 304:
+            _record(
+                self.request_type, self.url, res, started, cache="revalidated"
+            )
+            return http_cache.revalidated(self.url, self._cached, res)
 
         res.raise_for_status()
+        _record(self.request_type, self.url, res, started)
+        if self.max_stale is not None and self.request_type == "get":
+            http_cache.store(self.url, res, self.max_stale)
         return res
 
-    except requests.exceptions.RequestException as e:
-        if e.response is not None:
+    def retry_delay(self, error, res, started):
+        """Seconds to wait before sending the request again after `error`.
+
+        None when it is given up on.
+        """
+        request_type = self.request_type
+        _record(
+            request_type,
+            self.url,
+            error.response if error.response is not None else res,
+            started,
+            error=type(error).__name__,
+        )
+
+        delay = _retry_after(error.response, self._throttled)
+        if delay is not None and self._throttled < THROTTLED_RETRIES:
+            logger.info(
+                f"{request_type.upper()} {route_template(self.url)} throttled with {error.response.status_code}, retrying in {delay:.1f}s"
+            )
+            # Holds back every request of this process (or runner), not
+            # only this one, so the others don't get throttled too.
+            self.bucket.pause(delay)
+            self._throttled += 1
+            return 0
+
+        self._failures += 1
+        retry = self.retry
+        if self._failures < retry.attempts and retry.retryable(
+            request_type, error
+        ):
+            delay = retry.delay(self._failures - 1)
+            if time.monotonic() + delay < self._deadline:
+                logger.info(
+                    f"{request_type.upper()} {route_template(self.url)} failed with {type(error).__name__}, retrying in {delay:.1f}s ({self._failures}/{retry.attempts - 1})"
+                )
+                return delay
+
+        if error.response is not None:
             try:
-                logger.error(json.dumps(e.response.json(), indent=2))
+                logger.error(json.dumps(error.response.json(), indent=2))
             except Exception:
-                logger.error(e.response.text)
-        logger.error(f"Request failed: {e}")
-        raise
+                logger.error(error.response.text)
+        logger.error(f"Request failed: {error}")
+        return None
+
+
+def endpoint_call(
+    url,
+    request_type,
+    headers=None,
+    body=None,
+    json_data=None,
+    retry=DEFAULT_RETRY,
+    max_stale=None,
+):
+    """Sends a request to the Cloud API, retrying it as `retry` allows.
+
+    GET responses are cached on disk when `max_stale` is given: a cached
+    response younger than `max_stale` seconds (or than the max-age the server
+    set) is returned without asking the server, an older one is revalidated
+    with a conditional request.
+    """
+    call = CallState(url, request_type, headers, retry, max_stale)
+    res = call.cached_response()
+    if res is not None:
+        return res
+
+    while True:
+        waited = call.bucket.acquire()
+        if waited:
+            metrics.API_RATE_LIMIT_WAIT_SECONDS.inc(waited)
+
+        res = None
+        started = time.perf_counter()
+        try:
+            res = _send(url, request_type, call.headers, body, json_data)
+            return call.response(res, started)
+        except requests.exceptions.RequestException as e:
+            delay = call.retry_delay(e, res, started)
+            if delay is None:
+                raise
+            if delay:
+                time.sleep(delay)
+
+
+def records():
+    with _records_lock:
+        return list(_records)
+
+
+def reset():
+    with _records_lock:
+        _records.clear()
+        _failed.clear()
+
+
+def summary():
+    """Calls aggregated by method and route, slowest routes first."""
+    routes = {}
+    for record in records():
+        stats = routes.setdefault(
+            (record["method"], record["route"]),
+            {
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "reused_connections": 0,
+                "cached": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+                "bytes": 0,
+            },
+        )
+        stats["calls"] += 1
+        stats["errors"] += bool(record["error"])
+        stats["retries"] += record["retry"]
+        stats["reused_connections"] += bool(record["connection_reused"])
+        stats["cached"] += bool(record.get("cache"))
+        stats["total_seconds"] += record["latency_seconds"]
+        stats["max_seconds"] = max(
+            stats["max_seconds"], record["latency_seconds"]
+        )
+        stats["bytes"] += record["request_bytes"] + record["response_bytes"]
+
+    return sorted(
+        routes.items(), key=lambda item: item[1]["total_seconds"], reverse=True
+    )
+
+
+def log_summary():
+    routes = summary()
+    if not routes:
+        return
+
+    from prettytable import PrettyTable
+
+    table = PrettyTable(
+        [
+            "Method",
+            "Route",
+            "Calls",
+            "Errors",
+            "Retries",
+            "Reused",
+            "Cached",
+            "Total (s)",
+            "Mean (s)",
+            "Max (s)",
+            "Bytes",
+        ]
+    )
+    table.align["Route"] = "l"
+    for (method, route), stats in routes:
+        table.add_row(
+            [
+                method,
+                route,
+                stats["calls"],
+                stats["errors"],
+                stats["retries"],
+                stats["reused_connections"],
+                stats["cached"],
+                f"{stats['total_seconds']:.3f}",
+                f"{stats['total_seconds'] / stats['calls']:.3f}",
+                f"{stats['max_seconds']:.3f}",
+                stats["bytes"],
+            ]
+        )
+
+    logger.info("HTTP requests made during this run:")
+    for line in table.get_string().split("\n"):
+        logger.info(line)
@@ -0,0 +1,276 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import common
+import logging_setup
+import rule_table
+
+logger = logging_setup.setup_logging()
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS devices (
+        device_uuid TEXT PRIMARY KEY,
+        position INTEGER NOT NULL,
+        fingerprint TEXT NOT NULL,
+        device_id TEXT,
+        pid4 TEXT,
+        hardware_id TEXT,
+        last_seen TEXT,
+        current_build TEXT,
+        current_build_at REAL,
+        synced_at REAL NOT NULL,
+        data TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS devices_pid4_idx ON devices (pid4)",
+    "CREATE INDEX IF NOT EXISTS devices_hardware_id_idx ON devices (hardware_id)",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+)
+
+
+# Runs match devices against an inventory synced this recently without
+# listing the fleet again. `--sync-inventory` on a schedule keeps it so.
+MAX_AGE_SECONDS = int(os.getenv("AVAL_INVENTORY_MAX_AGE", "600"))
+
+
+def path():
+    return os.getenv("AVAL_INVENTORY_FILE")
+
+
+def enabled():
+    return bool(path())
+
+
+@contextlib.contextmanager
+def _connect():
+    os.makedirs(os.path.dirname(os.path.abspath(path())), exist_ok=True)
+    # Several aval processes may share the inventory: WAL lets them read
+    # while one of them syncs, and writers wait for each other.
+    conn = sqlite3.connect(path(), timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _fingerprint(device):
+    # lastSeen changes all the time and derives nothing, leave it out.
+    data = {k: v for k, v in device.items() if k != "lastSeen"}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def _rules_version():
+    rules_path = rule_table.default_hardware_id_rules_path()
+    stat = os.stat(rules_path)
+    return f"{os.path.abspath(rules_path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def _derive(device, resolver):
+    pid4 = device.get("notes")
+    if not pid4:
+        logger.error(
+            f"The following device has no PID4 set in the `notes` field: {device}"
+        )
+        pid4 = None
+    elif not common.PID4_PATTERN.fullmatch(pid4):
+        logger.error(
+            f"The following device has an invalid PID4 '{pid4}' in the `notes` field: {device}"
+        )
+        pid4 = None
+
+    try:
+        hardware_id = resolver.resolve(device.get("deviceId") or "")
+    except ValueError as e:
+        logger.debug("No hardware id for %s: %s", device["deviceUuid"], e)
+        hardware_id = None
+
+    return pid4, hardware_id
+
+
+def sync(devices):
+    """Updates the inventory to `devices`, the fleet as listed by the Cloud.
+
+    Only new and changed devices have their PID4 and hardware id derived
+    again, and only the devices that moved in the list or were seen since
+    are written.
+    """
+    started = time.monotonic()
+    now = time.time()
+
+    with _connect() as conn:
+        rules_version = _rules_version()
+        row = conn.execute(
+            "SELECT value FROM meta WHERE key = 'rules_version'"
+        ).fetchone()
+        # Hardware ids may derive differently now, derive them all again.
+        rederive = row is None or row[0] != rules_version
+        known = {
+            device_uuid: (fingerprint, position, last_seen)
+            for device_uuid, fingerprint, position, last_seen in conn.execute(
+                "SELECT device_uuid, fingerprint, position, last_seen FROM devices"
+            )
+        }
+
+        resolver = rule_table.load_hardware_id_resolver()
+        changed, moved, listed = [], [], set()
+        for position, device in enumerate(devices):
+            device_uuid = device["deviceUuid"]
+            listed.add(device_uuid)
+            fingerprint = _fingerprint(device)
+            previous = known.get(device_uuid)
+            if rederive or previous is None or previous[0] != fingerprint:
+                pid4, hardware_id = _derive(device, resolver)
+                changed.append(
+                    (
+                        device_uuid,
+                        position,
+                        fingerprint,
+                        device.get("deviceId"),
+                        pid4,
+                        hardware_id,
+                        device.get("lastSeen"),
+                        now,
+                        json.dumps(device),
+                    )
+                )
+            elif previous[1:] != (position, device.get("lastSeen")):
+                moved.append((position, device.get("lastSeen"), device_uuid))
+        removed = [(device_uuid,) for device_uuid in known.keys() - listed]
+
+        conn.executemany(
+            "INSERT INTO devices (device_uuid, position, fingerprint, device_id, pid4, hardware_id, last_seen, synced_at, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (device_uuid) DO UPDATE SET position = excluded.position, fingerprint = excluded.fingerprint, "
+            "device_id = excluded.device_id, pid4 = excluded.pid4, hardware_id = excluded.hardware_id, "
+            "last_seen = excluded.last_seen, synced_at = excluded.synced_at, data = excluded.data",
+            changed,
+        )
+        conn.executemany(
+            "UPDATE devices SET position = ?, last_seen = ? WHERE device_uuid = ?",
+            moved,
+        )
+        conn.executemany("DELETE FROM devices WHERE device_uuid = ?", removed)
+        conn.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [("rules_version", rules_version), ("synced_at", str(now))],
+        )
+
+    logger.info(
+        f"Inventory synced in {time.monotonic() - started:.3f}s: {len(devices)} devices, {len(changed)} new or changed, {len(removed)} removed"
+    )
+    return {
+        "devices": len(devices),
+        "changed": len(changed),
+        "removed": len(removed),
+    }
+
+
+def synced_at():
+    """When the inventory was last synced, as a time.time(), or None."""
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT value FROM meta WHERE key = 'synced_at'"
+        ).fetchone()
+    return float(row[0]) if row else None
+
+
+def is_fresh(max_age=MAX_AGE_SECONDS):
+    """Whether the inventory was synced less than `max_age` seconds ago."""
+    last_sync = synced_at()
+    return last_sync is not None and time.time() - last_sync < max_age
+
+
+def find(pid4s=None, hardware_ids=None):
+    """Devices, as listed by the Cloud, with any of `pid4s` and `hardware_ids`.
+
+    They come in fleet order.
+    """
+    conditions, params = [], []
+    for column, values in (("pid4", pid4s), ("hardware_id", hardware_ids)):
+        if values is not None:
+            values = list(values)
+            conditions.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+
+    sql = "SELECT data, last_seen FROM devices"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY position"
+
+    with _connect() as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    devices = []
+    for data, last_seen in rows:
+        device = json.loads(data)
+        # Only the column follows lastSeen, see _fingerprint().
+        if last_seen is not None:
+            device["lastSeen"] = last_seen
+        devices.append(device)
+    return devices
+
+
+def hardware_ids(device_uuids):
+    device_uuids = list(device_uuids)
+    with _connect() as conn:
+        return dict(
+            conn.execute(
+                "SELECT device_uuid, hardware_id FROM devices "
+                f"WHERE device_uuid IN ({', '.join('?' * len(device_uuids))})",
+                device_uuids,
+            )
+        )
+
+
+def record_current_builds(builds):
+    """Remembers the build each device of `builds`, uuid -> build, is on."""
+    now = time.time()
+    with _connect() as conn:
+        conn.executemany(
+            "UPDATE devices SET current_build = ?, current_build_at = ? WHERE device_uuid = ?",
+            [
+                (build, now, device_uuid)
+                for device_uuid, build in builds.items()
+            ],
+        )
+
+
+def sync_current_builds(cloud):
+    """Records the build of every device, as `cloud`, a CloudAPI, reports it."""
+    with _connect() as conn:
+        hardware_ids = dict(
+            conn.execute(
+                "SELECT device_uuid, hardware_id FROM devices WHERE hardware_id IS NOT NULL"
+            )
+        )
+    builds = cloud.get_current_builds(hardware_ids)
+    record_current_builds(builds)
+    return len(builds)
+
+
+def record_current_build(device_uuid, build):
+    record_current_builds({device_uuid: build})
+
+
+def current_builds(device_uuids, max_age=None):
+    """Last known build of each device, if known for less than `max_age` s."""
+    device_uuids = list(device_uuids)
+    oldest = time.time() - max_age if max_age is not None else 0
+    with _connect() as conn:
+        return dict(
+            conn.execute(
+                "SELECT device_uuid, current_build FROM devices "
+                f"WHERE device_uuid IN ({', '.join('?' * len(device_uuids))}) "
+                "AND current_build IS NOT NULL AND current_build_at >= ?",
+                device_uuids + [oldest],
+            )
+        )
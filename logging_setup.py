@@ -1,5 +1,11 @@
+import atexit
 import os
 import logging
+import logging.handlers
+import queue
+
+_configured = False
+_listener = None
 
 
 def _configure_external_loggers():
@@ -15,22 +21,57 @@ def _configure_external_loggers():
         logging.getLogger(logger_name).setLevel(logging.WARNING)
 
 
-def setup_logging():
-    if os.getenv("AVAL_VERBOSE"):
-        logging_level = logging.DEBUG
-
-        logging.basicConfig(
-            level=logging_level,
-            format="%(levelname)s - %(asctime)s - File: %(filename)s, Line: %(lineno)d -  %(message)s",
-            datefmt="%H:%M:%S",
+def _build_stream_handler(verbose):
+    handler = logging.StreamHandler()
+    if verbose:
+        handler.setFormatter(
+            logging.Formatter(
+                "%(levelname)s - %(asctime)s - File: %(filename)s, Line: %(lineno)d -  %(message)s",
+                datefmt="%H:%M:%S",
+            )
         )
     else:
-        logging_level = logging.INFO
-        logging.basicConfig(
-            level=logging_level,
-            format="%(levelname)s - %(message)s",
-        )
+        handler.setFormatter(logging.Formatter("%(levelname)s - %(message)s"))
+    return handler
+
+
+def _configure_root_logger():
+    global _configured, _listener
+
+    verbose = bool(os.getenv("AVAL_VERBOSE"))
+
+    # Callers (main thread, lock heartbeat, update polling) only enqueue
+    # records; the actual stream I/O happens on the listener thread, so a
+    # slow or blocked stderr never stalls them.
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(
+        log_queue, _build_stream_handler(verbose), respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG if verbose else logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _configured = True
+
+
+def setup_logging():
+    # Every module calls this at import time; the root logger and the queue
+    # listener are only configured by the first call.
+    if not _configured:
+        _configure_root_logger()
+        _configure_external_loggers()
 
-    _configure_external_loggers()
     logger = logging.getLogger(__name__)
     return logger
+
+
+def shutdown_logging():
+    # Flushes all queued records. Must be called before any `os._exit` since
+    # atexit handlers won't run then.
+    global _listener
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
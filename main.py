@@ -1,12 +1,11 @@
-from cloud import CloudAPI
+import os
 import sys
 
 import logging_setup
 import argument_parser
-import database
-import environment
-import device_matcher
-import device_handler
+import metrics
+import run_history
+import timeline
 
 
 def main():
@@ -14,33 +13,107 @@ def main():
 
     args = argument_parser.parse_arguments()
 
-    env_vars = environment.load_environment_variables(args)
+    if os.getenv("AVAL_METRICS_PORT"):
+        metrics.start_http_server(int(os.environ["AVAL_METRICS_PORT"]))
 
-    if args.delegation_config:
-        cloud = CloudAPI(
-            api_client=env_vars["TORIZON_API_CLIENT_ID"],
-            api_secret=env_vars["TORIZON_API_SECRET_ID"],
-            delegation_config_path=args.delegation_config,
+    with timeline.span("aval"):
+        # Heavy dependencies (fabric/paramiko, psycopg, requests, boto3...)
+        # are only imported once the arguments are known to be valid, so
+        # `--help` and argument errors return immediately.
+        import environment
+        from cloud import CloudAPI
+        import device_matcher
+        import device_handler
+        import inventory
+
+        env_vars = environment.load_environment_variables(args)
+        run_history.start_run(
+            soc_udt=env_vars.get("SOC_UDT"),
+            device_config=args.device_config,
+            target_build_type=env_vars["TARGET_BUILD_TYPE"],
         )
-    else:
-        logger.error("Missing delegation config file")
-        sys.exit(1)
 
-    possible_duts = device_matcher.find_possible_devices(cloud, args, env_vars)
+        if args.delegation_config:
+            with timeline.span("fleet_fetch"):
+                cloud = CloudAPI(
+                    api_client=env_vars["TORIZON_API_CLIENT_ID"],
+                    api_secret=env_vars["TORIZON_API_SECRET_ID"],
+                    delegation_config_path=args.delegation_config,
+                )
+        else:
+            logger.error("Missing delegation config file")
+            sys.exit(1)
+
+        if args.sync_inventory:
+            if not inventory.enabled():
+                logger.error("--sync-inventory needs AVAL_INVENTORY_FILE set")
+                sys.exit(1)
+            with timeline.span("inventory_sync"):
+                inventory.sync(cloud.provisioned_devices)
+                inventory.sync_current_builds(cloud)
+            sys.exit(0)
+
+        with timeline.span("matching"):
+            possible_duts = device_matcher.find_possible_devices(
+                cloud, args, env_vars
+            )
+
+        if args.warm_fleet:
+            with timeline.span("warm_fleet"):
+                outcomes = device_handler.warm_devices(
+                    possible_duts, cloud, env_vars, args
+                )
+            sys.exit(1 if "failed" in outcomes.values() else 0)
+
+        if (
+            args.candidate_order == "update-cost"
+            and not args.do_not_update
+            and not env_vars["TEST_WHOLE_FLEET"]
+        ):
+            with timeline.span("ranking"):
+                possible_duts = device_matcher.order_by_update_cost(
+                    possible_duts, cloud, env_vars["TARGET_BUILD_TYPE"]
+                )
+
+        if (
+            device_handler.process_devices(possible_duts, cloud, env_vars, args)
+            and not env_vars["TEST_WHOLE_FLEET"]
+        ):
+            sys.exit(0)
 
-    if (
-        device_handler.process_devices(possible_duts, cloud, env_vars, args)
-        and not env_vars["TEST_WHOLE_FLEET"]
-    ):
-        sys.exit(0)
+        if not env_vars["TEST_WHOLE_FLEET"]:
+            # EX_UNAVAILABLE 69	/* service unavailable */ sysexits.h
+            sys.exit(69)
 
-    if not env_vars["TEST_WHOLE_FLEET"]:
-        # EX_UNAVAILABLE 69	/* service unavailable */ sysexits.h
-        sys.exit(69)
+
+def shutdown(exit_code=None):
+    metrics.record_exit(exit_code)
+    run_history.finish_run(metrics.exit_reason(exit_code))
+    timeline.write_timeline()
+    metrics.write_textfile()
+
+    http_wrapper = sys.modules.get("http_wrapper")
+    if http_wrapper is not None:
+        http_wrapper.log_summary()
+
+    # The history is written by a daemon thread, which exiting would kill.
+    run_history.wait()
+
+    # Only tear down database access if it was actually used during this run.
+    database = sys.modules.get("database")
+    if database is not None:
+        database.shutdown_database_access()
 
 
 if __name__ == "__main__":
+    exit_code = None
     try:
         main()
+    except SystemExit as e:
+        exit_code = e.code
+        raise
+    except BaseException:
+        exit_code = "exception"
+        raise
     finally:
-        database.shutdown_database_access()
+        shutdown(exit_code)
@@ -0,0 +1,277 @@
+import os
+import threading
+import time
+
+import common
+import logging_setup
+
+logger = logging_setup.setup_logging()
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            return [
+                (self.name, key, value) for key, value in self._values.items()
+            ]
+
+    def expose(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(
+                f"{name}{_format_labels(labels)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0.0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        for _, key, (counts, total) in super().samples():
+            for bound, count in zip(self.buckets, counts):
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        key + (("le", _format_value(bound)),),
+                        count,
+                    )
+                )
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, counts[-1]))
+        return samples
+
+
+def _register(metric):
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+def counter(name, documentation, labelnames=()):
+    return _register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return _register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+LOCK_WAIT_SECONDS = histogram(
+    "aval_lock_wait_seconds",
+    "Time spent trying to lock a device.",
+    ["result"],
+    buckets=(0.1, 1, 10, 60, 300, 900, 1800, 3600, 7200),
+)
+UPDATE_DURATION_SECONDS = histogram(
+    "aval_update_duration_seconds",
+    "Duration of OS updates, from launch until the device reports it done.",
+    ["hardware_id", "result"],
+    buckets=(60, 300, 600, 900, 1200, 1800, 2700, 3600, 7200),
+)
+SSH_CONNECT_ATTEMPTS = counter(
+    "aval_ssh_connect_attempts_total",
+    "SSH connection tests against the device under test.",
+    ["result"],
+)
+DEVICES_SKIPPED = counter(
+    "aval_devices_skipped_total",
+    "Candidate devices skipped for their connection health.",
+    ["reason"],
+)
+API_REQUESTS = counter(
+    "aval_api_requests_total",
+    "Torizon Cloud API requests by route and status.",
+    ["method", "route", "status"],
+)
+API_REQUEST_DURATION_SECONDS = histogram(
+    "aval_api_request_duration_seconds",
+    "Torizon Cloud API request latency.",
+    ["method", "route"],
+)
+API_RATE_LIMIT_WAIT_SECONDS = counter(
+    "aval_api_rate_limit_wait_seconds_total",
+    "Time requests were held back by the rate limiter or a Retry-After.",
+)
+ARTIFACT_BYTES = counter(
+    "aval_artifact_bytes_total",
+    "Bytes of artifacts copied from the device under test.",
+)
+EXIT_REASON = gauge(
+    "aval_exit_reason",
+    "Set to 1 for the reason the last aval run exited with.",
+    ["reason"],
+)
+LAST_RUN_TIMESTAMP = gauge(
+    "aval_last_run_timestamp_seconds",
+    "When the last aval run finished.",
+)
+
+
+def exit_reason(code):
+    if code in (None, 0):
+        return "success"
+    if code == 69:
+        return "no_device_available"
+    if code == 1:
+        return "error"
+    if isinstance(code, int):
+        return f"exit_{code}"
+    return "exception"
+
+
+def record_exit(code):
+    EXIT_REASON.clear()
+    EXIT_REASON.set(1, reason=exit_reason(code))
+    LAST_RUN_TIMESTAMP.set(time.time())
+
+
+def expose():
+    """All metrics in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path=None):
+    """Writes the metrics for node_exporter's textfile collector.
+
+    Goes to AVAL_METRICS_FILE unless `path` is given, and does nothing if
+    neither is set. The file is replaced atomically, as the collector requires.
+    """
+    path = path or os.getenv("AVAL_METRICS_FILE")
+    if not path:
+        return
+
+    try:
+        # node_exporter usually runs as another user.
+        common.atomic_write(path, expose(), mode=0o644)
+    except OSError as e:
+        logger.error(f"Failed to write metrics to {path}: {e}")
+    else:
+        logger.info(f"Metrics written to {path}")
+
+
+def start_http_server(port, host=None):
+    """Serves the metrics on http://host:port/metrics from a daemon thread.
+
+    Only on the loopback interface, unless `host` or AVAL_METRICS_HOST says
+    otherwise: the metrics name hardware ids, routes and exit reasons.
+    """
+    host = host or os.getenv("AVAL_METRICS_HOST", "127.0.0.1")
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = expose().encode()
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+            )
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    logger.info(
+        f"Serving metrics on http://{host}:{server.server_port}/metrics"
+    )
+    return server
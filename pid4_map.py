@@ -0,0 +1,277 @@
+import functools
+import hashlib
+import json
+import os
+import logging_setup
+
+logger = logging_setup.setup_logging()
+
+CACHE_FORMAT_VERSION = 1
+
+_loaded_maps = {}
+
+
+def default_pid_map_path():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, "pid_map.yaml")
+
+
+def _cache_path(pid_map_path):
+    # One cache file per source file, so several maps can be cached side by side.
+    # Imported here, common imports this module.
+    import common
+
+    key = hashlib.sha256(pid_map_path.encode()).hexdigest()[:16]
+    return os.path.join(common.cache_dir(), f"pid_map-{key}.json")
+
+
+def pid4_id(entry):
+    # Entries are usually dicts with an `id` key, but bare ids are accepted too.
+    return entry.get("id", entry) if isinstance(entry, dict) else entry
+
+
+class Pid4Map(dict):
+    """A parsed PID4 map with lookups precomputed at load time.
+
+    It is the map exactly as parsed from the yaml file (SoC name -> {"pid4":
+    [...]}), so it can be passed to anything that expects the plain dict, plus
+    inverted indexes. Treat it as read-only: the indexes are not updated if the
+    map is modified.
+    """
+
+    def __init__(self, data=None, path=None):
+        super().__init__(data or {})
+        self.path = path
+
+        self.socs = {
+            soc: soc_data
+            for soc, soc_data in self.items()
+            if isinstance(soc_data, dict) and "pid4" in soc_data
+        }
+
+        # pid4 -> (SoC, properties)
+        self.by_pid4 = {}
+        # SoC -> pid4s, architecture -> pid4s and common_device -> pid4s. The
+        # lists keep the order of the map.
+        self.pid4s_by_soc = {}
+        self.pid4s_by_architecture = {}
+        self.pid4s_by_common_device = {}
+
+        for soc, soc_data in self.socs.items():
+            soc_pid4s = self.pid4s_by_soc.setdefault(soc, [])
+            for entry in soc_data.get("pid4") or []:
+                pid4 = pid4_id(entry)
+                properties = entry if isinstance(entry, dict) else {}
+
+                self.by_pid4.setdefault(pid4, (soc, properties))
+                soc_pid4s.append(pid4)
+
+                if properties.get("architecture"):
+                    self.pid4s_by_architecture.setdefault(
+                        properties["architecture"], []
+                    ).append(pid4)
+                if "common_device" in properties:
+                    self.pid4s_by_common_device.setdefault(
+                        properties["common_device"], set()
+                    ).add(pid4)
+
+        self.architectures = frozenset(self.pid4s_by_architecture)
+
+    def get_pid4_entries(self, soc):
+        return self.socs.get(soc, {}).get("pid4") or []
+
+    def is_architecture(self, name):
+        return name in self.architectures
+
+    def soc_of(self, pid4):
+        return self.by_pid4.get(pid4, (None, None))[0]
+
+    def properties_of(self, pid4):
+        return self.by_pid4.get(pid4, (None, {}))[1]
+
+    def architecture_of(self, pid4):
+        return self.properties_of(pid4).get("architecture")
+
+    def pid4s_for_soc(self, soc):
+        return list(self.pid4s_by_soc.get(soc, []))
+
+    def pid4s_for_architecture(self, architecture, common_device=None):
+        pid4s = self.pid4s_by_architecture.get(architecture, [])
+        if common_device is None:
+            return list(pid4s)
+
+        common = self.pid4s_by_common_device.get(common_device, set())
+        return [pid4 for pid4 in pid4s if pid4 in common]
+
+    @functools.cached_property
+    def property_index(self):
+        return PropertyIndex(self)
+
+
+def _value_key(name, value):
+    # True == 1 for dict keys, so keep booleans apart from numbers.
+    return (name, isinstance(value, bool), value)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class PropertyIndex:
+    """Bitmasks over every PID4 of a map, one bit per PID4.
+
+    Each scalar property value (soc_npu=True, architecture="arm64", ...) gets a
+    mask with the bits of the PID4s that have it, so a device config is matched
+    by AND-ing a handful of integers instead of walking the entries.
+    """
+
+    def __init__(self, pid4_map):
+        self.pid4s = []
+        self.all = 0
+        self.by_soc = {}
+        self.has = {}
+        self.equals = {}
+        self.numbers = {}
+
+        for soc, soc_data in pid4_map.socs.items():
+            soc_mask = 0
+            for entry in soc_data.get("pid4") or []:
+                bit = 1 << len(self.pid4s)
+                self.pid4s.append(pid4_id(entry))
+                self.all |= bit
+                soc_mask |= bit
+
+                if not isinstance(entry, dict):
+                    continue
+
+                for name, value in entry.items():
+                    if name == "id" or isinstance(value, (dict, list)):
+                        continue
+
+                    self.has[name] = self.has.get(name, 0) | bit
+                    key = _value_key(name, value)
+                    self.equals[key] = self.equals.get(key, 0) | bit
+                    if _is_number(value):
+                        self.numbers.setdefault(name, []).append((value, bit))
+
+            self.by_soc[soc] = soc_mask
+
+    def soc(self, soc):
+        if soc is None:
+            return self.all
+        return self.by_soc.get(soc, 0)
+
+    def equal(self, name, value):
+        return self.equals.get(_value_key(name, value), 0)
+
+    def not_equal(self, name, value):
+        # PID4s without the property are unknown, not different.
+        return self.has.get(name, 0) & ~self.equal(name, value)
+
+    def in_range(self, name, minimum=None, maximum=None):
+        mask = 0
+        for value, bit in self.numbers.get(name, []):
+            if (minimum is None or value >= minimum) and (
+                maximum is None or value <= maximum
+            ):
+                mask |= bit
+        return mask
+
+    def to_pid4s(self, mask):
+        pid4s = []
+        while mask:
+            lowest = mask & -mask
+            pid4s.append(self.pid4s[lowest.bit_length() - 1])
+            mask ^= lowest
+        return pid4s
+
+
+def compile_pid_map(pid4_map):
+    # Lets the matching code accept both compiled maps and plain dicts.
+    if isinstance(pid4_map, Pid4Map):
+        return pid4_map
+    return Pid4Map(pid4_map)
+
+
+def _read_cache(cache_path, stat, source):
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+
+    if cache.get("version") != CACHE_FORMAT_VERSION:
+        return None, None
+
+    if (
+        cache.get("mtime_ns") == stat.st_mtime_ns
+        and cache.get("size") == stat.st_size
+    ):
+        return cache["data"], cache
+
+    # The file was touched (e.g. fresh checkout) but its content may still be
+    # the same: fall back to comparing the content hash.
+    if cache.get("sha256") == hashlib.sha256(source()).hexdigest():
+        return cache["data"], cache
+
+    return None, None
+
+
+def _write_cache(cache_path, stat, raw, data):
+    cache = {
+        "version": CACHE_FORMAT_VERSION,
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": hashlib.sha256(raw).hexdigest(),
+        "data": data,
+    }
+
+    # Imported here, common imports this module.
+    import common
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        common.atomic_write(cache_path, json.dumps(cache))
+    except (OSError, TypeError, ValueError) as e:
+        logger.debug("Could not write PID4 map cache %s: %s", cache_path, e)
+
+
+def _parse_pid_map(pid_map_path):
+    stat = os.stat(pid_map_path)
+    cache_path = _cache_path(pid_map_path)
+
+    raw = None
+
+    def source():
+        nonlocal raw
+        if raw is None:
+            with open(pid_map_path, "rb") as f:
+                raw = f.read()
+        return raw
+
+    data, cache = _read_cache(cache_path, stat, source)
+    if data is not None:
+        logger.debug("Loaded PID4 map %s from cache", pid_map_path)
+        if cache["mtime_ns"] != stat.st_mtime_ns:
+            _write_cache(cache_path, stat, source(), data)
+        return data
+
+    # Only pay for importing yaml when the cache can't be used.
+    import yaml
+
+    data = yaml.safe_load(source())
+    _write_cache(cache_path, stat, source(), data)
+    logger.debug("Parsed PID4 map %s", pid_map_path)
+    return data
+
+
+def load(pid_map_path=None):
+    """Returns the compiled PID4 map, parsing the file at most once per process."""
+    pid_map_path = os.path.abspath(pid_map_path or default_pid_map_path())
+
+    if pid_map_path not in _loaded_maps:
+        _loaded_maps[pid_map_path] = Pid4Map(
+            _parse_pid_map(pid_map_path), path=pid_map_path
+        )
+
+    return _loaded_maps[pid_map_path]
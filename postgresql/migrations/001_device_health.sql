@@ -0,0 +1,6 @@
+-- Connection health of the devices, see init.sql. For databases created
+-- before these columns, run once by the owner of the tables:
+--   psql -f postgresql/migrations/001_device_health.sql
+ALTER TABLE devices ADD COLUMN IF NOT EXISTS consecutive_failures INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE devices ADD COLUMN IF NOT EXISTS last_failure TEXT;
+ALTER TABLE devices ADD COLUMN IF NOT EXISTS circuit_open_until timestamptz;
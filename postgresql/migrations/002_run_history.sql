@@ -0,0 +1,39 @@
+-- Run history, see init.sql. For databases created before these tables,
+-- run once by the owner of the tables:
+--   psql -f postgresql/migrations/002_run_history.sql
+CREATE TABLE IF NOT EXISTS runs (
+    run_id UUID PRIMARY KEY,
+    started_at timestamptz NOT NULL,
+    finished_at timestamptz,
+    exit_reason TEXT,
+    soc_udt TEXT,
+    device_config TEXT,
+    target_build_type TEXT,
+    ci_job_id TEXT
+);
+
+CREATE TABLE IF NOT EXISTS device_runs (
+    run_id UUID NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    device_uuid UUID NOT NULL,
+    hardware_id TEXT,
+    locked_at timestamptz,
+    released_at timestamptz,
+    current_build TEXT,
+    target_build TEXT,
+    update_outcome TEXT,
+    update_seconds DOUBLE PRECISION,
+    failure TEXT,
+    PRIMARY KEY (run_id, device_uuid)
+);
+
+CREATE TABLE IF NOT EXISTS run_phases (
+    run_id UUID NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    device_uuid UUID,
+    phase TEXT NOT NULL,
+    started_at timestamptz NOT NULL,
+    duration_seconds DOUBLE PRECISION NOT NULL,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS device_runs_hardware_id_idx ON device_runs (hardware_id);
+CREATE INDEX IF NOT EXISTS run_phases_phase_idx ON run_phases (phase);
@@ -0,0 +1,149 @@
+import asyncio
+import contextlib
+import json
+import os
+import threading
+import time
+
+import logging_setup
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the bucket is then only shared by the threads of a process.
+    fcntl = None
+
+logger = logging_setup.setup_logging()
+
+
+class TokenBucket:
+    """Lets `rate` requests per second through on average, `burst` at once.
+
+    Without a rate it only enforces the pauses asked for by the server. With a
+    `state_file`, every process using the same file shares the bucket, so the
+    aval jobs of a runner stay under the quota together.
+    """
+
+    def __init__(self, rate=0, burst=None, state_file=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.state_file = state_file if fcntl else None
+        self._lock = threading.Lock()
+        self._state = self._initial_state()
+
+        if state_file and not fcntl:
+            logger.info(
+                f"Can't share the rate limit through {state_file} on this OS, limiting this process only"
+            )
+
+    def _initial_state(self):
+        return {"tokens": self.burst, "updated": time.time(), "paused_until": 0}
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        with self._lock:
+            if not self.state_file:
+                yield self._state
+                return
+
+            with open(self.state_file, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = self._initial_state()
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def try_acquire(self):
+        """Takes a token if a request may be sent now, returns 0 if it did.
+
+        Otherwise returns the seconds to wait before trying again.
+        """
+        with self._locked_state() as state:
+            now = time.time()
+            wait = state["paused_until"] - now
+            if wait > 0:
+                return wait
+            if not self.rate:
+                return 0
+
+            tokens = min(
+                self.burst,
+                state["tokens"] + (now - state["updated"]) * self.rate,
+            )
+            state["updated"] = now
+            if tokens >= 1:
+                state["tokens"] = tokens - 1
+                return 0
+            state["tokens"] = tokens
+            return (1 - tokens) / self.rate
+
+    def acquire(self):
+        """Blocks until a request may be sent, returns the seconds waited."""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self):
+        """Like acquire(), but waits without blocking the event loop."""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        """Holds every request back for `seconds`, e.g. after a 429."""
+        with self._locked_state() as state:
+            now = time.time()
+            state["paused_until"] = max(state["paused_until"], now + seconds)
+            # Start again from an empty bucket once the pause is over.
+            state["tokens"] = 0
+            state["updated"] = state["paused_until"]
+
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+def bucket():
+    """The process-wide bucket, configured from the environment."""
+    global _bucket
+
+    with _bucket_lock:
+        if _bucket is None:
+            rate = float(os.getenv("AVAL_API_RATE_LIMIT", "0"))
+            burst = float(os.getenv("AVAL_API_BURST", "0"))
+            _bucket = TokenBucket(
+                rate=rate,
+                burst=burst or None,
+                state_file=os.getenv("AVAL_API_RATE_LIMIT_FILE"),
+            )
+            if rate:
+                logger.debug(
+                    "Limiting API requests to %s/s, bursts of %s",
+                    rate,
+                    _bucket.burst,
+                )
+        return _bucket
+
+
+def reset():
+    global _bucket
+
+    with _bucket_lock:
+        _bucket = None
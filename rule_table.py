@@ -0,0 +1,89 @@
+import os
+import re
+
+_resolvers = {}
+
+
+class RuleTable:
+    """First-match table of rules keyed by a regex.
+
+    `rules` is a list of dicts; `pattern_key` names the entry holding the regex
+    that is searched for in the looked-up value. Patterns are compiled once and
+    results are memoized, since the same values are looked up over and over.
+    """
+
+    def __init__(self, rules, pattern_key):
+        self._rules = [(re.compile(rule[pattern_key]), rule) for rule in rules]
+        self._matches = {}
+
+    def match(self, value):
+        """Returns (rule, re.Match) for the first matching rule or None."""
+        if value not in self._matches:
+            self._matches[value] = next(
+                (
+                    (rule, match)
+                    for pattern, rule in self._rules
+                    if (match := pattern.search(value))
+                ),
+                None,
+            )
+        return self._matches[value]
+
+    def lookup(self, value):
+        """Returns the first matching rule or None."""
+        matched = self.match(value)
+        return matched[0] if matched else None
+
+
+class HardwareIdResolver:
+    def __init__(self, rules):
+        self._table = RuleTable(rules, "match")
+        self._resolved = {}
+
+    def resolve(self, device_id):
+        if device_id not in self._resolved:
+            matched = self._table.match(device_id)
+            if not matched:
+                raise ValueError(
+                    f"No hardware id rule matches device id {device_id}"
+                )
+
+            rule, match = matched
+            try:
+                self._resolved[device_id] = rule["hardware_id"].format(
+                    *device_id.split("-"), **match.groupdict()
+                )
+            except (IndexError, KeyError) as e:
+                raise ValueError(
+                    f"Hardware id rule {rule['match']!r} -> {rule['hardware_id']!r} "
+                    f"doesn't fit device id {device_id}: {e}"
+                ) from e
+        return self._resolved[device_id]
+
+    def resolve_fleet(self, devices):
+        """Resolves a whole device list at once: deviceUuid -> hardware id."""
+        return {
+            device["deviceUuid"]: self.resolve(device["deviceId"])
+            for device in devices
+        }
+
+
+def default_hardware_id_rules_path():
+    if os.getenv("AVAL_HARDWARE_ID_RULES"):
+        return os.environ["AVAL_HARDWARE_ID_RULES"]
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, "hardware_id_rules.toml")
+
+
+def load_hardware_id_resolver(rules_path=None):
+    """Returns the resolver for a rules file, loading it once per process."""
+    rules_path = os.path.abspath(rules_path or default_hardware_id_rules_path())
+
+    if rules_path not in _resolvers:
+        import toml
+
+        rules = toml.load(rules_path)["hardware_id"]["rule"]
+        _resolvers[rules_path] = HardwareIdResolver(rules)
+
+    return _resolvers[rules_path]
@@ -0,0 +1,224 @@
+import os
+import threading
+import uuid as uuid_lib
+from datetime import datetime, timezone
+
+import logging_setup
+import timeline
+
+logger = logging_setup.setup_logging()
+
+DEVICE_FIELDS = (
+    "hardware_id",
+    "locked_at",
+    "released_at",
+    "current_build",
+    "target_build",
+    "update_outcome",
+    "update_seconds",
+    "failure",
+)
+
+_run = None
+_devices = {}
+_writer = None
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def enabled():
+    return os.getenv("AVAL_RUN_HISTORY", "true").lower() != "false"
+
+
+def start_run(soc_udt=None, device_config=None, target_build_type=None):
+    global _run
+
+    if not enabled():
+        return
+
+    _run = {
+        "run_id": str(uuid_lib.uuid4()),
+        "started_at": _now(),
+        "soc_udt": soc_udt,
+        "device_config": device_config,
+        "target_build_type": target_build_type,
+        "ci_job_id": os.getenv("CI_JOB_ID"),
+    }
+    _devices.clear()
+
+
+def record_device(device_uuid, **fields):
+    """Merges `fields` into what this run knows about `device_uuid`."""
+    unknown = set(fields) - set(DEVICE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown device run fields: {sorted(unknown)}")
+
+    _devices.setdefault(device_uuid, {}).update(fields)
+
+
+def record_lock(device_uuid, hardware_id):
+    record_device(device_uuid, hardware_id=hardware_id, locked_at=_now())
+
+
+def record_release(device_uuid):
+    record_device(device_uuid, released_at=_now())
+
+
+def _span_devices(spans):
+    # Spans belong to the device named by them or by one of their parents.
+    # Otherwise, everything that starts once a device is locked happens on
+    # that device.
+    by_id = {s.span_id: s for s in spans}
+    locked = sorted(
+        (s.start_ns, s.attributes["device"])
+        for s in spans
+        if s.name == "lock_wait" and s.attributes.get("locked")
+    )
+    devices = {}
+    for s in spans:
+        ancestor = s
+        while ancestor is not None and "device" not in ancestor.attributes:
+            ancestor = by_id.get(ancestor.parent_id)
+        if ancestor is not None:
+            device = ancestor.attributes["device"]
+        else:
+            device = next(
+                (d for start, d in reversed(locked) if s.start_ns >= start),
+                None,
+            )
+        devices[s.span_id] = device
+    return devices
+
+
+def _rows(run, devices, spans, exit_reason):
+    run_row = dict(run, finished_at=_now(), exit_reason=exit_reason)
+    device_rows = [
+        (run["run_id"], device_uuid)
+        + tuple(fields.get(name) for name in DEVICE_FIELDS)
+        for device_uuid, fields in devices.items()
+    ]
+    span_devices = _span_devices(spans)
+    phase_rows = [
+        (
+            run["run_id"],
+            span_devices[s.span_id],
+            s.name,
+            datetime.fromtimestamp(s.start_ns / 1e9, timezone.utc),
+            s.duration_seconds,
+            s.error,
+        )
+        for s in spans
+    ]
+    return run_row, device_rows, phase_rows
+
+
+def _write(run_row, device_rows, phase_rows):
+    import database
+
+    try:
+        with database.get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO runs (run_id, started_at, finished_at, exit_reason, soc_udt, device_config, target_build_type, ci_job_id) "
+                    "VALUES (%(run_id)s, %(started_at)s, %(finished_at)s, %(exit_reason)s, %(soc_udt)s, %(device_config)s, %(target_build_type)s, %(ci_job_id)s)",
+                    run_row,
+                )
+                cursor.executemany(
+                    f"INSERT INTO device_runs (run_id, device_uuid, {', '.join(DEVICE_FIELDS)}) "
+                    f"VALUES ({', '.join(['%s'] * (len(DEVICE_FIELDS) + 2))})",
+                    device_rows,
+                )
+                cursor.executemany(
+                    "INSERT INTO run_phases (run_id, device_uuid, phase, started_at, duration_seconds, error) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)",
+                    phase_rows,
+                )
+            conn.commit()
+        logger.info(f"Run history saved as run {run_row['run_id']}")
+    except Exception as e:
+        # The history is only informative, never fail a run because of it.
+        logger.error(f"Failed to save the run history: {e}")
+
+
+def finish_run(exit_reason):
+    """Writes the run history in the background, in a single transaction."""
+    global _run, _writer
+
+    if _run is None:
+        return
+
+    rows = _rows(_run, _devices, timeline.spans(), exit_reason)
+    _run = None
+    _devices.clear()
+
+    _writer = threading.Thread(
+        target=_write, args=rows, name="run-history", daemon=True
+    )
+    _writer.start()
+
+
+def wait(timeout=30):
+    """Waits for the history started by finish_run to be written."""
+    if _writer is not None:
+        _writer.join(timeout)
+
+
+def _query(sql, params=()):
+    import database
+
+    with database.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            columns = [column.name for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def update_duration_by_hardware_id(days=30):
+    """Median and 90th percentile of successful updates per hardware id."""
+    return _query(
+        "SELECT hardware_id, COUNT(*) AS updates, "
+        "percentile_cont(0.5) WITHIN GROUP (ORDER BY update_seconds) AS median_seconds, "
+        "percentile_cont(0.9) WITHIN GROUP (ORDER BY update_seconds) AS p90_seconds "
+        "FROM device_runs JOIN runs USING (run_id) "
+        "WHERE update_outcome = 'success' AND runs.started_at > NOW() - make_interval(days => %s) "
+        "GROUP BY hardware_id ORDER BY hardware_id",
+        (days,),
+    )
+
+
+def device_failures(days=30):
+    """Runs and failures per device, most failing first."""
+    return _query(
+        "SELECT device_uuid, hardware_id, COUNT(*) AS runs, "
+        "COUNT(failure) AS failures, "
+        "COUNT(*) FILTER (WHERE update_outcome = 'failed') AS failed_updates "
+        "FROM device_runs JOIN runs USING (run_id) "
+        "WHERE runs.started_at > NOW() - make_interval(days => %s) "
+        "GROUP BY device_uuid, hardware_id ORDER BY failures DESC, runs DESC",
+        (days,),
+    )
+
+
+def phase_durations(days=30):
+    """Median, 90th percentile and total time spent in each phase."""
+    return _query(
+        "SELECT phase, COUNT(*) AS samples, "
+        "percentile_cont(0.5) WITHIN GROUP (ORDER BY duration_seconds) AS median_seconds, "
+        "percentile_cont(0.9) WITHIN GROUP (ORDER BY duration_seconds) AS p90_seconds, "
+        "SUM(duration_seconds) AS total_seconds "
+        "FROM run_phases JOIN runs USING (run_id) "
+        "WHERE runs.started_at > NOW() - make_interval(days => %s) "
+        "GROUP BY phase ORDER BY total_seconds DESC",
+        (days,),
+    )
+
+
+def recent_runs(limit=20):
+    return _query(
+        "SELECT runs.*, COUNT(device_runs.device_uuid) AS devices "
+        "FROM runs LEFT JOIN device_runs USING (run_id) "
+        "GROUP BY runs.run_id ORDER BY runs.started_at DESC LIMIT %s",
+        (limit,),
+    )
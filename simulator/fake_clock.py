@@ -0,0 +1,20 @@
+class FakeClock:
+    """Stands in for the `time` module of the code under test.
+
+    Sleeping moves both clocks forward at once, so code waiting on a
+    deadline runs through without waiting. Sleeps are kept in `sleeps`.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+if str(PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(PROJECT_ROOT))
+
+import logging_setup  # noqa: E402
+import pid4_map  # noqa: E402
+import rule_table  # noqa: E402
+from simulator.torizon_cloud import (  # noqa: E402
+    Fleet,
+    SimulatorConfig,
+    TorizonCloudSimulator,
+)
+
+logger = logging_setup.setup_logging()
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for Torizon Cloud, RAS and the devices behind it."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=8080, help="Cloud API port."
+    )
+    parser.add_argument(
+        "--devices",
+        type=int,
+        default=100,
+        help="Number of devices, spread over every PID4 of the PID4 map.",
+    )
+    parser.add_argument("--pid-map", help="PID4 map used to build the fleet.")
+    parser.add_argument(
+        "--outdated-ratio",
+        type=float,
+        default=0.5,
+        help="Fraction of devices not on the latest build.",
+    )
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of API calls answered with a 500.",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=0,
+        help="Requests per second before answering 429. 0 disables it.",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=0,
+        help="Default page size of list endpoints. 0 disables pagination.",
+    )
+    parser.add_argument("--in-flight-seconds", type=float, default=5)
+    parser.add_argument("--install-seconds", type=float, default=30)
+    parser.add_argument("--update-failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--no-ssh",
+        action="store_true",
+        help="Do not start the simulated SSH target.",
+    )
+    parser.add_argument(
+        "--ssh-port",
+        type=int,
+        default=2222,
+        help="Port of the simulated SSH target, returned by RAS sessions.",
+    )
+    parser.add_argument(
+        "--ssh-connect-delay",
+        type=float,
+        default=0.0,
+        help="Seconds the SSH target waits before each handshake.",
+    )
+    parser.add_argument(
+        "--sftp-root",
+        help="Directory served over SFTP, for testing --copy-artifact.",
+    )
+    parser.add_argument("--seed", type=int, help="Seed for reproducible runs.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    ssh_target = None
+    if not args.no_ssh:
+        # paramiko is only needed when simulating devices.
+        from simulator.ssh_target import SshTarget
+
+        ssh_target = SshTarget(
+            host=args.host,
+            port=args.ssh_port,
+            sftp_root=args.sftp_root,
+            connect_delay=args.ssh_connect_delay,
+        ).start()
+
+    config = SimulatorConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        page_size=args.page_size,
+        in_flight_seconds=args.in_flight_seconds,
+        install_seconds=args.install_seconds,
+        update_failure_rate=args.update_failure_rate,
+        ssh_port=ssh_target.port if ssh_target else None,
+        seed=args.seed,
+    )
+    fleet = Fleet(config)
+    fleet.populate(
+        args.devices,
+        pid4_map.load(args.pid_map),
+        rule_table.load_hardware_id_resolver(),
+        outdated_ratio=args.outdated_ratio,
+    )
+
+    simulator = TorizonCloudSimulator(fleet, host=args.host, port=args.port)
+
+    logger.info(
+        "Simulating %d devices on %s. Point aval at it with:",
+        len(fleet.devices),
+        simulator.base_url,
+    )
+    for name, value in simulator.environment().items():
+        logger.info("export %s=%s", name, value)
+    logger.info("export USE_RAC=true")
+    logger.info("Request statistics: %s/_sim/stats", simulator.base_url)
+
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.server_close()
+        if ssh_target:
+            ssh_target.stop()
+
+
+if __name__ == "__main__":
+    main()
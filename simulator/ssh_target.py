@@ -0,0 +1,215 @@
+import functools
+import os
+import socket
+import threading
+import time
+
+import paramiko
+
+import logging_setup
+
+logger = logging_setup.setup_logging()
+
+# Canned answers for the commands aval runs on a device, first match wins.
+# Anything else succeeds without output.
+DEFAULT_RESPONSES = [
+    (
+        "systemctl show -p ActiveEnterTimestamp",
+        "ActiveEnterTimestamp=Mon 2024-01-01 00:00:00 UTC\n",
+        0,
+    ),
+    (
+        "journalctl",
+        "aktualizr-torizon: Event: UpdateCheckComplete, Result - No updates available\n",
+        0,
+    ),
+]
+
+
+@functools.cache
+def _host_key():
+    # One host key is enough for every simulated device.
+    return paramiko.ECDSAKey.generate()
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, target):
+        self.target = target
+        self.commands = []
+        self.command_ready = threading.Event()
+
+    def check_auth_password(self, username, password):
+        if self.target.password is None or password == self.target.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        # Accept any key, as RAS does after the session was created with it.
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.commands.append((channel, command.decode(errors="replace")))
+        self.command_ready.set()
+        return True
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        return False
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.readfile.fileno())
+        )
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    """Read-only SFTP rooted at the target's `sftp_root`, for --copy-artifact."""
+
+    def __init__(self, server, *args, root=None, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _local_path(self, path):
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.stat(self._local_path(path))
+            )
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            f = open(self._local_path(path), "rb")
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        handle = _SFTPHandle(flags)
+        handle.readfile = f
+        handle.filename = path
+        return handle
+
+
+class SshTarget:
+    """A fake Torizon OS device answering aval's SSH commands.
+
+    A single target can stand in for the whole simulated fleet: every RAS
+    session created on the cloud simulator points to its port.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        password=None,
+        responses=None,
+        sftp_root=None,
+        connect_delay=0.0,
+    ):
+        self.password = password
+        self.responses = DEFAULT_RESPONSES if responses is None else responses
+        self.sftp_root = sftp_root
+        # Seconds before the handshake starts, to mimic slow RAS tunnels.
+        self.connect_delay = connect_delay
+        self.host_key = _host_key()
+        self.executed = []
+        self.connections = 0
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(100)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1]
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._accept_loop, name="ssh-target", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        # close() alone does not wake up a thread blocked in accept().
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def respond(self, command):
+        for pattern, output, exit_status in self.responses:
+            if pattern in command:
+                return output, exit_status
+        return "", 0
+
+    def _accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                client, _ = self._socket.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(
+                target=self._serve, args=(client,), daemon=True
+            ).start()
+
+    def _serve(self, client):
+        if self.connect_delay:
+            time.sleep(self.connect_delay)
+
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        if self.sftp_root:
+            transport.set_subsystem_handler(
+                "sftp", paramiko.SFTPServer, _SFTPServer, root=self.sftp_root
+            )
+
+        server = _ServerInterface(self)
+        try:
+            transport.start_server(server=server)
+            while transport.is_active() and not self._stopped.is_set():
+                if not server.command_ready.wait(timeout=0.5):
+                    continue
+                server.command_ready.clear()
+                while server.commands:
+                    channel, command = server.commands.pop(0)
+                    self._run(channel, command)
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            logger.debug("SSH target connection closed: %s", e)
+        finally:
+            transport.close()
+
+    def _run(self, channel, command):
+        self.executed.append(command)
+        output, exit_status = self.respond(command)
+        if output:
+            channel.sendall(output.encode())
+        channel.send_exit_status(exit_status)
+        channel.shutdown_write()
+        channel.close()
@@ -0,0 +1,644 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid as uuid_lib
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import logging_setup
+
+logger = logging_setup.setup_logging()
+
+AUTH_PATH = "/auth/realms/ota-users/protocol/openid-connect/token"
+API_PREFIX = "/api/v2"
+
+EXTERNAL_SOURCES = (
+    "tdx-quarterly",
+    "tdx-monthly",
+    "tdx-nightly",
+    "common-torizon-quarterly",
+    "common-torizon-monthly",
+    "common-torizon-nightly",
+)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _isoformat(dt):
+    return dt.isoformat().replace("+00:00", "Z")
+
+
+class SimulatorConfig:
+    def __init__(
+        self,
+        latency_ms=0,
+        jitter_ms=0,
+        error_rate=0.0,
+        rate_limit=0,
+        page_size=0,
+        in_flight_seconds=5,
+        install_seconds=30,
+        update_failure_rate=0.0,
+        ssh_port=None,
+        seed=None,
+    ):
+        # Delay added to every response, uniformly in latency +/- jitter.
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        # Fraction of API calls answered with a 500.
+        self.error_rate = error_rate
+        # Requests per second accepted before answering 429; 0 disables it.
+        self.rate_limit = rate_limit
+        # Default page size of list endpoints; 0 returns everything at once.
+        self.page_size = page_size
+        # Update timeline: seconds until the device picks the update up and
+        # seconds from then until it is installed.
+        self.in_flight_seconds = in_flight_seconds
+        self.install_seconds = install_seconds
+        self.update_failure_rate = update_failure_rate
+        # Port returned as the reverse port of RAS sessions, usually the one of
+        # a simulator.ssh_target.SshTarget.
+        self.ssh_port = ssh_port
+        self.random = random.Random(seed)
+
+
+class SimulatedDevice:
+    def __init__(self, device_uuid, device_id, pid4, hardware_id, build_number):
+        self.uuid = device_uuid
+        self.device_id = device_id
+        self.pid4 = pid4
+        self.hardware_id = hardware_id
+        self.build_number = build_number
+        self.installed_package = None
+        self.update = None
+        self.session = None
+
+    def to_json(self):
+        return {
+            "deviceUuid": self.uuid,
+            "deviceName": self.device_id,
+            "deviceId": self.device_id,
+            "deviceType": "Other",
+            "notes": self.pid4,
+            "createdAt": "2024-01-01T00:00:00Z",
+            "lastSeen": _isoformat(_now()),
+            "deviceStatus": "UpToDate",
+        }
+
+
+class Fleet:
+    """The simulated state of the cloud: devices, builds and updates.
+
+    Every hardware id has a single latest build number. Package names follow
+    `package_name_template` until aval asks for the latest package of a hardware
+    id, from then on the name it asked for is used.
+    """
+
+    def __init__(
+        self,
+        config,
+        latest_build_number=1000,
+        package_name_template="scarthgap/{hardware_id}/torizon/torizon-docker/nightly",
+    ):
+        self.config = config
+        self.devices = {}
+        self.latest_build_number = latest_build_number
+        self.package_name_template = package_name_template
+        self.package_names = {}
+        self._lock = threading.RLock()
+
+    def add_device(self, device_id, pid4, hardware_id, build_number=None):
+        device_uuid = str(
+            uuid_lib.UUID(int=self.config.random.getrandbits(128))
+        )
+        self.devices[device_uuid] = SimulatedDevice(
+            device_uuid,
+            device_id,
+            pid4,
+            hardware_id,
+            build_number or self.latest_build_number,
+        )
+        return self.devices[device_uuid]
+
+    def populate(
+        self, count, pid4_map, hardware_id_resolver, outdated_ratio=0.0
+    ):
+        """Adds `count` devices spread over every PID4 of the given map."""
+        pid4s = [
+            (soc, pid4)
+            for soc, soc_pid4s in pid4_map.pid4s_by_soc.items()
+            for pid4 in soc_pid4s
+        ]
+        for i in range(count):
+            soc, pid4 = pid4s[i % len(pid4s)]
+            device_id = f"{soc}-{15000000 + i:08d}-{i:06x}"
+            build_number = self.latest_build_number
+            if self.config.random.random() < outdated_ratio:
+                build_number -= 1
+            self.add_device(
+                device_id,
+                pid4,
+                hardware_id_resolver.resolve(device_id),
+                build_number,
+            )
+
+    def package_name(self, hardware_id):
+        return self.package_names.get(
+            hardware_id,
+            self.package_name_template.format(hardware_id=hardware_id),
+        )
+
+    def latest_package(self, name_contains, hardware_id):
+        if hardware_id:
+            self.package_names[hardware_id] = name_contains
+        return f"{name_contains}-{self.latest_build_number}"
+
+    def installed_package(self, device):
+        self._progress(device)
+        if device.installed_package:
+            return device.installed_package
+        return f"{self.package_name(device.hardware_id)}-{device.build_number}"
+
+    def launch_update(self, device, package_id):
+        device.update = {
+            "packageId": package_id,
+            "launched": time.monotonic(),
+            "fails": self.config.random.random()
+            < self.config.update_failure_rate,
+        }
+
+    def _progress(self, device):
+        update = device.update
+        if not update:
+            return
+
+        elapsed = time.monotonic() - update["launched"]
+        if (
+            elapsed
+            >= self.config.in_flight_seconds + self.config.install_seconds
+        ):
+            if not update["fails"]:
+                device.installed_package = update["packageId"]
+            device.update = None
+
+    def assignment(self, device):
+        self._progress(device)
+        update = device.update
+        if not update:
+            return []
+
+        elapsed = time.monotonic() - update["launched"]
+        return [
+            {
+                "correlationId": f"urn:tdx-ota:mtu:{device.uuid}",
+                "targets": {device.hardware_id: update["packageId"]},
+                "inFlight": elapsed >= self.config.in_flight_seconds,
+                "createdAt": _isoformat(_now()),
+            }
+        ]
+
+
+class RequestStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_route = {}
+        self.by_status = {}
+        self.started = time.monotonic()
+
+    def reset(self):
+        with self._lock:
+            self.by_route = {}
+            self.by_status = {}
+            self.started = time.monotonic()
+
+    def record(self, route, status):
+        with self._lock:
+            self.by_route[route] = self.by_route.get(route, 0) + 1
+            self.by_status[str(status)] = self.by_status.get(str(status), 0) + 1
+
+    def to_json(self):
+        with self._lock:
+            return {
+                "requests": dict(self.by_route),
+                "status": dict(self.by_status),
+                "total": sum(self.by_route.values()),
+                "elapsed_seconds": time.monotonic() - self.started,
+            }
+
+
+class RateLimiter:
+    """Fixed one-second window, enough to trigger 429s at a given rate."""
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self._lock = threading.Lock()
+        self._window = 0
+        self._count = 0
+
+    def allow(self):
+        if not self.per_second:
+            return True
+
+        with self._lock:
+            window = int(time.monotonic())
+            if window != self._window:
+                self._window, self._count = window, 0
+            self._count += 1
+            return self._count <= self.per_second
+
+
+# (method, path regex, handler, route template). Route templates are used for
+# the request statistics.
+ROUTES = [
+    ("POST", AUTH_PATH, "token", "POST token"),
+    ("GET", API_PREFIX + "/devices", "devices", "GET /devices"),
+    (
+        "GET",
+        API_PREFIX + "/devices/packages",
+        "device_packages",
+        "GET /devices/packages",
+    ),
+    (
+        "GET",
+        API_PREFIX + "/devices/network/(?P<uuid>[^/]+)",
+        "network",
+        "GET /devices/network/{uuid}",
+    ),
+    (
+        "GET",
+        API_PREFIX + "/devices/uptane/(?P<uuid>[^/]+)/assignment",
+        "assignment",
+        "GET /devices/uptane/{uuid}/assignment",
+    ),
+    ("POST", API_PREFIX + "/updates", "updates", "POST /updates"),
+    ("GET", API_PREFIX + "/packages", "packages", "GET /packages"),
+    (
+        "GET",
+        API_PREFIX + "/packages_external/info",
+        "external_info",
+        "GET /packages_external/info",
+    ),
+    (
+        "GET",
+        API_PREFIX + "/packages_external/refresh/(?P<source>[^/]+)",
+        "external_refresh",
+        "GET /packages_external/refresh/{source}",
+    ),
+    (
+        "HEAD",
+        "/_sim/external/(?P<source>[^/]+)",
+        "external_source",
+        "HEAD external source",
+    ),
+    (
+        "GET",
+        API_PREFIX + "/remote-access/device/(?P<uuid>[^/]+)/sessions",
+        "get_session",
+        "GET /remote-access/device/{uuid}/sessions",
+    ),
+    (
+        "POST",
+        API_PREFIX + "/remote-access/device/(?P<uuid>[^/]+)/sessions",
+        "create_session",
+        "POST /remote-access/device/{uuid}/sessions",
+    ),
+    (
+        "DELETE",
+        API_PREFIX + "/remote-access/device/(?P<uuid>[^/]+)/sessions",
+        "delete_session",
+        "DELETE /remote-access/device/{uuid}/sessions",
+    ),
+    ("GET", "/_sim/stats", "stats", None),
+    ("POST", "/_sim/reset", "reset", None),
+]
+
+_COMPILED_ROUTES = [
+    (method, re.compile(pattern + "/?"), handler, route)
+    for method, pattern, handler, route in ROUTES
+]
+
+
+class SimulatorError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("simulator: " + format, *args)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def do_HEAD(self):
+        self._dispatch("HEAD")
+
+    def _dispatch(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        # Repeated parameters, like deviceUuid, are in query_lists.
+        self.query_lists = parse_qs(url.query)
+        self.query = {k: v[-1] for k, v in self.query_lists.items()}
+
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+
+        for route_method, pattern, handler, route in _COMPILED_ROUTES:
+            match = pattern.fullmatch(url.path)
+            if route_method == method and match:
+                break
+        else:
+            self._respond(404, {"description": f"No route {method} {url.path}"})
+            return
+
+        if route is None:
+            # Simulator control endpoints: no latency, errors or statistics.
+            status, payload, headers = getattr(self, "_" + handler)(
+                **match.groupdict()
+            )
+            self._respond(status, payload, headers)
+            return
+
+        config = server.fleet.config
+        delay = config.latency_ms + config.random.uniform(
+            -config.jitter_ms, config.jitter_ms
+        )
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        try:
+            if not server.rate_limiter.allow():
+                raise SimulatorError(
+                    429, "Too many requests", {"Retry-After": "1"}
+                )
+            if url.path.startswith(API_PREFIX):
+                self._check_token()
+            if config.random.random() < config.error_rate:
+                raise SimulatorError(500, "Injected error")
+
+            with server.fleet._lock:
+                status, payload, headers = getattr(self, "_" + handler)(
+                    **match.groupdict()
+                )
+        except SimulatorError as e:
+            status, payload, headers = (
+                e.status,
+                {"description": str(e)},
+                e.headers,
+            )
+
+        if method == "GET" and status == 200:
+            digest = hashlib.sha256(
+                json.dumps(payload, sort_keys=True).encode()
+            ).hexdigest()
+            etag = f'"{digest[:16]}"'
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get("If-None-Match") == etag:
+                status, payload = 304, None
+
+        server.stats.record(route, status)
+        self._respond(status, payload, headers)
+
+    def _respond(self, status, payload, headers=None):
+        data = b"" if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if payload is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _check_token(self):
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Bearer ") or auth[7:] not in self.server.tokens:
+            raise SimulatorError(401, "Invalid or missing bearer token")
+
+    def _json_body(self):
+        try:
+            return json.loads(self.body or b"{}")
+        except ValueError:
+            raise SimulatorError(400, "Invalid JSON body")
+
+    def _device(self, device_uuid):
+        device = self.server.fleet.devices.get(device_uuid)
+        if device is None:
+            raise SimulatorError(404, f"Device {device_uuid} not found")
+        return device
+
+    def _paginate(self, values):
+        offset = int(self.query.get("offset", 0))
+        limit = (
+            int(self.query.get("limit", 0))
+            or self.server.fleet.config.page_size
+        )
+        page = values[offset:]
+        if limit:
+            page = page[:limit]
+        return {
+            "values": page,
+            "total": len(values),
+            "offset": offset,
+            "limit": limit or len(values),
+        }
+
+    # Cloud endpoints
+
+    def _token(self):
+        token = f"sim-{uuid_lib.uuid4().hex}"
+        self.server.tokens.add(token)
+        return 200, {"access_token": token, "expires_in": 300}, None
+
+    def _devices(self):
+        devices = [d.to_json() for d in self.server.fleet.devices.values()]
+        return 200, self._paginate(devices), None
+
+    def _device_packages(self):
+        fleet = self.server.fleet
+        if "deviceUuid" in self.query:
+            devices = [
+                self._device(device_uuid)
+                for device_uuid in self.query_lists["deviceUuid"]
+            ]
+        else:
+            devices = list(fleet.devices.values())
+
+        values = [
+            {
+                "deviceUuid": device.uuid,
+                "installedPackages": [
+                    {
+                        "component": device.hardware_id,
+                        "installed": {
+                            "packageId": fleet.installed_package(device)
+                        },
+                    }
+                ],
+            }
+            for device in devices
+        ]
+        return 200, self._paginate(values), None
+
+    def _network(self, uuid):
+        device = self._device(uuid)
+        return (
+            200,
+            {
+                "deviceUuid": device.uuid,
+                "localIpV4": "127.0.0.1",
+                "hostname": device.device_id,
+                "macAddress": "00:00:00:00:00:00",
+            },
+            None,
+        )
+
+    def _assignment(self, uuid):
+        device = self._device(uuid)
+        return 200, self.server.fleet.assignment(device), None
+
+    def _updates(self):
+        body = self._json_body()
+        package_ids = body.get("packageIds") or []
+        if len(package_ids) != 1 or not body.get("devices"):
+            raise SimulatorError(400, "Expected one packageId and devices")
+
+        devices = [self._device(device_uuid) for device_uuid in body["devices"]]
+        for device in devices:
+            self.server.fleet.launch_update(device, package_ids[0])
+
+        return 201, {"updateId": str(uuid_lib.uuid4())}, None
+
+    def _packages(self):
+        name_contains = self.query.get("nameContains", "")
+        values = []
+        if name_contains:
+            values.append(
+                {
+                    "packageId": self.server.fleet.latest_package(
+                        name_contains, self.query.get("hardwareIds")
+                    ),
+                    "hardwareIds": [self.query.get("hardwareIds")],
+                }
+            )
+        return 200, self._paginate(values), None
+
+    def _external_info(self):
+        base = f"http://{self.headers.get('Host')}"
+        return (
+            200,
+            {
+                source: {
+                    "remoteUri": f"{base}/_sim/external/{source}",
+                    "lastFetched": _isoformat(self.server.started_at),
+                }
+                for source in EXTERNAL_SOURCES
+            },
+            None,
+        )
+
+    def _external_refresh(self, source):
+        return 200, None, None
+
+    def _external_source(self, source):
+        last_modified = self.server.started_at - timedelta(hours=1)
+        return (
+            200,
+            None,
+            {"Last-Modified": format_datetime(last_modified, usegmt=True)},
+        )
+
+    # Remote access endpoints
+
+    def _get_session(self, uuid):
+        device = self._device(uuid)
+        if not device.session:
+            raise SimulatorError(404, f"No session for {uuid}")
+        return 200, {"ssh": device.session}, None
+
+    def _create_session(self, uuid):
+        device = self._device(uuid)
+        if device.session:
+            raise SimulatorError(409, "Session already exists")
+
+        port = self.server.fleet.config.ssh_port or 22
+        device.session = {
+            "reversePort": port,
+            "expiresAt": _isoformat(_now() + timedelta(hours=12)),
+        }
+        return 201, None, None
+
+    def _delete_session(self, uuid):
+        self._device(uuid).session = None
+        return 200, None, None
+
+    # Simulator control endpoints
+
+    def _stats(self):
+        return 200, self.server.stats.to_json(), None
+
+    def _reset(self):
+        self.server.stats.reset()
+        return 200, None, None
+
+
+class TorizonCloudSimulator(ThreadingHTTPServer):
+    """Local stand-in for app.torizon.io, kc.torizon.io and ras.torizon.io."""
+
+    daemon_threads = True
+
+    def __init__(self, fleet, host="127.0.0.1", port=0):
+        super().__init__((host, port), _Handler)
+        self.fleet = fleet
+        self.stats = RequestStats()
+        self.rate_limiter = RateLimiter(fleet.config.rate_limit)
+        self.tokens = set()
+        self.started_at = _now().replace(microsecond=0)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def environment(self):
+        """Environment variables pointing aval at this simulator."""
+        return {
+            "TORIZON_API_BASE_URL": self.base_url + API_PREFIX,
+            "TORIZON_AUTH_URL": self.base_url + AUTH_PATH,
+            "TORIZON_RAS_HOST": self.server_address[0],
+        }
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever,
+            kwargs={"poll_interval": 0.1},
+            name="torizon-cloud-simulator",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join(timeout=5)
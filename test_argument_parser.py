@@ -0,0 +1,29 @@
+import io
+import unittest
+from contextlib import redirect_stderr
+from unittest.mock import patch
+
+import argument_parser
+
+
+class TestArgumentParser(unittest.TestCase):
+    def parse(self, *argv):
+        with patch("sys.argv", ["main.py", *argv]):
+            return argument_parser.parse_arguments()
+
+    def test_warm_concurrency(self):
+        self.assertEqual(self.parse().warm_concurrency, 4)
+        self.assertEqual(
+            self.parse("--warm-concurrency", "8").warm_concurrency, 8
+        )
+
+    def test_warm_concurrency_must_be_positive(self):
+        for value in ("0", "-2", "many"):
+            with self.subTest(value=value), redirect_stderr(io.StringIO()):
+                with self.assertRaises(SystemExit) as context:
+                    self.parse("--warm-concurrency", value)
+                self.assertEqual(context.exception.code, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,292 @@
+import asyncio
+import gzip
+import json
+import os
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import async_http
+    import http_wrapper
+    import rate_limit
+
+
+def response(status=200, body=b"{}", headers=None):
+    headers = {"Content-Length": str(len(body)), **(headers or {})}
+    head = f"HTTP/1.1 {status} Reason\r\n" + "".join(
+        f"{name}: {value}\r\n" for name, value in headers.items()
+    )
+    return head.encode() + b"\r\n" + body
+
+
+class ScriptedServer:
+    """Answers each request with the next of `responses`.
+
+    A response may be a callable, given the request line, headers and body.
+    With `close_after`, connections are closed after that many requests,
+    without telling the client.
+    """
+
+    def __init__(self, responses, close_after=None):
+        self.responses = list(responses)
+        self.close_after = close_after
+        self.requests = []
+        self.connections = 0
+        self.open_connections = 0
+        self.max_open_connections = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        self.open_connections += 1
+        self.max_open_connections = max(
+            self.max_open_connections, self.open_connections
+        )
+        try:
+            served = 0
+            while self.close_after is None or served < self.close_after:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) != b"\r\n":
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get("content-length", 0))
+                )
+                self.requests.append((request_line.decode(), headers, body))
+
+                res = self.responses.pop(0)
+                if callable(res):
+                    res = await res(request_line, headers, body)
+                writer.write(res)
+                await writer.drain()
+                served += 1
+        finally:
+            self.open_connections -= 1
+            writer.close()
+
+
+class AsyncHttpTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        for name in ("async_http.logger", "http_wrapper.logger"):
+            patcher = patch(name)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        patcher_env = patch.dict(os.environ, {}, clear=True)
+        self.addCleanup(patcher_env.stop)
+        patcher_env.start()
+
+        http_wrapper.reset()
+        self.addCleanup(http_wrapper.reset)
+        rate_limit.reset()
+        self.addCleanup(rate_limit.reset)
+
+    async def asyncSetUp(self):
+        self.addAsyncCleanup(async_http.pool().close)
+
+    async def serve(self, responses, **kwargs):
+        server = await ScriptedServer(responses, **kwargs).start()
+        self.addAsyncCleanup(server.stop)
+        return server
+
+    def pool(self, **kwargs):
+        pool = async_http.ConnectionPool(**kwargs)
+        self.addAsyncCleanup(pool.close)
+        return pool
+
+
+class TestConnectionPool(AsyncHttpTestCase):
+    async def test_connections_are_kept_alive(self):
+        server = await self.serve([response(body=b'{"a": 1}')] * 3)
+        pool = self.pool()
+
+        responses = [
+            await pool.request("get", server.url + "/devices?limit=1")
+            for _ in range(3)
+        ]
+
+        self.assertEqual([r.json() for r in responses], [{"a": 1}] * 3)
+        self.assertEqual(
+            [r.connection_reused for r in responses], [False, True, True]
+        )
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(
+            server.requests[0][0], "GET /devices?limit=1 HTTP/1.1\r\n"
+        )
+
+    async def test_request_bodies(self):
+        server = await self.serve([response(status=201)] * 2)
+        pool = self.pool()
+
+        await pool.request("post", server.url + "/updates", json={"a": 1})
+        await pool.request(
+            "post", server.url + "/token", data={"grant_type": "x"}
+        )
+
+        (_, headers, body), (_, form_headers, form) = server.requests
+        self.assertEqual(json.loads(body), {"a": 1})
+        self.assertEqual(headers["content-type"], "application/json")
+        self.assertEqual(form, b"grant_type=x")
+        self.assertEqual(
+            form_headers["content-type"], "application/x-www-form-urlencoded"
+        )
+
+    async def test_chunked_and_compressed_responses(self):
+        body = gzip.compress(b'{"values": []}')
+        chunked = (
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n"
+            b"Content-Encoding: gzip\r\n\r\n"
+            + b"".join(
+                b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                for chunk in (body[:10], body[10:])
+            )
+            + b"0\r\n\r\n"
+        )
+        server = await self.serve([chunked, response()])
+        pool = self.pool()
+
+        res = await pool.request("get", server.url + "/devices")
+        await pool.request("get", server.url + "/devices")
+
+        self.assertEqual(res.json(), {"values": []})
+        self.assertEqual(server.connections, 1)
+
+    async def test_connections_closed_by_the_server_are_replaced(self):
+        server = await self.serve(
+            [response(), response(body=b'{"b": 2}')], close_after=1
+        )
+        pool = self.pool()
+
+        await pool.request("get", server.url + "/devices")
+        await asyncio.sleep(0.05)
+        # As if the close wasn't noticed before sending the next request.
+        with patch.object(async_http._Connection, "usable", return_value=True):
+            res = await pool.request("get", server.url + "/devices")
+
+        self.assertEqual(res.json(), {"b": 2})
+        self.assertFalse(res.connection_reused)
+        self.assertEqual(server.connections, 2)
+
+    async def test_connection_close_is_honored(self):
+        server = await self.serve(
+            [response(headers={"Connection": "close"}), response()]
+        )
+        pool = self.pool()
+
+        await pool.request("get", server.url + "/devices")
+        res = await pool.request("get", server.url + "/devices")
+
+        self.assertFalse(res.connection_reused)
+        self.assertEqual(server.connections, 2)
+
+    async def test_concurrent_requests_share_a_few_connections(self):
+        async def slow_response(*_):
+            await asyncio.sleep(0.01)
+            return response()
+
+        server = await self.serve([slow_response] * 50)
+        pool = self.pool(max_connections=4)
+
+        await asyncio.gather(
+            *(pool.request("get", server.url + "/devices") for _ in range(50))
+        )
+
+        self.assertEqual(len(server.requests), 50)
+        self.assertEqual(server.connections, 4)
+        self.assertEqual(server.max_open_connections, 4)
+
+    async def test_unreachable_hosts_are_not_sent_to(self):
+        server = await self.serve([])
+        url = server.url
+        await server.stop()
+
+        with self.assertRaises(requests.exceptions.ConnectionError) as context:
+            await self.pool().request("post", url + "/updates", json={})
+
+        self.assertTrue(http_wrapper._not_sent(context.exception))
+
+    async def test_read_timeout(self):
+        async def no_response(*_):
+            await asyncio.sleep(1)
+            return response()
+
+        server = await self.serve([no_response])
+
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            await self.pool(read_timeout=0.05).request(
+                "get", server.url + "/devices"
+            )
+
+
+class TestEndpointCall(AsyncHttpTestCase):
+    async def test_errors_are_retried_and_recorded(self):
+        server = await self.serve(
+            [response(status=502), response(body=b'{"a": 1}')]
+        )
+
+        res = await async_http.endpoint_call(
+            server.url + "/api/v2/devices",
+            "get",
+            retry=http_wrapper.RetryPolicy(backoff=0),
+        )
+
+        self.assertEqual(res.json(), {"a": 1})
+        self.assertEqual(
+            [
+                (r["status"], r["retry"], r["connection_reused"])
+                for r in http_wrapper.records()
+            ],
+            [(502, False, False), (200, True, True)],
+        )
+
+    async def test_client_errors_are_raised(self):
+        server = await self.serve([response(status=404)])
+
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            await async_http.endpoint_call(server.url + "/api/v2/x", "get")
+
+        self.assertEqual(context.exception.response.status_code, 404)
+        self.assertEqual(len(server.requests), 1)
+
+    async def test_throttling_pauses_the_bucket(self):
+        server = await self.serve(
+            [response(status=429, headers={"Retry-After": "0.05"}), response()]
+        )
+        bucket = rate_limit.bucket()
+
+        with patch.object(bucket, "pause", wraps=bucket.pause) as mock_pause:
+            res = await async_http.endpoint_call(
+                server.url + "/api/v2/devices", "get"
+            )
+
+        self.assertEqual(res.status_code, 200)
+        mock_pause.assert_called_once_with(0.05)
+
+    async def test_each_event_loop_has_its_own_pool(self):
+        self.assertIs(async_http.pool(), async_http.pool())
+
+        other = await asyncio.to_thread(lambda: asyncio.run(_current_pool()))
+
+        self.assertIsNot(other, async_http.pool())
+
+
+async def _current_pool():
+    return async_http.pool()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import pid4_map
+    import rule_table
+    from benchmarks import acquisition, lock_contention
+    from simulator.torizon_cloud import Fleet, SimulatorConfig
+
+
+class TestAcquisitionBenchmark(unittest.TestCase):
+    def test_summarize_keeps_medians(self):
+        runs = [
+            {"wall_time_seconds": 3.0, "api_calls_by_route": {"GET": 1}},
+            {"wall_time_seconds": 1.0, "api_calls_by_route": {"GET": 1}},
+            {"wall_time_seconds": 2.0, "api_calls_by_route": {"GET": 1}},
+        ]
+
+        summary = acquisition.summarize(runs)
+
+        self.assertEqual(summary["wall_time_seconds"], 2.0)
+        self.assertEqual(summary["api_calls_by_route"], {"GET": 1})
+        self.assertEqual(summary["runs"], 3)
+
+    def test_compare_flags_regressions_over_tolerance(self):
+        baseline = {
+            "fleets": {
+                "10": {
+                    "wall_time_seconds": 1.0,
+                    "api_calls_per_device": 0.5,
+                },
+                "100": {"wall_time_seconds": 1.0},
+            }
+        }
+        results = {
+            "fleets": {
+                "10": {
+                    "wall_time_seconds": 1.1,
+                    "api_calls_per_device": 1.0,
+                },
+                "1000": {"wall_time_seconds": 5.0},
+            }
+        }
+
+        lines, regressions = acquisition.compare(results, baseline, 0.2)
+
+        self.assertEqual(regressions, [("10", "api_calls_per_device")])
+        self.assertEqual(len(lines), 2)
+
+    def test_candidates_follow_aval_matching(self):
+        pid_map = pid4_map.load()
+        fleet = Fleet(SimulatorConfig(seed=1))
+        fleet.populate(50, pid_map, rule_table.load_hardware_id_resolver())
+
+        candidates = acquisition.candidate_uuids(fleet, pid_map, "arm64")
+
+        arm64 = set(pid_map.pid4s_for_architecture("arm64", False))
+        self.assertTrue(candidates)
+        for device in fleet.devices.values():
+            self.assertEqual(device.uuid in candidates, device.pid4 in arm64)
+
+
+class TestLockContentionHarness(unittest.TestCase):
+    def test_jain_index(self):
+        self.assertEqual(lock_contention.jain_index([3, 3, 3]), 1.0)
+        self.assertEqual(lock_contention.jain_index([4, 0, 0, 0]), 0.25)
+        self.assertEqual(lock_contention.jain_index([]), 1.0)
+
+    def test_idle_device_seconds_counts_free_boards_while_waiting(self):
+        acquisitions = [
+            # Holds the only board from 0 to 10.
+            {"requested": 0, "acquired": 0, "released": 10},
+            # Waits from 5, but only gets the board 2 seconds after release.
+            {"requested": 5, "acquired": 12, "released": 15},
+        ]
+
+        self.assertEqual(
+            lock_contention.idle_device_seconds(acquisitions, 1), 2
+        )
+
+    def test_percentiles(self):
+        waits = lock_contention.percentiles([float(i) for i in range(101)])
+
+        self.assertEqual(waits["p50"], 50)
+        self.assertEqual(waits["p99"], 99)
+        self.assertEqual(waits["max"], 100)
+        self.assertEqual(lock_contention.percentiles([])["p50"], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
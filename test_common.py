@@ -1,7 +1,10 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
 
 with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import common
     from common import parse_device_id, parse_hardware_id
 
 device_id_dict = {
@@ -20,6 +23,9 @@ hardware_id_dict = {
     "colibri-imx8x-07203041-b5464c": "colibri-imx8x",
     "colibri-imx7-emmc-15149329-6f39ce": "colibri-imx7-emmc",
     "colibri-imx6-15054304-e259ec": "colibri-imx6",
+    "imx93frdm-15054304-e259ec": "imx93frdm",
+    "torizon-x86-15054304-e259ec": "intel-corei7-64",
+    "torizon-sl1680-15054304-e259ec": "sl1680",
 }
 
 
@@ -33,3 +39,40 @@ class TestCommon(unittest.TestCase):
         for device_id, expected in hardware_id_dict.items():
             with self.subTest(device_id=device_id):
                 self.assertEqual(parse_hardware_id(device_id), expected)
+
+    @patch("common.logger")
+    def test_parse_hardware_ids_skips_devices_no_rule_fits(self, mock_logger):
+        devices = [
+            {
+                "deviceUuid": "uuid1",
+                "deviceId": "verdin-imx8mm-07214001-9334fa",
+            },
+            {"deviceUuid": "uuid2", "deviceId": "labpc"},
+            {"deviceUuid": "uuid3", "deviceId": "colibri-imx6-15054304-e259ec"},
+        ]
+
+        self.assertEqual(
+            common.parse_hardware_ids(devices),
+            {"uuid1": "verdin-imx8mm", "uuid3": "colibri-imx6"},
+        )
+        mock_logger.error.assert_called_once()
+
+    def test_atomic_write(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cache.json")
+            common.atomic_write(path, "old")
+            common.atomic_write(path, "new")
+
+            with open(path) as f:
+                self.assertEqual(f.read(), "new")
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            self.assertEqual(os.listdir(tmp_dir), ["cache.json"])
+
+    def test_atomic_write_leaves_nothing_behind_on_errors(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "cache.json")
+            with patch("common.os.replace", side_effect=OSError("EXDEV")):
+                with self.assertRaises(OSError):
+                    common.atomic_write(path, "new")
+
+            self.assertEqual(os.listdir(tmp_dir), [])
@@ -19,7 +19,7 @@ pid4_map_data = {
 mock_toml_data = """
 [soc_udt]
 soc_udt_name = "verdin-imx8mp"
-soc_properties = ["soc_npu", "soc_gpu"]
+soc_properties = ["soc_npu", "!soc_gpu"]
 """
 
 mock_yaml_data = """
@@ -44,6 +44,46 @@ class TestConvolute(unittest.TestCase):
         result = convolute.get_pid4_list(soc, pid4_map_data)
         self.assertEqual(result, expected_pid4_list)
 
+    def test_get_pid4_list_from_architecture(self):
+        pid4_map = {
+            "verdin-imx8mp": {
+                "pid4": [
+                    {
+                        "id": "0058",
+                        "architecture": "arm64",
+                        "common_device": False,
+                    },
+                    {
+                        "id": "0063",
+                        "architecture": "arm64",
+                        "common_device": True,
+                    },
+                ]
+            },
+            "colibri-imx6": {
+                "pid4": [
+                    {
+                        "id": "0014",
+                        "architecture": "arm",
+                        "common_device": False,
+                    },
+                ]
+            },
+        }
+
+        self.assertEqual(
+            convolute.get_pid4_list_from_architecture("arm64", pid4_map, False),
+            ["0058"],
+        )
+        self.assertEqual(
+            convolute.get_pid4_list_from_architecture("arm64", pid4_map, True),
+            ["0063"],
+        )
+        self.assertEqual(
+            convolute.get_pid4_list_from_architecture("x86", pid4_map, False),
+            [],
+        )
+
     def test_get_pid4_list_with_device_config(self):
         device_config_data = toml.loads(mock_toml_data)
         pid4_map_data_loaded = yaml.safe_load(mock_yaml_data)
@@ -52,13 +92,72 @@ class TestConvolute(unittest.TestCase):
             device_config_data
         )
 
-        expected_pid4_list = [1, 3]
+        # pid4 2 has no soc_gpu at all, so it is not known to lack a GPU.
+        expected_pid4_list = [1]
 
         result = convolute.get_pid4_list_with_device_config(
             (soc_udt, soc_properties), pid4_map_data_loaded
         )
         self.assertEqual(result, expected_pid4_list)
 
+    def test_get_pid4_list_with_device_config_checks_values(self):
+        # Every entry has a soc_npu key, only the ones where it is true match.
+        result = convolute.get_pid4_list_with_device_config(
+            ("verdin-imx8mp", ["soc_npu"]), pid4_map_data
+        )
+        self.assertEqual(result, [1, 2])
+
+    def test_get_pid4_list_with_device_config_table(self):
+        pid4_map = {
+            "verdin-imx8mp": {
+                "pid4": [
+                    {"id": "0058", "soc_npu": False, "ram_mb": 2048},
+                    {"id": "0063", "soc_npu": True, "ram_mb": 4096},
+                    {"id": "0070", "soc_npu": True, "ram_mb": 8192},
+                ]
+            },
+            "verdin-am62": {
+                "pid4": [
+                    {"id": "0073", "soc_npu": False, "ram_mb": 1024},
+                ]
+            },
+        }
+
+        cases = [
+            ({"soc_npu": True}, ["0063", "0070"]),
+            ({"soc_npu": {"not": True}}, ["0058"]),
+            ({"ram_mb": {"min": 4096}}, ["0063", "0070"]),
+            ({"ram_mb": {"min": 2048, "max": 4096}}, ["0058", "0063"]),
+            ({"soc_npu": True, "ram_mb": {"max": 4096}}, ["0063"]),
+            ({"soc_vpu": True}, []),
+        ]
+        for soc_properties, expected in cases:
+            with self.subTest(soc_properties=soc_properties):
+                result = convolute.get_pid4_list_with_device_config(
+                    ("verdin-imx8mp", soc_properties), pid4_map
+                )
+                self.assertEqual(result, expected)
+
+        # Without a SoC name all SoCs are considered
+        result = convolute.get_pid4_list_with_device_config(
+            (None, {"ram_mb": {"max": 2048}}), pid4_map
+        )
+        self.assertEqual(result, ["0058", "0073"])
+
+    def test_parse_soc_properties_invalid(self):
+        for soc_properties in (["!"], [1], {"ram_mb": {"above": 1}}):
+            with self.subTest(soc_properties=soc_properties):
+                with self.assertRaises(ValueError):
+                    convolute.parse_soc_properties(soc_properties)
+
+    def test_get_device_config_data_without_soc(self):
+        device_config = toml.loads('[soc_udt]\nsoc_properties = ["soc_npu"]\n')
+
+        self.assertEqual(
+            convolute.get_device_config_data(device_config),
+            (None, ["soc_npu"]),
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -103,13 +103,13 @@ class TestDatabase(unittest.TestCase):
         result = database.acquire_lock("5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE")
         self.assertTrue(result)
 
-        self.assertIsNotNone(database._heartbeat_thread)
-        self.assertTrue(database._heartbeat_thread.is_alive())
+        heartbeat_thread, stop_event = database._heartbeats.pop(
+            "5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE"
+        )
+        self.assertTrue(heartbeat_thread.is_alive())
 
-        database._heartbeat_stop_event.set()
-        database._heartbeat_thread.join(timeout=2)
-        database._heartbeat_thread = None
-        database._heartbeat_stop_event = None
+        stop_event.set()
+        heartbeat_thread.join(timeout=2)
 
     @patch("database.get_db_connection")
     def test_release_lock_stops_heartbeat_thread(self, mock_get_db_connection):
@@ -118,11 +118,14 @@ class TestDatabase(unittest.TestCase):
         mock_get_db_connection.return_value.__enter__.return_value = mock_conn
         mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
 
-        database._heartbeat_stop_event = threading.Event()
-        database._heartbeat_thread = threading.Thread(
+        heartbeat_thread = threading.Thread(
             target=lambda: time.sleep(1), daemon=True
         )
-        database._heartbeat_thread.start()
+        database._heartbeats["5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE"] = (
+            heartbeat_thread,
+            threading.Event(),
+        )
+        heartbeat_thread.start()
 
         database.release_lock("5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE")
 
@@ -131,8 +134,92 @@ class TestDatabase(unittest.TestCase):
             ("5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE",),
         )
 
-        self.assertIsNone(database._heartbeat_thread)
-        self.assertIsNone(database._heartbeat_stop_event)
+        self.assertNotIn(
+            "5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE", database._heartbeats
+        )
+
+    def test_circuit_cooldown_doubles_up_to_a_day(self):
+        with patch.multiple(
+            "database",
+            CIRCUIT_FAILURE_THRESHOLD=2,
+            CIRCUIT_COOLDOWN_SECONDS=1800,
+        ):
+            self.assertEqual(database.circuit_cooldown(1), 0)
+            self.assertEqual(database.circuit_cooldown(2), 1800)
+            self.assertEqual(database.circuit_cooldown(4), 7200)
+            self.assertEqual(database.circuit_cooldown(20), 24 * 60 * 60)
+
+    @patch("database.get_db_connection")
+    def test_record_connection_failure_opens_the_circuit(
+        self, mock_get_db_connection
+    ):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_db_connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = (
+            database.CIRCUIT_FAILURE_THRESHOLD,
+        )
+
+        database.record_connection_failure(
+            "5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE", "Connection test failed"
+        )
+
+        self.assertEqual(mock_cursor.execute.call_count, 2)
+        self.assertTrue(
+            mock_cursor.execute.call_args.args[0].startswith(
+                "UPDATE devices SET circuit"
+            )
+        )
+        self.assertEqual(
+            mock_cursor.execute.call_args.args[1],
+            (
+                database.CIRCUIT_COOLDOWN_SECONDS,
+                "5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE",
+            ),
+        )
+        mock_conn.commit.assert_called_once()
+
+    @patch("database.get_db_connection")
+    def test_a_single_failure_keeps_the_circuit_closed(
+        self, mock_get_db_connection
+    ):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_db_connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = (1,)
+
+        with patch("database.CIRCUIT_FAILURE_THRESHOLD", 2):
+            database.record_connection_failure(
+                "5B76B5C7-FCCD-4FCD-A100-0CE33E8DCDFE", "Connection test failed"
+            )
+
+        mock_cursor.execute.assert_called_once()
+
+    @patch("database.get_db_connection")
+    def test_open_circuits(self, mock_get_db_connection):
+        mock_conn = MagicMock()
+        mock_cursor = MagicMock()
+        mock_get_db_connection.return_value.__enter__.return_value = mock_conn
+        mock_conn.cursor.return_value.__enter__.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [("uuid2",)]
+
+        self.assertEqual(database.open_circuits(["uuid1", "uuid2"]), {"uuid2"})
+        self.assertEqual(
+            mock_cursor.execute.call_args.args[1], (["uuid1", "uuid2"],)
+        )
+        self.assertEqual(database.open_circuits([]), set())
+        mock_get_db_connection.assert_called_once()
+
+    @patch("database.get_db_connection")
+    def test_open_circuits_survives_database_errors(
+        self, mock_get_db_connection
+    ):
+        mock_get_db_connection.side_effect = Exception("column does not exist")
+
+        self.assertEqual(database.open_circuits(["uuid1"]), set())
+        self.logger.error.assert_called_once()
 
     @patch("database.logger")
     @patch("database.shutdown_database_access")
@@ -1,8 +1,14 @@
 import unittest
 from unittest.mock import MagicMock, patch
 
+import requests
+
+from simulator.fake_clock import FakeClock
+
 with patch("logging_setup.setup_logging", return_value=MagicMock()):
     from device import Device
+    import timeline
+    import update_progress
 
 max_attempts = 10
 
@@ -118,6 +124,166 @@ class TestDeviceGetCurrentBuild(unittest.TestCase):
             max_attempts,
         )
 
+    @patch("time.sleep", return_value=None)
+    def test_get_current_build_request_errors_are_not_retried_again(self, _):
+        self.mock_cloud_api.get_package_metadata_for_device.side_effect = (
+            requests.exceptions.ConnectionError("Connection reset by peer")
+        )
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.device.get_current_build()
+
+        self.mock_cloud_api.get_package_metadata_for_device.assert_called_once()
+
+
+class TestDeviceSetupRacSession(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("device.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        self.mock_cloud_api = MagicMock()
+        with patch.object(Device, "_get_network_info", return_value=None):
+            self.device = Device(
+                cloud_api=self.mock_cloud_api,
+                uuid="device-uuid-1234",
+                hardware_id="component-x",
+                env_vars={
+                    "DEVICE_PASSWORD": "pass",
+                    "PUBLIC_KEY": "ssh-rsa AAAAB3Nza...",
+                    "USE_RAC": True,
+                },
+            )
+
+    def test_cloud_errors_are_not_connection_errors(self):
+        response = requests.Response()
+        response.status_code = 400
+        error = requests.exceptions.HTTPError(
+            "400 Client Error", response=response
+        )
+        self.mock_cloud_api.get_remote_session.side_effect = error
+
+        with self.assertRaises(requests.exceptions.HTTPError) as context:
+            self.device.setup_rac_session("ras.torizon.io")
+
+        self.assertIs(context.exception, error)
+        self.assertNotIsInstance(context.exception, ConnectionError)
+
+    def test_setup_rac_session(self):
+        self.mock_cloud_api.get_remote_session.side_effect = [
+            {},
+            {"ssh": {"reversePort": 2222, "expiresAt": "2026-10-19T18:00:00Z"}},
+        ]
+
+        self.device.setup_rac_session("ras.torizon.io")
+
+        self.mock_cloud_api.create_remote_session.assert_called_once_with(
+            "device-uuid-1234", "ssh-rsa AAAAB3Nza..."
+        )
+        self.mock_cloud_api.delete_remote_session.assert_not_called()
+        self.assertEqual(self.device.remote_session_ip, "ras.torizon.io")
+        self.assertEqual(self.device.remote_session_port, 2222)
+
+
+class TestDeviceUpdateToLatest(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("device.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        timeline.reset()
+        self.addCleanup(timeline.reset)
+
+        with patch.object(Device, "_get_network_info", return_value=None):
+            self.device = Device(
+                cloud_api=MagicMock(),
+                uuid="device-uuid-1234",
+                hardware_id="component-x",
+                env_vars={
+                    "DEVICE_PASSWORD": "pass",
+                    "PUBLIC_KEY": "ssh-rsa AAAAB3Nza...",
+                    "USE_RAC": False,
+                },
+            )
+        self.device.connection = MagicMock()
+
+    @patch("device.update_progress.UpdateProgress")
+    def test_fuse_removal_span(self, mock_UpdateProgress):
+        def run(on_installing):
+            on_installing()
+            return update_progress.VERIFIED
+
+        mock_UpdateProgress.return_value.run.side_effect = run
+        mock_UpdateProgress.return_value.current_build = None
+
+        self.assertTrue(
+            self.device.update_to_latest(
+                "nightly",
+                ignore_different_secondaries_between_updates=True,
+                launched=True,
+            )
+        )
+
+        update, fuse_removal = timeline.spans()
+        self.assertEqual(
+            (update.name, fuse_removal.name), ("update", "fuse_removal")
+        )
+        self.assertEqual(fuse_removal.parent_id, update.span_id)
+        self.device.connection.run.assert_called_once()
+
+
+class TestDeviceWaitUntilReachable(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("device.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        self.clock = FakeClock()
+        patcher_time = patch("device.time", self.clock)
+        self.addCleanup(patcher_time.stop)
+        patcher_time.start()
+
+        with patch.object(
+            Device, "_get_network_info", return_value={"localIpV4": "127.0.0.1"}
+        ):
+            self.device = Device(
+                cloud_api=MagicMock(),
+                uuid="device-uuid-1234",
+                hardware_id="component-x",
+                env_vars={"DEVICE_PASSWORD": "pass", "PUBLIC_KEY": "ssh-rsa"},
+            )
+        self.device.remote_session_ip = "127.0.0.1"
+        self.device.remote_session_port = "22"
+        self.device.connection = MagicMock()
+
+    @patch("device.socket.create_connection")
+    def test_reachable_once_the_port_and_ssh_answer(self, mock_connect):
+        mock_connect.side_effect = [
+            ConnectionRefusedError(),
+            ConnectionRefusedError(),
+            MagicMock(),
+            MagicMock(),
+        ]
+        self.device.connection.open.side_effect = [
+            Exception("Error reading SSH protocol banner"),
+            None,
+        ]
+
+        self.assertTrue(self.device.wait_until_reachable())
+
+        self.assertEqual(self.clock.sleeps, [1, 2, 4])
+        mock_connect.assert_called_with(("127.0.0.1", 22), timeout=5)
+
+    @patch(
+        "device.socket.create_connection", side_effect=ConnectionRefusedError()
+    )
+    def test_gives_up_at_the_deadline(self, _):
+        self.assertFalse(self.device.wait_until_reachable(deadline=100))
+
+        self.assertEqual(self.clock.now - 1000.0, 100)
+        self.assertEqual(max(self.clock.sleeps), 30)
+        self.device.connection.open.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
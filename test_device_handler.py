@@ -3,8 +3,10 @@ from unittest.mock import MagicMock, patch, call
 import sys
 import subprocess
 
+import requests
+
 with patch("logging_setup.setup_logging", return_value=MagicMock()):
-    from device_handler import process_devices
+    from device_handler import process_devices, warm_devices
 
 
 class TestDeviceHandler(unittest.TestCase):
@@ -207,14 +209,137 @@ class TestDeviceHandler(unittest.TestCase):
         args.command = None
         args.copy_artifact = None
 
-        _ = process_devices(self.devices, self.cloud, self.env_vars, args)
+        mock_database.open_circuits.return_value = set()
 
-        self.mock_sys_exit.assert_called_once_with(1)
+        locked = process_devices(self.devices, self.cloud, self.env_vars, args)
+
+        self.assertFalse(locked)
+        self.mock_sys_exit.assert_not_called()
         self.logger.error.assert_called_with(
-            f"An error occurred while processing device {uuid}: Connection test failed"
+            f"Can't connect to device {uuid}, moving on to the next one: Connection test failed"
+        )
+        mock_database.record_connection_failure.assert_called_once_with(
+            uuid, "Connection test failed"
         )
         mock_database.release_lock.assert_called_with(uuid)
 
+    @patch("device_handler.database")
+    @patch("device_handler.common")
+    @patch("device_handler.Device")
+    def test_process_devices_moves_on_after_a_failed_connection(
+        self, mock_Device, mock_common, mock_database
+    ):
+        devices = [
+            self.device,
+            {**self.device, "deviceUuid": "uuid2"},
+        ]
+        mock_database.device_exists.return_value = True
+        mock_database.try_until_locked.return_value = True
+        mock_database.open_circuits.return_value = set()
+
+        unreachable = MagicMock()
+        unreachable.create_ssh_connnection.side_effect = ConnectionError(
+            "Connection test failed"
+        )
+        reachable = MagicMock()
+        reachable.network_info = None
+        mock_Device.side_effect = [unreachable, reachable]
+
+        args = MagicMock()
+        args.do_not_update = True
+        args.run_before_on_host = None
+        args.hacking_session = False
+        args.before = None
+        args.command = None
+        args.copy_artifact = None
+
+        self.assertTrue(
+            process_devices(devices, self.cloud, self.env_vars, args)
+        )
+
+        self.mock_sys_exit.assert_not_called()
+        mock_database.record_connection_failure.assert_called_once_with(
+            "uuid1", "Connection test failed"
+        )
+        mock_database.record_connection_success.assert_called_once_with("uuid2")
+        self.assertEqual(
+            mock_database.release_lock.call_args_list,
+            [call("uuid1"), call("uuid2")],
+        )
+
+    @patch("device_handler.database")
+    @patch("device_handler.common")
+    @patch("device_handler.Device")
+    def test_process_devices_cloud_errors_leave_device_health_alone(
+        self, mock_Device, mock_common, mock_database
+    ):
+        mock_database.device_exists.return_value = True
+        mock_database.try_until_locked.return_value = True
+        mock_database.open_circuits.return_value = set()
+
+        dut_instance = MagicMock()
+        dut_instance.create_ssh_connnection.side_effect = (
+            requests.exceptions.HTTPError("400 Client Error")
+        )
+        mock_Device.return_value = dut_instance
+
+        process_devices(self.devices, self.cloud, self.env_vars, self.args)
+
+        self.mock_sys_exit.assert_called_once_with(1)
+        mock_database.record_connection_failure.assert_not_called()
+        mock_database.record_connection_success.assert_not_called()
+        mock_database.release_lock.assert_called_once_with("uuid1")
+
+    @patch("device_handler.database")
+    @patch("device_handler.Device")
+    def test_process_devices_skips_devices_no_rule_fits(
+        self, mock_Device, mock_database
+    ):
+        devices = [
+            {**self.device, "deviceUuid": "uuid0", "deviceId": "labpc"},
+            self.device,
+        ]
+        mock_database.open_circuits.return_value = set()
+        mock_database.try_until_locked.return_value = False
+
+        with patch("common.logger"):
+            self.assertFalse(
+                process_devices(devices, self.cloud, self.env_vars, self.args)
+            )
+
+        # The only device left is busy-waited for.
+        mock_database.try_until_locked.assert_called_once_with(
+            "uuid1", fail_fast=False
+        )
+
+    @patch("device_handler.database")
+    @patch("device_handler.common")
+    @patch("device_handler.Device")
+    def test_process_devices_skips_open_circuits(
+        self, mock_Device, mock_common, mock_database
+    ):
+        devices = [
+            self.device,
+            {**self.device, "deviceUuid": "uuid2"},
+        ]
+        mock_database.open_circuits.return_value = {"uuid1"}
+        mock_database.try_until_locked.return_value = False
+
+        process_devices(devices, self.cloud, self.env_vars, self.args)
+
+        # The only healthy device left is busy-waited for.
+        mock_database.try_until_locked.assert_called_once_with(
+            "uuid2", fail_fast=False
+        )
+
+        mock_database.try_until_locked.reset_mock()
+        mock_database.open_circuits.return_value = {"uuid1", "uuid2"}
+
+        process_devices(devices, self.cloud, self.env_vars, self.args)
+
+        # Skipped devices are still tried when no healthy one is left.
+        self.assertEqual(mock_database.try_until_locked.call_count, 2)
+
     @patch("device_handler.database")
     @patch("device_handler.common")
     @patch("device_handler.Device")
@@ -511,6 +636,271 @@ class TestDeviceHandler(unittest.TestCase):
             "Failed to start interactive shell: Some unexpected error"
         )
 
+    def _fail_update(self, mock_Device, mock_database, reachable):
+        mock_database.try_until_locked.return_value = True
+        dut = MagicMock()
+        dut.is_os_updated_to_latest.return_value = False
+        dut.update_to_latest.return_value = False
+        dut.wait_until_reachable.return_value = reachable
+        mock_Device.return_value = dut
+        self.args.do_not_update = False
+
+        process_devices(self.devices, self.cloud, self.env_vars, self.args)
+
+        dut.wait_until_reachable.assert_called_once_with(deadline=300)
+        self.logger.error.assert_called_with(
+            "An error occurred while processing device uuid1: Update unsuccessful for uuid1."
+        )
+        self.mock_sys_exit.assert_called_once_with(1)
+        mock_database.release_lock.assert_called_once_with("uuid1")
+        return dut
+
+    @patch("device_handler.database")
+    @patch("device_handler.common")
+    @patch("device_handler.Device")
+    def test_failed_update_logs_are_read_once_reachable(
+        self, mock_Device, mock_common, mock_database
+    ):
+        dut = self._fail_update(mock_Device, mock_database, reachable=True)
+
+        dut.connection.run.assert_called_once_with(
+            "journalctl -u aktualizr-torizon --no-pager"
+        )
+
+    @patch("device_handler.database")
+    @patch("device_handler.common")
+    @patch("device_handler.Device")
+    def test_failed_update_of_an_unreachable_device(
+        self, mock_Device, mock_common, mock_database
+    ):
+        dut = self._fail_update(mock_Device, mock_database, reachable=False)
+
+        dut.connection.run.assert_not_called()
+        self.logger.error.assert_any_call(
+            "Device uuid1 didn't come back, can't get its Aktualizr logs"
+        )
+
+
+class TestWarmDevices(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("device_handler.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        self.devices = [
+            {"deviceUuid": uuid, "deviceId": "verdin-imx8mm-07214001-9334fa"}
+            for uuid in ("uuid1", "uuid2", "uuid3", "uuid4")
+        ]
+        self.env_vars = {
+            "PUBLIC_KEY": "public_key_content",
+            "DEVICE_PASSWORD": "device_password",
+            "TARGET_BUILD_TYPE": "nightly",
+            "USE_RAC": False,
+        }
+        self.args = MagicMock()
+        self.args.warm_concurrency = 2
+        self.args.remove_databases = False
+        self.args.ignore_different_secondaries_between_updates = False
+
+    def cloud(self, current_builds, latest_build="build-1"):
+        cloud = MagicMock()
+        cloud.get_current_builds.return_value = current_builds
+        cloud.get_latest_build.return_value = latest_build
+        return cloud
+
+    @patch("device_handler.database")
+    @patch("device_handler.Device")
+    def test_outcomes(self, mock_Device, mock_database):
+        # uuid1 is up to date, uuid2 is used by another job, uuid3 updates
+        # and uuid4, whose build is unknown, doesn't manage to.
+        checks = {
+            "uuid2": [False],
+            "uuid3": [False, False],
+            "uuid4": [False, False],
+        }
+
+        def make_device(cloud, uuid, hardware_id, env_vars):
+            dut = MagicMock()
+            dut.uuid = uuid
+            dut.is_os_updated_to_latest.side_effect = checks[uuid]
+            dut.update_to_latest.return_value = uuid == "uuid3"
+            dut.latest_build = "build-1"
+            return dut
+
+        mock_Device.side_effect = make_device
+        mock_database.try_until_locked.side_effect = (
+            lambda uuid, fail_fast: uuid != "uuid2"
+        )
+        cloud = self.cloud(
+            {"uuid1": "build-1", "uuid2": "build-0", "uuid3": "build-0"}
+        )
+
+        outcomes = warm_devices(self.devices, cloud, self.env_vars, self.args)
+
+        self.assertEqual(
+            outcomes,
+            {
+                "uuid1": "not_needed",
+                "uuid2": "busy",
+                "uuid3": "success",
+                "uuid4": "failed",
+            },
+        )
+        for call_args in mock_database.try_until_locked.call_args_list:
+            self.assertEqual(call_args.kwargs, {"fail_fast": True})
+        self.assertCountEqual(
+            [c.args[0] for c in mock_database.release_lock.call_args_list],
+            ["uuid3", "uuid4"],
+        )
+        # Waves of 2: uuid2 and uuid3, then uuid4.
+        self.assertEqual(
+            [c.args for c in cloud.launch_update.call_args_list],
+            [("build-1", ["uuid3"]), ("build-1", ["uuid4"])],
+        )
+
+    @patch("device_handler.database")
+    @patch("device_handler.Device")
+    def test_checks_are_batched(self, mock_Device, mock_database):
+        devices = self.devices + [
+            {"deviceUuid": "uuid5", "deviceId": "verdin-am62-15133530-24fe44"}
+        ]
+        mock_Device.return_value.uuid = "uuid2"
+        mock_database.try_until_locked.return_value = False
+        cloud = self.cloud(
+            {
+                "uuid1": "build-1",
+                "uuid2": "build-0",
+                "uuid3": "build-1",
+                "uuid4": "build-1",
+                "uuid5": "build-1",
+            }
+        )
+
+        outcomes = warm_devices(devices, cloud, self.env_vars, self.args)
+
+        self.assertEqual(
+            outcomes,
+            {
+                "uuid1": "not_needed",
+                "uuid2": "busy",
+                "uuid3": "not_needed",
+                "uuid4": "not_needed",
+                "uuid5": "not_needed",
+            },
+        )
+        cloud.get_current_builds.assert_called_once_with(
+            {
+                "uuid1": "verdin-imx8mm",
+                "uuid2": "verdin-imx8mm",
+                "uuid3": "verdin-imx8mm",
+                "uuid4": "verdin-imx8mm",
+                "uuid5": "verdin-am62",
+            }
+        )
+        self.assertCountEqual(
+            [c.kwargs for c in cloud.get_latest_build.call_args_list],
+            [
+                {"release_type": "nightly", "hardware_id": "verdin-imx8mm"},
+                {"release_type": "nightly", "hardware_id": "verdin-am62"},
+            ],
+        )
+        # Only the outdated device is set up.
+        mock_Device.assert_called_once_with(
+            cloud, "uuid2", "verdin-imx8mm", self.env_vars
+        )
+
+    @patch("device_handler.database")
+    @patch("device_handler.Device")
+    def test_devices_without_a_latest_build_fail(
+        self, mock_Device, mock_database
+    ):
+        cloud = self.cloud({})
+        cloud.get_latest_build.side_effect = Exception("no packages")
+
+        outcomes = warm_devices(
+            self.devices[:1], cloud, self.env_vars, self.args
+        )
+
+        self.assertEqual(outcomes, {"uuid1": "failed"})
+        mock_Device.assert_not_called()
+        mock_database.try_until_locked.assert_not_called()
+
+    @patch("device_handler.database")
+    @patch("device_handler.Device")
+    def test_failures_release_the_lock(self, mock_Device, mock_database):
+        dut = MagicMock()
+        dut.uuid = "uuid1"
+        dut.is_os_updated_to_latest.return_value = False
+        dut.update_to_latest.side_effect = Exception("update never started")
+        mock_Device.return_value = dut
+        mock_database.try_until_locked.return_value = True
+
+        outcomes = warm_devices(
+            self.devices[:1], self.cloud({}), self.env_vars, self.args
+        )
+
+        self.assertEqual(outcomes, {"uuid1": "failed"})
+        mock_database.release_lock.assert_called_once_with("uuid1")
+        dut.create_ssh_connnection.assert_not_called()
+
+    @patch("device_handler.database")
+    @patch("device_handler.Device")
+    def test_updates_are_launched_per_build_and_wave(
+        self, mock_Device, mock_database
+    ):
+        builds = {
+            "uuid1": "imx8mm-new",
+            "uuid2": "am62-new",
+            "uuid3": "imx8mm-new",
+            "uuid4": "imx8mm-new",
+        }
+
+        def make_device(cloud, uuid, hardware_id, env_vars):
+            dut = MagicMock()
+            dut.uuid = uuid
+            dut.latest_build = builds[uuid]
+            dut.is_os_updated_to_latest.side_effect = [False, False]
+            dut.update_to_latest.return_value = True
+            return dut
+
+        mock_Device.side_effect = make_device
+        mock_database.try_until_locked.return_value = True
+        cloud = self.cloud({})
+
+        outcomes = warm_devices(self.devices, cloud, self.env_vars, self.args)
+
+        self.assertEqual(set(outcomes.values()), {"success"})
+        self.assertEqual(
+            [c.args for c in cloud.launch_update.call_args_list],
+            [
+                ("imx8mm-new", ["uuid1"]),
+                ("am62-new", ["uuid2"]),
+                ("imx8mm-new", ["uuid3", "uuid4"]),
+            ],
+        )
+
+    @patch("device_handler.database")
+    @patch("device_handler.Device")
+    def test_launch_failures_release_the_locks(
+        self, mock_Device, mock_database
+    ):
+        dut = MagicMock()
+        dut.uuid = "uuid1"
+        dut.latest_build = "build-1"
+        dut.is_os_updated_to_latest.return_value = False
+        mock_Device.return_value = dut
+        mock_database.try_until_locked.return_value = True
+        cloud = self.cloud({})
+        cloud.launch_update.side_effect = Exception("400 Bad Request")
+
+        outcomes = warm_devices(
+            self.devices[:1], cloud, self.env_vars, self.args
+        )
+
+        self.assertEqual(outcomes, {"uuid1": "failed"})
+        mock_database.release_lock.assert_called_once_with("uuid1")
+        dut.update_to_latest.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,8 @@
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, PropertyMock, patch
 
 with patch("logging_setup.setup_logging", return_value=MagicMock()):
-    from device_matcher import find_possible_devices
+    from device_matcher import find_possible_devices, order_by_update_cost
 
 
 class TestDeviceMatcher(unittest.TestCase):
@@ -299,6 +299,142 @@ class TestDeviceMatcher(unittest.TestCase):
             f"The following device has an invalid PID4 'asdf' in the `notes` field: {self.sample_devices[-1]}"
         )
 
+    @patch("device_matcher.inventory")
+    @patch("device_matcher.config_loader.load_pid_map", return_value={})
+    @patch("device_matcher.convolute")
+    @patch("device_matcher.common")
+    def test_find_possible_devices_from_inventory(
+        self, mock_common, mock_convolute, _, mock_inventory
+    ):
+        mock_inventory.enabled.return_value = True
+        mock_inventory.is_fresh.return_value = False
+        mock_inventory.find.return_value = self.sample_devices[:2]
+        mock_convolute.get_pid4_list.return_value = ["0001", "0002"]
+
+        possible_duts = find_possible_devices(
+            self.cloud, self.args, self.env_vars
+        )
+
+        self.assertEqual(possible_duts, self.sample_devices[:2])
+        mock_inventory.sync.assert_called_once_with(self.sample_devices)
+        mock_inventory.find.assert_called_once_with(pid4s={"0001", "0002"})
+
+    @patch("device_matcher.inventory")
+    @patch("device_matcher.config_loader.load_pid_map", return_value={})
+    @patch("device_matcher.convolute")
+    @patch("device_matcher.common")
+    def test_a_fresh_inventory_saves_listing_the_fleet(
+        self, mock_common, mock_convolute, _, mock_inventory
+    ):
+        mock_inventory.enabled.return_value = True
+        mock_inventory.is_fresh.return_value = True
+        mock_inventory.find.return_value = self.sample_devices[:2]
+        mock_convolute.get_pid4_list.return_value = ["0001", "0002"]
+        provisioned_devices = PropertyMock(return_value=self.sample_devices)
+        type(self.cloud).provisioned_devices = provisioned_devices
+
+        possible_duts = find_possible_devices(
+            self.cloud, self.args, self.env_vars
+        )
+
+        self.assertEqual(possible_duts, self.sample_devices[:2])
+        mock_inventory.sync.assert_not_called()
+        provisioned_devices.assert_not_called()
+
+
+class TestOrderByUpdateCost(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("device_matcher.logger")
+        self.addCleanup(patcher_logger.stop)
+        patcher_logger.start()
+
+        self.devices = [
+            {
+                "deviceUuid": "uuid1",
+                "deviceId": "verdin-imx8mm-07214001-9334fa",
+            },
+            {"deviceUuid": "uuid2", "deviceId": "verdin-am62-15133530-24fe44"},
+            {
+                "deviceUuid": "uuid3",
+                "deviceId": "verdin-imx8mm-07214002-9334fb",
+            },
+            {"deviceUuid": "uuid4", "deviceId": "verdin-am62-15133531-24fe45"},
+        ]
+        self.cloud = MagicMock()
+        self.cloud.get_current_builds.side_effect = lambda hardware_ids: {
+            uuid: build
+            for uuid, build in {
+                "uuid1": "imx8mm-old",
+                "uuid2": "am62-old",
+                "uuid3": "imx8mm-new",
+            }.items()
+            if uuid in hardware_ids
+        }
+        self.cloud.get_latest_build.side_effect = (
+            lambda release_type, hardware_id: {
+                "verdin-imx8mm": "imx8mm-new",
+                "verdin-am62": "am62-new",
+            }[hardware_id]
+        )
+
+    def _order(self):
+        return [
+            device["deviceUuid"]
+            for device in order_by_update_cost(
+                self.devices, self.cloud, "nightly"
+            )
+        ]
+
+    @patch(
+        "device_matcher.run_history.update_duration_by_hardware_id",
+        return_value=[
+            {"hardware_id": "verdin-imx8mm", "median_seconds": 1500.0},
+            {"hardware_id": "verdin-am62", "median_seconds": 600.0},
+        ],
+    )
+    def test_up_to_date_first_then_fastest_updates(self, _):
+        self.assertEqual(self._order(), ["uuid3", "uuid2", "uuid1", "uuid4"])
+        self.assertEqual(self.cloud.get_latest_build.call_count, 2)
+        self.cloud.get_current_builds.assert_called_once()
+
+    @patch(
+        "device_matcher.run_history.update_duration_by_hardware_id",
+        side_effect=Exception("no database"),
+    )
+    def test_fleet_order_is_kept_without_history(self, _):
+        self.assertEqual(self._order(), ["uuid3", "uuid1", "uuid2", "uuid4"])
+
+    @patch(
+        "device_matcher.run_history.update_duration_by_hardware_id",
+        return_value=[],
+    )
+    def test_fleet_order_is_kept_without_current_builds(self, _):
+        self.cloud.get_current_builds.side_effect = Exception("503")
+
+        self.assertEqual(self._order(), ["uuid1", "uuid2", "uuid3", "uuid4"])
+
+    @patch("device_matcher.inventory")
+    @patch(
+        "device_matcher.run_history.update_duration_by_hardware_id",
+        return_value=[],
+    )
+    def test_builds_known_to_the_inventory_are_not_fetched(
+        self, _, mock_inventory
+    ):
+        mock_inventory.enabled.return_value = True
+        mock_inventory.current_builds.return_value = {
+            "uuid1": "imx8mm-new",
+            "uuid2": "am62-old",
+        }
+
+        self.assertEqual(self._order(), ["uuid1", "uuid3", "uuid2", "uuid4"])
+        self.cloud.get_current_builds.assert_called_once_with(
+            {"uuid3": "verdin-imx8mm", "uuid4": "verdin-am62"}
+        )
+        mock_inventory.record_current_builds.assert_called_once_with(
+            {"uuid3": "imx8mm-new"}
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
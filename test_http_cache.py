@@ -0,0 +1,173 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import http_cache
+    import http_wrapper
+    from http_wrapper import endpoint_call
+
+URL = "http://host/api/v2/packages_external/info"
+
+
+def response(status_code=200, content=b'{"a": 1}', headers=None):
+    res = requests.Response()
+    res.status_code = status_code
+    res._content = content
+    res.headers.update(headers or {})
+    return res
+
+
+class HttpCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        for name in ("http_cache.logger", "http_wrapper.logger"):
+            patcher = patch(name)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher_env = patch.dict(
+            os.environ, {"AVAL_CACHE_DIR": cache_dir.name}, clear=True
+        )
+        self.addCleanup(patcher_env.stop)
+        patcher_env.start()
+
+        patcher_namespace = patch("http_cache._namespace", "")
+        self.addCleanup(patcher_namespace.stop)
+        patcher_namespace.start()
+
+        http_wrapper.reset()
+        self.addCleanup(http_wrapper.reset)
+
+
+class TestHttpCache(HttpCacheTestCase):
+    def test_store_and_lookup(self):
+        http_cache.store(URL, response(headers={"ETag": '"v1"'}), 0)
+
+        entry = http_cache.lookup(URL)
+
+        self.assertEqual(http_cache.to_response(entry).json(), {"a": 1})
+        self.assertEqual(
+            http_cache.conditional_headers(entry), {"If-None-Match": '"v1"'}
+        )
+
+    def test_only_our_user_can_read_the_cache(self):
+        http_cache.store(URL, response(), 60)
+
+        path = http_cache._path(URL)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777, 0o700)
+
+    def test_concurrent_stores_of_the_same_url(self):
+        start = threading.Barrier(8)
+
+        def store(i):
+            start.wait()
+            http_cache.store(
+                URL, response(content=f'{{"a": {i}}}'.encode()), 60
+            )
+
+        threads = [threading.Thread(target=store, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        entry = http_cache.lookup(URL)
+        self.assertIn(http_cache.to_response(entry).json()["a"], range(8))
+        self.assertEqual(
+            os.listdir(os.path.dirname(http_cache._path(URL))),
+            [os.path.basename(http_cache._path(URL))],
+        )
+
+    def test_only_reusable_responses_are_stored(self):
+        http_cache.store(URL, response(), 0)
+        http_cache.store(
+            URL + "?x", response(headers={"Cache-Control": "no-store"}), 60
+        )
+        http_cache.store(URL + "?y", response(404, headers={"ETag": "1"}), 0)
+
+        for url in (URL, URL + "?x", URL + "?y"):
+            self.assertIsNone(http_cache.lookup(url))
+
+    def test_freshness(self):
+        http_cache.store(
+            URL, response(headers={"Cache-Control": "max-age=60"}), 0
+        )
+        entry = http_cache.lookup(URL)
+
+        with patch("http_cache.time.time", return_value=entry["stored_at"]):
+            self.assertTrue(http_cache.is_fresh(entry, 0))
+        with patch(
+            "http_cache.time.time", return_value=entry["stored_at"] + 120
+        ):
+            self.assertFalse(http_cache.is_fresh(entry, 0))
+            self.assertTrue(http_cache.is_fresh(entry, 300))
+
+    def test_accounts_are_kept_apart(self):
+        http_cache.set_namespace("client-a")
+        http_cache.store(URL, response(headers={"ETag": '"v1"'}), 0)
+
+        http_cache.set_namespace("client-b")
+
+        self.assertIsNone(http_cache.lookup(URL))
+
+
+class TestCachedEndpointCall(HttpCacheTestCase):
+    @patch("http_wrapper._session.get")
+    def test_not_cached_without_max_stale(self, mock_get):
+        mock_get.return_value = response(headers={"ETag": '"v1"'})
+
+        endpoint_call(URL, "get")
+
+        self.assertIsNone(http_cache.lookup(URL))
+
+    @patch("http_wrapper._session.get")
+    def test_fresh_responses_are_not_requested(self, mock_get):
+        mock_get.return_value = response()
+
+        first = endpoint_call(URL, "get", max_stale=60)
+        second = endpoint_call(URL, "get", max_stale=60)
+
+        mock_get.assert_called_once()
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(
+            [r["cache"] for r in http_wrapper.records()], [None, "hit"]
+        )
+
+    @patch("http_wrapper._session.get")
+    def test_revalidation(self, mock_get):
+        mock_get.side_effect = [
+            response(headers={"ETag": '"v1"'}),
+            response(304, b"", headers={"ETag": '"v1"'}),
+        ]
+
+        endpoint_call(URL, "get", headers={"accept": "*/*"}, max_stale=0)
+        res = endpoint_call(URL, "get", headers={"accept": "*/*"}, max_stale=0)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {"a": 1})
+        mock_get.assert_called_with(
+            URL, headers={"accept": "*/*", "If-None-Match": '"v1"'}
+        )
+        ((_, stats),) = http_wrapper.summary()
+        self.assertEqual(stats["cached"], 1)
+
+    @patch.dict(os.environ, {"AVAL_HTTP_CACHE": "false"})
+    @patch("http_wrapper._session.get")
+    def test_can_be_disabled(self, mock_get):
+        mock_get.return_value = response()
+
+        endpoint_call(URL, "get", max_stale=60)
+        endpoint_call(URL, "get", max_stale=60)
+
+        self.assertEqual(mock_get.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,15 @@
+import json
+import os
+import tempfile
 import unittest
+from datetime import datetime, timezone
 from unittest.mock import MagicMock, patch
 import requests
+from urllib3.exceptions import NewConnectionError
 
 with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import http_wrapper
+    import rate_limit
     from http_wrapper import endpoint_call
 
 
@@ -12,7 +19,14 @@ class TestEndpointCall(unittest.TestCase):
         self.addCleanup(patcher_logger.stop)
         self.logger = patcher_logger.start()
 
-    @patch("http_wrapper.requests.get")
+        patcher_sleep = patch("http_wrapper.time.sleep")
+        self.addCleanup(patcher_sleep.stop)
+        self.mock_sleep = patcher_sleep.start()
+
+        http_wrapper.reset()
+        self.addCleanup(http_wrapper.reset)
+
+    @patch("http_wrapper._session.get")
     def test_get_success(self, mock_get):
         # Mock the response for a successful GET request
         mock_response = mock_get.return_value
@@ -27,7 +41,7 @@ class TestEndpointCall(unittest.TestCase):
         self.assertEqual(result.json(), {"key": "value"})
         mock_get.assert_called_once_with(url, headers=headers)
 
-    @patch("http_wrapper.requests.post")
+    @patch("http_wrapper._session.post")
     def test_post_success(self, mock_post):
         # Mock the response for a successful POST request
         mock_response = mock_post.return_value
@@ -45,7 +59,7 @@ class TestEndpointCall(unittest.TestCase):
             url, headers=headers, data=body, json=None
         )
 
-    @patch("http_wrapper.requests.delete")
+    @patch("http_wrapper._session.delete")
     def test_delete_success(self, mock_post):
         # Mock the response for a successful DELETE request
         mock_response = mock_post.return_value
@@ -60,7 +74,7 @@ class TestEndpointCall(unittest.TestCase):
         self.assertEqual(result.json(), {"status": "success"})
         mock_post.assert_called_once_with(url, headers=headers)
 
-    @patch("http_wrapper.requests.get")
+    @patch("http_wrapper._session.get")
     def test_unsupported_request_type(self, mock_get):
         # Simulate a unsupported request type
         url = "http://example.com/api"
@@ -77,7 +91,7 @@ class TestEndpointCall(unittest.TestCase):
         )
         mock_get.assert_not_called()
 
-    @patch("http_wrapper.requests.get")
+    @patch("http_wrapper._session.get")
     def test_get_http_code_error(self, mock_get):
         # Simulate a connection error
         mock_get.side_effect = requests.exceptions.HTTPError("405")
@@ -96,7 +110,7 @@ class TestEndpointCall(unittest.TestCase):
         )
         mock_get.assert_called_once_with(url, headers=headers)
 
-    @patch("http_wrapper.requests.get")
+    @patch("http_wrapper._session.get")
     def test_get_connection_error(self, mock_get):
         # Simulate a connection error
         mock_get.side_effect = requests.exceptions.ConnectionError(
@@ -115,9 +129,12 @@ class TestEndpointCall(unittest.TestCase):
             str(context.exception),
             "Failed to connect",
         )
-        mock_get.assert_called_once_with(url, headers=headers)
+        mock_get.assert_called_with(url, headers=headers)
+        self.assertEqual(
+            mock_get.call_count, http_wrapper.DEFAULT_RETRY.attempts
+        )
 
-    @patch("http_wrapper.requests.get")
+    @patch("http_wrapper._session.get")
     def test_get_timeout_error(self, mock_get):
         # Simulate a timeout error
         mock_get.side_effect = requests.exceptions.Timeout(
@@ -136,9 +153,12 @@ class TestEndpointCall(unittest.TestCase):
             str(context.exception),
             "Connection timed out",
         )
-        mock_get.assert_called_once_with(url, headers=headers)
+        mock_get.assert_called_with(url, headers=headers)
+        self.assertEqual(
+            mock_get.call_count, http_wrapper.DEFAULT_RETRY.attempts
+        )
 
-    @patch("http_wrapper.requests.get")
+    @patch("http_wrapper._session.get")
     def test_other_request_exception(self, mock_get):
         # Simulate an else HTTP exception
         mock_get.side_effect = requests.exceptions.RequestException(
@@ -159,7 +179,7 @@ class TestEndpointCall(unittest.TestCase):
         )
         mock_get.assert_called_once_with(url, headers=headers)
 
-    @patch("http_wrapper.requests.get")
+    @patch("http_wrapper._session.get")
     def test_unexpected_exception(self, mock_get):
         # Simulate a not known error
         mock_get.side_effect = Exception("Not request error")
@@ -174,3 +194,293 @@ class TestEndpointCall(unittest.TestCase):
 
         self.assertEqual(str(context.exception), "Not request error")
         mock_get.assert_called_once_with(url, headers=headers)
+
+
+class TestEndpointCallInstrumentation(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("http_wrapper.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        http_wrapper.reset()
+        self.addCleanup(http_wrapper.reset)
+
+    def _response(self, status_code=200, content=b"{}", pool=None):
+        res = MagicMock()
+        res.status_code = status_code
+        res.content = content
+        res.request.body = b'{"a": 1}'
+        res.raw._pool = pool
+        if status_code >= 400:
+            res.raise_for_status.side_effect = requests.exceptions.HTTPError(
+                str(status_code), response=res
+            )
+        return res
+
+    def test_route_template(self):
+        self.assertEqual(
+            http_wrapper.route_template(
+                "https://app.torizon.io/api/v2/devices/network/"
+                "5b76b5c7-fccd-4fcd-a100-0ce33e8dcdfe?x=1"
+            ),
+            "app.torizon.io/api/v2/devices/network/{uuid}",
+        )
+        self.assertEqual(
+            http_wrapper.route_template("http://host/packages/1234"),
+            "host/packages/{id}",
+        )
+
+    @patch("http_wrapper._session.post")
+    def test_records_requests(self, mock_post):
+        mock_post.return_value = self._response(content=b"12345")
+
+        endpoint_call("http://host/api/v2/updates", "post", json_data={})
+
+        (record,) = http_wrapper.records()
+        self.assertEqual(record["method"], "POST")
+        self.assertEqual(record["route"], "host/api/v2/updates")
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["request_bytes"], 8)
+        self.assertEqual(record["response_bytes"], 5)
+        self.assertFalse(record["retry"])
+        self.assertIsNone(record["error"])
+
+    @patch("http_wrapper.time.sleep")
+    @patch("http_wrapper._session.get")
+    def test_transient_failures_count_retries(self, mock_get, _):
+        url = "http://host/api/v2/devices"
+        mock_get.side_effect = [
+            self._response(500),
+            self._response(200),
+            self._response(404),
+            self._response(404),
+        ]
+
+        for _ in range(3):
+            try:
+                endpoint_call(url, "get")
+            except requests.exceptions.HTTPError:
+                pass
+
+        self.assertEqual(
+            [r["retry"] for r in http_wrapper.records()],
+            [False, True, False, False],
+        )
+        ((_, stats),) = http_wrapper.summary()
+        self.assertEqual(stats["calls"], 4)
+        self.assertEqual(stats["errors"], 3)
+        self.assertEqual(stats["retries"], 1)
+
+    @patch("http_wrapper._session.get")
+    def test_connection_reuse(self, mock_get):
+        pool = MagicMock()
+        pool.num_connections = 1
+        mock_get.return_value = self._response(pool=pool)
+
+        endpoint_call("http://host/a", "get")
+        endpoint_call("http://host/a", "get")
+        pool.num_connections = 2
+        endpoint_call("http://host/a", "get")
+
+        self.assertEqual(
+            [r["connection_reused"] for r in http_wrapper.records()],
+            [False, True, False],
+        )
+
+    @patch("http_wrapper._session.get")
+    def test_jsonl_dump(self, mock_get):
+        mock_get.return_value = self._response()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_file = os.path.join(tmp_dir, "http.jsonl")
+            with patch.dict(os.environ, {"AVAL_HTTP_LOG_FILE": log_file}):
+                endpoint_call("http://host/a", "get")
+                endpoint_call("http://host/b", "get")
+
+            with open(log_file) as f:
+                routes = [json.loads(line)["route"] for line in f]
+
+        self.assertEqual(routes, ["host/a", "host/b"])
+
+    @patch("http_wrapper._session.get")
+    def test_log_summary(self, mock_get):
+        http_wrapper.log_summary()
+        self.logger.info.assert_not_called()
+
+        mock_get.return_value = self._response()
+        endpoint_call("http://host/a", "get")
+        http_wrapper.log_summary()
+
+        logged = "\n".join(c.args[0] for c in self.logger.info.call_args_list)
+        self.assertIn("host/a", logged)
+
+
+class TestThrottling(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("http_wrapper.logger")
+        self.addCleanup(patcher_logger.stop)
+        patcher_logger.start()
+
+        http_wrapper.reset()
+        self.addCleanup(http_wrapper.reset)
+
+        self.sleeps = []
+        self.now = 1000.0
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        patcher_time = patch(
+            "rate_limit.time", MagicMock(time=lambda: self.now, sleep=sleep)
+        )
+        self.addCleanup(patcher_time.stop)
+        patcher_time.start()
+
+        patcher_env = patch.dict(os.environ, {}, clear=True)
+        self.addCleanup(patcher_env.stop)
+        patcher_env.start()
+        rate_limit.reset()
+        self.addCleanup(rate_limit.reset)
+
+    def _response(self, status_code, retry_after=None):
+        res = MagicMock()
+        res.status_code = status_code
+        res.headers = {"Retry-After": retry_after} if retry_after else {}
+        if status_code >= 400:
+            res.raise_for_status.side_effect = requests.exceptions.HTTPError(
+                str(status_code), response=res
+            )
+        return res
+
+    @patch("http_wrapper._session.get")
+    def test_honors_retry_after(self, mock_get):
+        mock_get.side_effect = [
+            self._response(429, "7"),
+            self._response(503),
+            self._response(200),
+        ]
+
+        res = endpoint_call("http://host/api/v2/devices", "get")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.sleeps, [7, 2])
+        self.assertEqual(
+            [r["retry"] for r in http_wrapper.records()], [False, True, True]
+        )
+
+    @patch("http_wrapper._session.post")
+    def test_gives_up_after_a_few_retries(self, mock_post):
+        mock_post.return_value = self._response(429, "1")
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            endpoint_call("http://host/api/v2/updates", "post", json_data={})
+
+        self.assertEqual(
+            mock_post.call_count, http_wrapper.THROTTLED_RETRIES + 1
+        )
+
+    @patch("http_wrapper._session.get")
+    def test_client_errors_are_not_retried(self, mock_get):
+        mock_get.return_value = self._response(404)
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            endpoint_call("http://host/api/v2/devices", "get")
+
+        mock_get.assert_called_once()
+        self.assertEqual(self.sleeps, [])
+
+    def test_retry_after_http_date(self):
+        res = self._response(429, "Wed, 21 Oct 2015 07:28:00 GMT")
+
+        with patch("http_wrapper.datetime") as mock_datetime:
+            mock_datetime.now.return_value = datetime(
+                2015, 10, 21, 7, 27, 30, tzinfo=timezone.utc
+            )
+            self.assertEqual(http_wrapper._retry_after(res, 0), 30)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("http_wrapper.logger")
+        self.addCleanup(patcher_logger.stop)
+        patcher_logger.start()
+
+        http_wrapper.reset()
+        self.addCleanup(http_wrapper.reset)
+
+        patcher_sleep = patch("http_wrapper.time.sleep")
+        self.addCleanup(patcher_sleep.stop)
+        self.mock_sleep = patcher_sleep.start()
+
+    def _response(self, status_code):
+        res = MagicMock()
+        res.status_code = status_code
+        if status_code >= 400:
+            res.raise_for_status.side_effect = requests.exceptions.HTTPError(
+                str(status_code), response=res
+            )
+        return res
+
+    def _not_sent(self):
+        return requests.exceptions.ConnectionError(
+            MagicMock(reason=NewConnectionError(None, "Connection refused"))
+        )
+
+    @patch("http_wrapper._session.get")
+    def test_idempotent_requests_are_retried(self, mock_get):
+        mock_get.side_effect = [
+            requests.exceptions.ConnectionError("Connection reset by peer"),
+            self._response(502),
+            self._response(200),
+        ]
+
+        res = endpoint_call("http://host/api/v2/devices", "get")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.mock_sleep.call_count, 2)
+        for (delay,), _ in self.mock_sleep.call_args_list:
+            self.assertLessEqual(delay, 2)
+
+    @patch("http_wrapper._session.post")
+    def test_posts_are_only_retried_when_never_sent(self, mock_post):
+        mock_post.side_effect = [self._not_sent(), self._response(500)]
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            endpoint_call("http://host/api/v2/updates", "post", json_data={})
+
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch("http_wrapper._session.post")
+    def test_idempotent_posts_can_be_retried(self, mock_post):
+        mock_post.side_effect = [self._response(500), self._response(200)]
+
+        endpoint_call(
+            "http://host/token", "post", retry=http_wrapper.IDEMPOTENT_RETRY
+        )
+
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch("http_wrapper._session.get")
+    def test_retries_stop_at_the_budget(self, mock_get):
+        mock_get.return_value = self._response(500)
+        policy = http_wrapper.RetryPolicy(attempts=10, backoff=10, budget=5)
+
+        with patch("http_wrapper.random.uniform", side_effect=lambda a, b: b):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                endpoint_call("http://host/api/v2/devices", "get", retry=policy)
+
+        # The first retry, up to 10s away, doesn't fit in 5 seconds.
+        mock_get.assert_called_once()
+
+    @patch("http_wrapper._session.get")
+    def test_no_retry(self, mock_get):
+        mock_get.return_value = self._response(500)
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            endpoint_call(
+                "http://host/api/v2/devices",
+                "get",
+                retry=http_wrapper.NO_RETRY,
+            )
+
+        mock_get.assert_called_once()
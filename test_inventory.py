@@ -0,0 +1,188 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import inventory
+
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("inventory.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        patcher_env = patch.dict(
+            os.environ,
+            {"AVAL_INVENTORY_FILE": os.path.join(tmp_dir.name, "fleet.db")},
+        )
+        self.addCleanup(patcher_env.stop)
+        patcher_env.start()
+
+        self.devices = [
+            {
+                "deviceUuid": "uuid1",
+                "deviceId": "verdin-imx8mm-07214001-9334fa",
+                "notes": "0001",
+                "lastSeen": "2024-01-01T00:00:00Z",
+            },
+            {
+                "deviceUuid": "uuid2",
+                "deviceId": "verdin-am62-15133530-24fe44",
+                "notes": "0002",
+                "lastSeen": "2024-01-01T00:00:00Z",
+            },
+            {
+                "deviceUuid": "uuid3",
+                "deviceId": "verdin-imx8mm-07214002-9334fb",
+                "notes": "0001",
+                "lastSeen": "2024-01-01T00:00:00Z",
+            },
+            {
+                "deviceUuid": "uuid4",
+                "deviceId": "verdin-am62-15133531-24fe45",
+                "notes": "asdf",  # Device with invalid PID4
+                "lastSeen": "2024-01-01T00:00:00Z",
+            },
+        ]
+
+    def _uuids(self, devices):
+        return [device["deviceUuid"] for device in devices]
+
+    def test_enabled(self):
+        self.assertTrue(inventory.enabled())
+        with patch.dict(os.environ, {"AVAL_INVENTORY_FILE": ""}):
+            self.assertFalse(inventory.enabled())
+
+    def test_sync_is_incremental(self):
+        self.assertEqual(
+            inventory.sync(self.devices),
+            {"devices": 4, "changed": 4, "removed": 0},
+        )
+
+        self.devices[0]["lastSeen"] = "2024-01-02T00:00:00Z"
+        self.devices[1]["notes"] = "0003"
+
+        self.assertEqual(
+            inventory.sync(self.devices),
+            {"devices": 4, "changed": 1, "removed": 0},
+        )
+        self.assertEqual(self._uuids(inventory.find(pid4s=["0003"])), ["uuid2"])
+        self.assertEqual(
+            inventory.find(pid4s=["0001"])[0]["lastSeen"],
+            "2024-01-02T00:00:00Z",
+        )
+
+    def test_sync_rederives_everything_when_the_rules_change(self):
+        inventory.sync(self.devices)
+
+        with patch("inventory._rules_version", return_value="other"):
+            stats = inventory.sync(self.devices)
+
+        self.assertEqual(stats["changed"], 4)
+
+    def test_sync_removes_devices_gone_from_the_fleet(self):
+        inventory.sync(self.devices)
+
+        stats = inventory.sync(self.devices[1:])
+
+        self.assertEqual(stats["removed"], 1)
+        self.assertEqual(
+            self._uuids(inventory.find()), ["uuid2", "uuid3", "uuid4"]
+        )
+
+    def test_sync_survives_malformed_devices(self):
+        self.devices.append(
+            {"deviceUuid": "uuid5", "deviceId": "labpc", "notes": None}
+        )
+
+        self.assertEqual(inventory.sync(self.devices)["changed"], 5)
+
+        self.assertEqual(inventory.hardware_ids(["uuid5"]), {"uuid5": None})
+        self.assertEqual(
+            inventory.find(pid4s=["0001"])[0]["deviceUuid"], "uuid1"
+        )
+
+    def test_is_fresh(self):
+        self.assertFalse(inventory.is_fresh())
+
+        with patch("inventory.time.time", return_value=1000):
+            inventory.sync(self.devices)
+        with patch("inventory.time.time", return_value=1000 + 599):
+            self.assertTrue(inventory.is_fresh(max_age=600))
+        with patch("inventory.time.time", return_value=1000 + 600):
+            self.assertFalse(inventory.is_fresh(max_age=600))
+
+    def test_find_keeps_fleet_order(self):
+        inventory.sync(self.devices)
+        inventory.sync(list(reversed(self.devices)))
+
+        self.assertEqual(
+            self._uuids(inventory.find(pid4s=["0001", "0002"])),
+            ["uuid3", "uuid2", "uuid1"],
+        )
+
+    def test_invalid_pid4s_are_never_found(self):
+        inventory.sync(self.devices)
+
+        self.assertEqual(inventory.find(pid4s=["asdf"]), [])
+        self.logger.error.assert_called_once()
+
+    def test_hardware_ids(self):
+        inventory.sync(self.devices)
+
+        self.assertEqual(
+            inventory.hardware_ids(["uuid1", "uuid2"]),
+            {"uuid1": "verdin-imx8mm", "uuid2": "verdin-am62"},
+        )
+        self.assertEqual(
+            self._uuids(inventory.find(hardware_ids=["verdin-am62"])),
+            ["uuid2", "uuid4"],
+        )
+
+    def test_current_builds(self):
+        inventory.sync(self.devices)
+
+        with patch("inventory.time.time", return_value=1000):
+            inventory.record_current_build("uuid1", "build-1")
+        with patch("inventory.time.time", return_value=2000):
+            inventory.record_current_build("uuid2", "build-2")
+
+            self.assertEqual(
+                inventory.current_builds(["uuid1", "uuid2", "uuid3"]),
+                {"uuid1": "build-1", "uuid2": "build-2"},
+            )
+            self.assertEqual(
+                inventory.current_builds(["uuid1", "uuid2"], max_age=600),
+                {"uuid2": "build-2"},
+            )
+
+    def test_sync_current_builds(self):
+        inventory.sync(self.devices)
+        cloud = MagicMock()
+        cloud.get_current_builds.return_value = {
+            "uuid1": "build-1",
+            "uuid2": "build-2",
+        }
+
+        self.assertEqual(inventory.sync_current_builds(cloud), 2)
+
+        cloud.get_current_builds.assert_called_once_with(
+            {
+                "uuid1": "verdin-imx8mm",
+                "uuid2": "verdin-am62",
+                "uuid3": "verdin-imx8mm",
+                "uuid4": "verdin-am62",
+            }
+        )
+        self.assertEqual(
+            inventory.current_builds(["uuid1", "uuid2", "uuid3"]),
+            {"uuid1": "build-1", "uuid2": "build-2"},
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
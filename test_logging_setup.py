@@ -0,0 +1,74 @@
+import importlib
+import logging
+import logging.handlers
+import unittest
+from unittest.mock import MagicMock, patch
+
+import logging_setup
+
+
+class TestLoggingSetup(unittest.TestCase):
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.saved_handlers = self.root.handlers[:]
+        self.saved_level = self.root.level
+        self.root.handlers = []
+
+        importlib.reload(logging_setup)
+
+    def tearDown(self):
+        logging_setup.shutdown_logging()
+        self.root.handlers = self.saved_handlers
+        self.root.setLevel(self.saved_level)
+
+    def _queue_handlers(self):
+        return [
+            h
+            for h in self.root.handlers
+            if isinstance(h, logging.handlers.QueueHandler)
+        ]
+
+    def test_setup_logging_configures_only_once(self):
+        with patch("logging_setup.atexit.register") as mock_register:
+            logging_setup.setup_logging()
+            logging_setup.setup_logging()
+            logging_setup.setup_logging()
+
+        self.assertEqual(len(self._queue_handlers()), 1)
+        mock_register.assert_called_once_with(logging_setup.shutdown_logging)
+
+    @patch.dict("os.environ", {"AVAL_VERBOSE": ""})
+    def test_debug_arguments_are_not_formatted_when_disabled(self):
+        with patch("logging_setup.atexit.register"):
+            logger = logging_setup.setup_logging()
+
+        expensive = MagicMock()
+        logger.debug("Provisioned devices: %s", expensive)
+
+        expensive.__str__.assert_not_called()
+
+    def test_records_are_handed_off_to_the_listener(self):
+        with patch("logging_setup.atexit.register"):
+            logger = logging_setup.setup_logging()
+
+        handler = logging_setup._listener.handlers[0]
+        with patch.object(handler, "emit") as mock_emit:
+            logger.info("Lock acquired for device %s", "uuid1")
+            logging_setup.shutdown_logging()
+
+        mock_emit.assert_called_once()
+        record = mock_emit.call_args[0][0]
+        self.assertEqual(record.getMessage(), "Lock acquired for device uuid1")
+
+    def test_shutdown_logging_is_idempotent(self):
+        with patch("logging_setup.atexit.register"):
+            logging_setup.setup_logging()
+
+        logging_setup.shutdown_logging()
+        logging_setup.shutdown_logging()
+
+        self.assertIsNone(logging_setup._listener)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+from unittest.mock import MagicMock, patch
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import database
+    import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("metrics.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        patcher_registry = patch.dict(metrics._registry, clear=True)
+        self.addCleanup(patcher_registry.stop)
+        patcher_registry.start()
+
+    def test_counter_exposition(self):
+        calls = metrics.counter("calls_total", "Calls.", ["route"])
+        calls.inc(route="/devices")
+        calls.inc(2, route="/devices")
+        calls.inc(route='/a"b')
+
+        self.assertEqual(
+            metrics.expose(),
+            "# HELP calls_total Calls.\n"
+            "# TYPE calls_total counter\n"
+            'calls_total{route="/devices"} 3\n'
+            'calls_total{route="/a\\"b"} 1\n',
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        wait = metrics.histogram("wait_seconds", "Wait.", buckets=(1, 10))
+        wait.observe(0.5)
+        wait.observe(5)
+        wait.observe(50)
+
+        exposed = metrics.expose()
+
+        self.assertIn('wait_seconds_bucket{le="1"} 1\n', exposed)
+        self.assertIn('wait_seconds_bucket{le="10"} 2\n', exposed)
+        self.assertIn('wait_seconds_bucket{le="+Inf"} 3\n', exposed)
+        self.assertIn("wait_seconds_sum 55.5\n", exposed)
+        self.assertIn("wait_seconds_count 3\n", exposed)
+
+    def test_labels_are_checked(self):
+        calls = metrics.counter("calls_total", "Calls.", ["route"])
+
+        with self.assertRaises(ValueError):
+            calls.inc(status="200")
+
+    def test_record_exit_keeps_only_the_last_reason(self):
+        metrics._register(metrics.EXIT_REASON)
+        metrics.record_exit(1)
+        metrics.record_exit(69)
+
+        exposed = metrics.expose()
+
+        self.assertIn(
+            'aval_exit_reason{reason="no_device_available"} 1', exposed
+        )
+        self.assertNotIn('reason="error"', exposed)
+
+    def test_write_textfile(self):
+        metrics.counter("calls_total", "Calls.").inc()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "aval.prom")
+            with patch.dict(os.environ, {"AVAL_METRICS_FILE": path}):
+                metrics.write_textfile()
+
+            with open(path) as f:
+                self.assertIn("calls_total 1\n", f.read())
+            self.assertEqual(os.listdir(tmp_dir), ["aval.prom"])
+            # Readable by node_exporter.
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o644)
+
+    def test_write_textfile_is_optional(self):
+        with patch.dict(os.environ, {}, clear=True), patch(
+            "metrics.common.atomic_write"
+        ) as mock_atomic_write:
+            metrics.write_textfile()
+
+        mock_atomic_write.assert_not_called()
+
+    def test_http_server(self):
+        metrics.counter("calls_total", "Calls.").inc()
+        server = metrics.start_http_server(0, host="127.0.0.1")
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{server.server_port}/metrics"
+        ) as res:
+            self.assertIn(b"calls_total 1\n", res.read())
+
+    @patch.dict(os.environ, {}, clear=False)
+    def test_http_server_listens_on_loopback_by_default(self):
+        os.environ.pop("AVAL_METRICS_HOST", None)
+        server = metrics.start_http_server(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        self.assertEqual(server.server_address[0], "127.0.0.1")
+
+    @patch.dict(os.environ, {"AVAL_METRICS_HOST": "0.0.0.0"})
+    @patch("http.server.ThreadingHTTPServer")
+    def test_http_server_host_from_environment(self, mock_server):
+        metrics.start_http_server(9100)
+
+        self.assertEqual(mock_server.call_args.args[0], ("0.0.0.0", 9100))
+
+
+class TestLockWaitMetrics(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("database.logger")
+        self.addCleanup(patcher_logger.stop)
+        patcher_logger.start()
+
+        metrics.LOCK_WAIT_SECONDS.clear()
+        self.addCleanup(metrics.LOCK_WAIT_SECONDS.clear)
+
+    @patch("database.acquire_lock", return_value=False)
+    def test_fail_fast_records_busy(self, _):
+        database.try_until_locked("uuid1", fail_fast=True)
+
+        ((_, labels, _),) = [
+            s
+            for s in metrics.LOCK_WAIT_SECONDS.samples()
+            if s[0].endswith("_count")
+        ]
+        self.assertEqual(labels, (("result", "busy"),))
+
+    @patch("database.time.sleep")
+    @patch("database.acquire_lock", side_effect=[False, True])
+    def test_busy_wait_records_locked(self, *_):
+        database.try_until_locked("uuid1", fail_fast=False)
+
+        counts = {
+            labels: value
+            for name, labels, value in metrics.LOCK_WAIT_SECONDS.samples()
+            if name.endswith("_count")
+        }
+        self.assertEqual(counts, {(("result", "locked"),): 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
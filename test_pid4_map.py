@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import yaml
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import pid4_map
+
+mock_yaml_data = """
+common_props_arm64: &common_props_arm64
+  architecture: "arm64"
+  common_device: false
+
+verdin-imx8mp:
+  pid4:
+    - id: "0058"
+      soc_npu: true
+      <<: *common_props_arm64
+    - id: "0063"
+      soc_npu: false
+      <<: *common_props_arm64
+
+colibri-imx6:
+  pid4:
+    - id: "0014"
+      architecture: "arm"
+      common_device: false
+"""
+
+
+class TestPid4Map(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("pid4_map.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        patcher_env = patch.dict(
+            os.environ,
+            {"AVAL_CACHE_DIR": os.path.join(self.tmp_dir, "cache")},
+        )
+        self.addCleanup(patcher_env.stop)
+        patcher_env.start()
+
+        patcher_loaded = patch.dict(pid4_map._loaded_maps, clear=True)
+        self.addCleanup(patcher_loaded.stop)
+        patcher_loaded.start()
+
+        self.pid_map_path = os.path.join(self.tmp_dir, "pid_map.yaml")
+        with open(self.pid_map_path, "w") as f:
+            f.write(mock_yaml_data)
+
+    def test_precomputed_lookups(self):
+        compiled = pid4_map.load(self.pid_map_path)
+
+        self.assertEqual(compiled.architectures, {"arm", "arm64"})
+        self.assertTrue(compiled.is_architecture("arm64"))
+        self.assertFalse(compiled.is_architecture("verdin-imx8mp"))
+        self.assertEqual(set(compiled.socs), {"verdin-imx8mp", "colibri-imx6"})
+        self.assertEqual(
+            [e["id"] for e in compiled.get_pid4_entries("verdin-imx8mp")],
+            ["0058", "0063"],
+        )
+        self.assertEqual(compiled, yaml.safe_load(mock_yaml_data))
+
+    def test_inverted_indexes(self):
+        compiled = pid4_map.load(self.pid_map_path)
+
+        self.assertEqual(compiled.soc_of("0063"), "verdin-imx8mp")
+        self.assertEqual(compiled.architecture_of("0014"), "arm")
+        self.assertTrue(compiled.properties_of("0058")["soc_npu"])
+        self.assertIsNone(compiled.soc_of("9999"))
+        self.assertEqual(compiled.properties_of("9999"), {})
+        self.assertEqual(
+            compiled.pid4s_for_soc("verdin-imx8mp"), ["0058", "0063"]
+        )
+        self.assertEqual(
+            compiled.pid4s_for_architecture("arm64"), ["0058", "0063"]
+        )
+        self.assertEqual(
+            compiled.pid4s_for_architecture("arm64", common_device=True), []
+        )
+        self.assertEqual(
+            compiled.pid4s_for_architecture("arm", common_device=False),
+            ["0014"],
+        )
+
+    def test_compile_pid_map_accepts_plain_dicts(self):
+        plain = yaml.safe_load(mock_yaml_data)
+        compiled = pid4_map.compile_pid_map(plain)
+
+        self.assertIsInstance(compiled, pid4_map.Pid4Map)
+        self.assertIs(pid4_map.compile_pid_map(compiled), compiled)
+        self.assertEqual(compiled.pid4s_for_soc("colibri-imx6"), ["0014"])
+
+    def test_parsed_once_per_process(self):
+        with patch("yaml.safe_load", wraps=yaml.safe_load) as mock_safe_load:
+            first = pid4_map.load(self.pid_map_path)
+            second = pid4_map.load(self.pid_map_path)
+
+        self.assertIs(first, second)
+        mock_safe_load.assert_called_once()
+
+    def test_cache_is_reused_across_processes(self):
+        pid4_map.load(self.pid_map_path)
+        pid4_map._loaded_maps.clear()
+
+        with patch("yaml.safe_load") as mock_safe_load:
+            compiled = pid4_map.load(self.pid_map_path)
+
+        mock_safe_load.assert_not_called()
+        self.assertEqual(compiled.architectures, {"arm", "arm64"})
+
+    def test_cache_is_invalidated_on_content_change(self):
+        pid4_map.load(self.pid_map_path)
+        pid4_map._loaded_maps.clear()
+
+        with open(self.pid_map_path, "a") as f:
+            f.write('\nx86-board:\n  pid4:\n    - id: "9999"\n')
+            f.write('      architecture: "x86"\n')
+
+        compiled = pid4_map.load(self.pid_map_path)
+
+        self.assertIn("x86", compiled.architectures)
+
+    def test_touched_file_with_same_content_uses_cache(self):
+        pid4_map.load(self.pid_map_path)
+        pid4_map._loaded_maps.clear()
+
+        stat = os.stat(self.pid_map_path)
+        os.utime(
+            self.pid_map_path,
+            ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000),
+        )
+
+        with patch("yaml.safe_load") as mock_safe_load:
+            pid4_map.load(self.pid_map_path)
+
+        mock_safe_load.assert_not_called()
+
+    def test_unwritable_cache_does_not_fail(self):
+        with patch("pid4_map.os.replace", side_effect=OSError("read-only")):
+            compiled = pid4_map.load(self.pid_map_path)
+
+        self.assertEqual(compiled.architectures, {"arm", "arm64"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from simulator.fake_clock import FakeClock
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import rate_limit
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher_time = patch("rate_limit.time", self.clock)
+        self.addCleanup(patcher_time.stop)
+        patcher_time.start()
+
+    def test_bursts_then_paces(self):
+        bucket = rate_limit.TokenBucket(rate=2, burst=3)
+
+        waits = [bucket.acquire() for _ in range(5)]
+
+        self.assertEqual(waits, [0, 0, 0, 0.5, 0.5])
+
+    def test_tokens_refill_while_idle(self):
+        bucket = rate_limit.TokenBucket(rate=2, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+
+        self.clock.now += 10
+
+        self.assertEqual([bucket.acquire(), bucket.acquire()], [0, 0])
+
+    def test_pause_holds_requests_back_without_a_rate(self):
+        bucket = rate_limit.TokenBucket()
+        self.assertEqual(bucket.acquire(), 0)
+
+        bucket.pause(30)
+
+        self.assertEqual(bucket.acquire(), 30)
+        self.assertEqual(bucket.acquire(), 0)
+
+    def test_acquire_async_waits_without_blocking(self):
+        slept = []
+
+        async def sleep(seconds):
+            slept.append(seconds)
+            self.clock.now += seconds
+
+        bucket = rate_limit.TokenBucket(rate=2, burst=1)
+
+        async def acquire_twice():
+            return [await bucket.acquire_async() for _ in range(2)]
+
+        with patch("rate_limit.asyncio.sleep", side_effect=sleep):
+            self.assertEqual(asyncio.run(acquire_twice()), [0, 0.5])
+        self.assertEqual(slept, [0.5])
+        self.assertEqual(self.clock.sleeps, [])
+
+    @unittest.skipIf(rate_limit.fcntl is None, "needs fcntl")
+    def test_state_file_is_shared(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = os.path.join(tmp_dir, "rate_limit.json")
+            first = rate_limit.TokenBucket(rate=1, state_file=state_file)
+            second = rate_limit.TokenBucket(rate=1, state_file=state_file)
+
+            self.assertEqual(first.acquire(), 0)
+            self.assertEqual(second.acquire(), 1)
+
+            second.pause(60)
+
+            self.assertEqual(first.acquire(), 60 + 1)
+
+    @patch.dict(
+        os.environ, {"AVAL_API_RATE_LIMIT": "5", "AVAL_API_BURST": "10"}
+    )
+    def test_bucket_from_environment(self):
+        rate_limit.reset()
+        self.addCleanup(rate_limit.reset)
+
+        bucket = rate_limit.bucket()
+
+        self.assertEqual((bucket.rate, bucket.burst), (5, 10))
+        self.assertIs(rate_limit.bucket(), bucket)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import rule_table
+
+mock_rules_data = """
+[[hardware_id.rule]]
+match = "^(?P<family>aquila)-(?P<soc>[^-]+)"
+hardware_id = "{family}-{soc}"
+
+[[hardware_id.rule]]
+match = ""
+hardware_id = "{0}"
+"""
+
+
+class TestRuleTable(unittest.TestCase):
+    def test_first_match_wins(self):
+        table = rule_table.RuleTable(
+            [
+                {"hardware_id_pattern": "imx6|imx7", "namespace": "upstream"},
+                {"hardware_id_pattern": ".*", "namespace": "torizon"},
+            ],
+            "hardware_id_pattern",
+        )
+
+        self.assertEqual(table.lookup("colibri-imx7")["namespace"], "upstream")
+        self.assertEqual(table.lookup("verdin-am62")["namespace"], "torizon")
+
+    def test_no_match(self):
+        table = rule_table.RuleTable([{"pattern": "imx"}], "pattern")
+
+        self.assertIsNone(table.lookup("am62"))
+        self.assertIsNone(table.match("am62"))
+
+    @patch("rule_table.re.compile")
+    def test_lookups_are_memoized(self, mock_compile):
+        table = rule_table.RuleTable([{"pattern": "imx"}], "pattern")
+
+        table.lookup("verdin-imx8mp")
+        table.lookup("verdin-imx8mp")
+
+        mock_compile.return_value.search.assert_called_once_with(
+            "verdin-imx8mp"
+        )
+
+
+class TestHardwareIdResolver(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        patcher_resolvers = patch.dict(rule_table._resolvers, clear=True)
+        self.addCleanup(patcher_resolvers.stop)
+        patcher_resolvers.start()
+
+        self.rules_path = os.path.join(self.tmp_dir, "rules.toml")
+        with open(self.rules_path, "w") as f:
+            f.write(mock_rules_data)
+
+    def test_custom_rules_with_named_groups(self):
+        resolver = rule_table.load_hardware_id_resolver(self.rules_path)
+
+        self.assertEqual(
+            resolver.resolve("aquila-am69-12345678-abcdef"), "aquila-am69"
+        )
+        self.assertEqual(resolver.resolve("beagley-ai-1234"), "beagley")
+
+    def test_rules_path_from_environment(self):
+        with patch.dict(
+            os.environ, {"AVAL_HARDWARE_ID_RULES": self.rules_path}
+        ):
+            resolver = rule_table.load_hardware_id_resolver()
+
+        self.assertIs(
+            resolver, rule_table.load_hardware_id_resolver(self.rules_path)
+        )
+
+    def test_no_matching_rule(self):
+        resolver = rule_table.HardwareIdResolver(
+            [{"match": "^verdin", "hardware_id": "{0}-{1}"}]
+        )
+
+        with self.assertRaises(ValueError):
+            resolver.resolve("colibri-imx6-15054304-e259ec")
+
+    def test_rule_not_fitting_the_device_id(self):
+        resolver = rule_table.load_hardware_id_resolver()
+
+        with self.assertRaisesRegex(ValueError, "device id labpc"):
+            resolver.resolve("labpc")
+
+    def test_resolve_fleet(self):
+        resolver = rule_table.load_hardware_id_resolver()
+        devices = [
+            {
+                "deviceUuid": "uuid1",
+                "deviceId": "verdin-imx8mm-07214001-9334fa",
+            },
+            {
+                "deviceUuid": "uuid2",
+                "deviceId": "colibri-imx7-emmc-15149329-6f39ce",
+            },
+            {
+                "deviceUuid": "uuid3",
+                "deviceId": "torizon-x86-15149329-6f39ce",
+            },
+        ]
+
+        self.assertEqual(
+            resolver.resolve_fleet(devices),
+            {
+                "uuid1": "verdin-imx8mm",
+                "uuid2": "colibri-imx7-emmc",
+                "uuid3": "intel-corei7-64",
+            },
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
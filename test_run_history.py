@@ -0,0 +1,144 @@
+import os
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import run_history
+    import timeline
+
+
+class TestRunHistory(unittest.TestCase):
+    def setUp(self):
+        for name in ("run_history.logger", "timeline.logger"):
+            patcher = patch(name)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        timeline.reset()
+        self.addCleanup(timeline.reset)
+        self.addCleanup(run_history._devices.clear)
+
+        patcher_run = patch("run_history._run", None)
+        self.addCleanup(patcher_run.stop)
+        patcher_run.start()
+
+        self.cursor = MagicMock()
+        conn = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = self.cursor
+        patcher_db = patch("database.get_db_connection")
+        self.addCleanup(patcher_db.stop)
+        self.get_db_connection = patcher_db.start()
+        self.get_db_connection.return_value.__enter__.return_value = conn
+        self.conn = conn
+
+    def _finish(self, exit_reason="success"):
+        run_history.finish_run(exit_reason)
+        run_history.wait()
+
+    def _executemany_rows(self, table):
+        for c in self.cursor.executemany.call_args_list:
+            if f"INSERT INTO {table} " in c.args[0]:
+                return c.args[1]
+
+    def test_writes_run_devices_and_phases_in_one_transaction(self):
+        run_history.start_run(
+            soc_udt="verdin-imx8mp", target_build_type="nightly"
+        )
+        with timeline.span("matching"):
+            pass
+        with timeline.span("lock_wait", device="uuid1", locked=True):
+            pass
+        run_history.record_lock("uuid1", "verdin-imx8mp")
+        with timeline.span("update"):
+            pass
+        run_history.record_device(
+            "uuid1", update_outcome="success", update_seconds=12.5
+        )
+        run_history.record_release("uuid1")
+
+        self._finish()
+
+        run_row = self.cursor.execute.call_args_list[-1].args[1]
+        self.assertEqual(run_row["soc_udt"], "verdin-imx8mp")
+        self.assertEqual(run_row["exit_reason"], "success")
+
+        (device_row,) = self._executemany_rows("device_runs")
+        self.assertEqual(device_row[1:3], ("uuid1", "verdin-imx8mp"))
+        self.assertEqual(device_row[-3:], ("success", 12.5, None))
+
+        phases = {
+            row[2]: row[1] for row in self._executemany_rows("run_phases")
+        }
+        self.assertEqual(
+            phases, {"matching": None, "lock_wait": "uuid1", "update": "uuid1"}
+        )
+        self.conn.commit.assert_called_once()
+
+    def test_nothing_written_without_a_started_run(self):
+        run_history.record_device("uuid1", failure="boom")
+
+        self._finish()
+
+        self.get_db_connection.assert_not_called()
+
+    @patch.dict(os.environ, {"AVAL_RUN_HISTORY": "false"})
+    def test_can_be_disabled(self):
+        run_history.start_run()
+
+        self._finish()
+
+        self.get_db_connection.assert_not_called()
+
+    def test_database_errors_do_not_fail_the_run(self):
+        self.get_db_connection.side_effect = Exception("no database")
+        run_history.start_run()
+
+        self._finish("error")
+
+        run_history.logger.error.assert_called_once()
+
+    @patch.dict(sys.modules)
+    def test_shutdown_waits_for_the_history_without_database(self):
+        # Runs that never locked a device haven't imported database.
+        sys.modules.pop("database", None)
+        with patch("logging_setup.setup_logging", return_value=MagicMock()):
+            import main
+
+        with patch("main.metrics"), patch("main.timeline"), patch(
+            "main.run_history"
+        ) as mock_run_history:
+            main.shutdown(0)
+
+        mock_run_history.finish_run.assert_called_once()
+        mock_run_history.wait.assert_called_once()
+
+    def test_spans_belong_to_the_device_of_their_parent(self):
+        with timeline.span("warm_fleet"):
+            with timeline.span("warm_device", device="uuid1"):
+                with timeline.span("update"):
+                    pass
+            with timeline.span("warm_device", device="uuid2"):
+                with timeline.span("update"):
+                    pass
+
+        devices = run_history._span_devices(timeline.spans())
+
+        self.assertCountEqual(
+            [(s.name, devices[s.span_id]) for s in timeline.spans()],
+            [
+                ("warm_fleet", None),
+                ("warm_device", "uuid1"),
+                ("update", "uuid1"),
+                ("warm_device", "uuid2"),
+                ("update", "uuid2"),
+            ],
+        )
+
+    def test_unknown_fields_are_rejected(self):
+        with self.assertRaises(ValueError):
+            run_history.record_device("uuid1", color="red")
+
+
+if __name__ == "__main__":
+    unittest.main()
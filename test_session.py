@@ -13,19 +13,16 @@ class TestDeviceInitialization(unittest.TestCase):
         self.logger = patcher_logger.start()
 
     @patch("device.Device._create_remote_session")
-    @patch("device.endpoint_call")
     def test_initialization_refresh_called(
         self,
-        mock_endpoint_call,
         mock_create_remote_session,
     ):
-        mock_endpoint_call.return_value = MagicMock()
-        mock_endpoint_call.return_value.json.return_value = {
-            "network_info": "dummy_data"
-        }
-
+        # The cloud mock avoids actual network calls
         mock_cloud_api = MagicMock()
         mock_cloud_api.token = "test-token"
+        mock_cloud_api.get_network_info.return_value = {
+            "network_info": "dummy_data"
+        }
 
         mock_create_remote_session.return_value = (
             1234,
@@ -52,21 +49,16 @@ class TestDeviceInitialization(unittest.TestCase):
         self.assertEqual(device._remote_session_time, None)
 
     @patch("device.Device._create_remote_session")
-    @patch(
-        "device.endpoint_call"
-    )  # Mock endpoint_call to avoid actual network calls
     def test_initialization_no_refresh_called(
         self,
-        mock_endpoint_call,
         mock_create_remote_session,
     ):
-        mock_endpoint_call.return_value = MagicMock()
-        mock_endpoint_call.return_value.json.return_value = {
-            "network_info": "dummy_data"
-        }
-
+        # The cloud mock avoids actual network calls
         mock_cloud_api = MagicMock()
         mock_cloud_api.token = "test-token"
+        mock_cloud_api.get_network_info.return_value = {
+            "network_info": "dummy_data"
+        }
 
         mock_create_remote_session.return_value = (
             1234,
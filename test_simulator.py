@@ -0,0 +1,451 @@
+import asyncio
+import io
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import requests
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import async_cloud
+    import async_http
+    import cloud
+    import device
+    import http_wrapper
+    import pid4_map
+    import rule_table
+    import update_progress
+    from simulator.torizon_cloud import (
+        Fleet,
+        SimulatorConfig,
+        TorizonCloudSimulator,
+    )
+    from simulator.ssh_target import SshTarget
+
+
+class SimulatorTestCase(unittest.TestCase):
+    config = {}
+
+    def setUp(self):
+        for name in (
+            "cloud.logger",
+            "device.logger",
+            "http_wrapper.logger",
+            "simulator.torizon_cloud.logger",
+        ):
+            patcher = patch(name)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        patcher_env = patch.dict(os.environ, {"AVAL_CACHE_DIR": cache_dir.name})
+        self.addCleanup(patcher_env.stop)
+        patcher_env.start()
+
+        self.fleet = Fleet(SimulatorConfig(seed=1, **self.config))
+        self.fleet.populate(
+            10,
+            pid4_map.load(),
+            rule_table.load_hardware_id_resolver(),
+            outdated_ratio=1.0,
+        )
+        self.simulator = TorizonCloudSimulator(self.fleet).start()
+        self.addCleanup(self.simulator.stop)
+
+        env = self.simulator.environment()
+        for name, value in (
+            ("cloud.API_BASE_URL", env["TORIZON_API_BASE_URL"]),
+            ("cloud.AUTH_URL", env["TORIZON_AUTH_URL"]),
+            ("device.RAC_IP", env["TORIZON_RAS_HOST"]),
+        ):
+            patcher = patch(name, value)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+        self.api = env["TORIZON_API_BASE_URL"]
+
+    def token(self):
+        res = requests.post(self.simulator.environment()["TORIZON_AUTH_URL"])
+        return {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+
+class TestTorizonCloudSimulator(SimulatorTestCase):
+    config = {"in_flight_seconds": 0.1, "install_seconds": 0.2}
+
+    def test_cloud_api_against_simulator(self):
+        cloud_api = cloud.CloudAPI(
+            api_client="id",
+            api_secret="secret",
+            delegation_config_path="delegation_config.toml",
+        )
+
+        self.assertEqual(len(cloud_api.provisioned_devices), 10)
+
+        dev = self.fleet.devices[cloud_api.provisioned_devices[0]["deviceUuid"]]
+        latest = cloud_api.get_latest_build("nightly", dev.hardware_id)
+        self.assertTrue(latest.endswith("/nightly-1000"))
+
+        metadata = cloud_api.get_package_metadata_for_device(dev.uuid)
+        installed = metadata[0]["installedPackages"][0]["installed"]
+        self.assertTrue(installed["packageId"].endswith("/nightly-999"))
+
+        self.assertEqual(
+            cloud_api.get_assigment_status_for_device(dev.uuid), []
+        )
+
+    def test_responses_are_revalidated(self):
+        cloud_api = cloud.CloudAPI(
+            api_client="id",
+            api_secret="secret",
+            delegation_config_path="delegation_config.toml",
+        )
+        dev = self.fleet.devices[cloud_api.provisioned_devices[0]["deviceUuid"]]
+
+        latest = [
+            cloud_api.get_latest_build("nightly", dev.hardware_id)
+            for _ in range(2)
+        ]
+
+        self.assertEqual(latest[0], latest[1])
+        # /packages_external/info and /packages the second time.
+        self.assertEqual(self.simulator.stats.by_status.get("304"), 2)
+
+    def test_connections_are_reused(self):
+        http_wrapper.reset()
+        self.addCleanup(http_wrapper.reset)
+        cloud_api = cloud.CloudAPI(
+            api_client="id",
+            api_secret="secret",
+            delegation_config_path="delegation_config.toml",
+        )
+
+        for _ in range(3):
+            cloud_api.get_assigment_status_for_device(
+                cloud_api.provisioned_devices[0]["deviceUuid"]
+            )
+
+        self.assertEqual(
+            [r["connection_reused"] for r in http_wrapper.records()][-3:],
+            [True, True, True],
+        )
+
+    def test_update_lifecycle(self):
+        dev = next(iter(self.fleet.devices.values()))
+        headers = self.token()
+
+        res = requests.post(
+            self.api + "/updates",
+            headers=headers,
+            json={"packageIds": ["pkg-1000"], "devices": [dev.uuid]},
+        )
+        self.assertEqual(res.status_code, 201)
+
+        assignment_url = f"{self.api}/devices/uptane/{dev.uuid}/assignment"
+        assignment = requests.get(assignment_url, headers=headers).json()
+        self.assertFalse(assignment[0]["inFlight"])
+
+        time.sleep(0.15)
+        assignment = requests.get(assignment_url, headers=headers).json()
+        self.assertTrue(assignment[0]["inFlight"])
+
+        time.sleep(0.2)
+        self.assertEqual(
+            requests.get(assignment_url, headers=headers).json(), []
+        )
+        self.assertEqual(self.fleet.installed_package(dev), "pkg-1000")
+
+    def test_updates_launched_together(self):
+        cloud_api = cloud.CloudAPI(
+            api_client="id",
+            api_secret="secret",
+            delegation_config_path="delegation_config.toml",
+        )
+        devs = list(self.fleet.devices.values())[:3]
+
+        cloud_api.launch_update("pkg-1000", [dev.uuid for dev in devs])
+
+        self.assertEqual(self.simulator.stats.by_route["POST /updates"], 1)
+        time.sleep(0.35)
+        for dev in devs:
+            self.assertEqual(self.fleet.installed_package(dev), "pkg-1000")
+
+    @patch.dict(
+        "update_progress.POLL_SECONDS",
+        {state: 0.05 for state in update_progress.POLL_SECONDS},
+    )
+    def test_device_update_followed_to_the_end(self):
+        cloud_api = cloud.CloudAPI(
+            api_client="id",
+            api_secret="secret",
+            delegation_config_path="delegation_config.toml",
+        )
+        dev = next(iter(self.fleet.devices.values()))
+        dut = device.Device(
+            cloud_api,
+            dev.uuid,
+            dev.hardware_id,
+            {"DEVICE_PASSWORD": "secret", "PUBLIC_KEY": "ssh-ed25519 AAAA"},
+        )
+        self.assertFalse(dut.is_os_updated_to_latest("nightly"))
+
+        self.assertTrue(dut.update_to_latest("nightly"))
+
+        self.assertEqual(dut.current_build, dut.latest_build)
+
+    def test_pagination(self):
+        res = requests.get(
+            self.api + "/devices?offset=8&limit=5", headers=self.token()
+        ).json()
+
+        self.assertEqual(len(res["values"]), 2)
+        self.assertEqual(res["total"], 10)
+
+    def test_requires_token(self):
+        res = requests.get(self.api + "/devices")
+
+        self.assertEqual(res.status_code, 401)
+
+    def test_remote_access_sessions(self):
+        dev = next(iter(self.fleet.devices.values()))
+        url = f"{self.api}/remote-access/device/{dev.uuid}/sessions"
+        headers = self.token()
+
+        self.assertEqual(requests.get(url, headers=headers).status_code, 404)
+        self.assertEqual(requests.post(url, headers=headers).status_code, 201)
+        self.assertEqual(requests.post(url, headers=headers).status_code, 409)
+        self.assertIn(
+            "reversePort", requests.get(url, headers=headers).json()["ssh"]
+        )
+        self.assertEqual(requests.delete(url, headers=headers).status_code, 200)
+        self.assertEqual(requests.get(url, headers=headers).status_code, 404)
+
+    def test_stats(self):
+        headers = self.token()
+        requests.get(self.api + "/devices", headers=headers)
+        requests.get(self.api + "/devices", headers=headers)
+
+        stats = requests.get(self.simulator.base_url + "/_sim/stats").json()
+
+        self.assertEqual(stats["requests"]["GET /devices"], 2)
+        self.assertEqual(stats["requests"]["POST token"], 1)
+
+
+class TestBatchedLookups(SimulatorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cloud_api = cloud.CloudAPI(
+            api_client="id",
+            api_secret="secret",
+            delegation_config_path="delegation_config.toml",
+        )
+        self.simulator.stats.reset()
+
+    def hardware_ids(self, devs):
+        return {dev.uuid: dev.hardware_id for dev in devs}
+
+    @patch("cloud.PAGE_SIZE", 4)
+    @patch("cloud.DEVICES_PER_REQUEST", 2)
+    def test_current_builds_of_some_devices(self):
+        devs = list(self.fleet.devices.values())[:3]
+
+        builds = self.cloud_api.get_current_builds(self.hardware_ids(devs))
+
+        self.assertEqual(
+            builds,
+            {dev.uuid: self.fleet.installed_package(dev) for dev in devs},
+        )
+        self.assertEqual(
+            self.simulator.stats.by_route["GET /devices/packages"], 2
+        )
+
+    @patch("cloud.PAGE_SIZE", 4)
+    def test_current_builds_of_the_whole_fleet(self):
+        devs = list(self.fleet.devices.values())
+
+        builds = self.cloud_api.get_current_builds(self.hardware_ids(devs))
+
+        self.assertEqual(len(builds), 10)
+        # One unfiltered listing, in pages of 4.
+        self.assertEqual(
+            self.simulator.stats.by_route["GET /devices/packages"], 3
+        )
+
+
+class TestAsyncCloudAPI(SimulatorTestCase):
+    config = {"in_flight_seconds": 0.1, "install_seconds": 0.2}
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch("async_http.logger")
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+        http_wrapper.reset()
+        self.addCleanup(http_wrapper.reset)
+        self.cloud_api = cloud.CloudAPI(
+            api_client="id",
+            api_secret="secret",
+            delegation_config_path="delegation_config.toml",
+        )
+
+    def run_async(self, main):
+        """Runs `main` with an AsyncCloudAPI, in an event loop of its own."""
+
+        async def run():
+            api = async_cloud.AsyncCloudAPI(self.cloud_api)
+            try:
+                return await main(api)
+            finally:
+                await api.close()
+
+        return asyncio.run(run())
+
+    def test_same_results_as_cloud_api(self):
+        async def main(api):
+            devices = await api.provisioned_devices
+            uuid = devices[0]["deviceUuid"]
+            dev = self.fleet.devices[uuid]
+            return (
+                devices,
+                await api.get_latest_build("nightly", dev.hardware_id),
+                await api.get_package_metadata_for_device(uuid),
+                await api.get_assigment_status_for_device(uuid),
+                await api.get_network_info(uuid),
+                await api.get_current_builds(
+                    {
+                        uuid: dev.hardware_id
+                        for uuid, dev in self.fleet.devices.items()
+                    }
+                ),
+            )
+
+        devices, latest, metadata, assignment, network, builds = self.run_async(
+            main
+        )
+
+        uuid = devices[0]["deviceUuid"]
+        hardware_id = self.fleet.devices[uuid].hardware_id
+        self.assertEqual(devices, self.cloud_api.provisioned_devices)
+        self.assertEqual(
+            latest, self.cloud_api.get_latest_build("nightly", hardware_id)
+        )
+        self.assertEqual(
+            metadata, self.cloud_api.get_package_metadata_for_device(uuid)
+        )
+        self.assertEqual(assignment, [])
+        self.assertEqual(network, self.cloud_api.get_network_info(uuid))
+        self.assertEqual(len(builds), 10)
+
+    def test_updates_and_remote_sessions(self):
+        devs = list(self.fleet.devices.values())[:3]
+
+        async def main(api):
+            await api.launch_update("pkg-1000", [dev.uuid for dev in devs])
+            await api.create_remote_session(devs[0].uuid, "ssh-ed25519 AAAA")
+            session = await api.get_remote_session(devs[0].uuid)
+            await api.delete_remote_session(devs[0].uuid)
+            with self.assertRaises(requests.exceptions.HTTPError):
+                await api.get_remote_session(devs[0].uuid)
+            return session
+
+        session = self.run_async(main)
+
+        self.assertIn("reversePort", session["ssh"])
+        self.assertEqual(self.simulator.stats.by_route["POST /updates"], 1)
+        time.sleep(0.35)
+        for dev in devs:
+            self.assertEqual(self.fleet.installed_package(dev), "pkg-1000")
+
+    def test_many_devices_on_a_few_connections(self):
+        uuids = list(self.fleet.devices) * 10
+
+        async def main(api):
+            statuses = await asyncio.gather(
+                *(api.get_assigment_status_for_device(uuid) for uuid in uuids)
+            )
+            return statuses, async_http.pool().max_connections
+
+        statuses, max_connections = self.run_async(main)
+
+        self.assertEqual(statuses, [[]] * len(uuids))
+        opened = [
+            r for r in http_wrapper.records() if not r["connection_reused"]
+        ]
+        # The token request went through the blocking client.
+        self.assertLessEqual(len(opened), max_connections + 1)
+        self.assertEqual(
+            self.simulator.stats.by_route[
+                "GET /devices/uptane/{uuid}/assignment"
+            ],
+            len(uuids),
+        )
+
+
+class TestSimulatorInjection(SimulatorTestCase):
+    def test_error_injection(self):
+        headers = self.token()
+        self.fleet.config.error_rate = 1.0
+
+        res = requests.get(self.api + "/devices", headers=headers)
+
+        self.assertEqual(res.status_code, 500)
+
+
+class TestSimulatorRateLimit(SimulatorTestCase):
+    config = {"rate_limit": 2}
+
+    def test_rate_limit(self):
+        # The token request already counts towards the limit.
+        headers = self.token()
+        statuses = [
+            requests.get(self.api + "/devices", headers=headers)
+            for _ in range(3)
+        ]
+
+        self.assertEqual(statuses[-1].status_code, 429)
+        self.assertEqual(statuses[-1].headers["Retry-After"], "1")
+
+
+class TestSshTarget(SimulatorTestCase):
+    def setUp(self):
+        self.ssh_target = SshTarget(password="secret").start()
+        self.addCleanup(self.ssh_target.stop)
+        self.config = {"ssh_port": self.ssh_target.port}
+        super().setUp()
+
+    # invoke mirrors stdin to the remote command, which fails when the test
+    # runner captures it.
+    @patch("sys.stdin", io.StringIO())
+    @patch("device.time.sleep")
+    def test_device_over_simulated_ras(self, _):
+        cloud_api = cloud.CloudAPI(
+            api_client="id",
+            api_secret="secret",
+            delegation_config_path="delegation_config.toml",
+        )
+        dut = device.Device(
+            cloud_api,
+            cloud_api.provisioned_devices[0]["deviceUuid"],
+            "verdin-imx8mp",
+            {
+                "DEVICE_PASSWORD": "secret",
+                "PUBLIC_KEY": "ssh-rsa",
+                "USE_RAC": True,
+            },
+        )
+
+        dut.create_ssh_connnection()
+        res = dut.connection.run("journalctl -u aktualizr-torizon", hide=True)
+
+        self.assertEqual(dut.remote_session_port, self.ssh_target.port)
+        self.assertIn("UpdateCheckComplete", res.stdout)
+        self.assertIn(
+            "journalctl -u aktualizr-torizon", self.ssh_target.executed
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that make `aval --help` slow. None of them may be pulled in by
+# merely importing `main`.
+HEAVY_MODULES = (
+    "boto3",
+    "cloud",
+    "database",
+    "dateutil",
+    "device",
+    "device_handler",
+    "fabric",
+    "paramiko",
+    "prettytable",
+    "psycopg",
+    "requests",
+    "toml",
+    "yaml",
+)
+
+# Upper bound for the cumulative import time of `main`, in milliseconds. It
+# can be raised on slow runners through AVAL_IMPORT_BUDGET_MS.
+IMPORT_BUDGET_MS = int(os.environ.get("AVAL_IMPORT_BUDGET_MS", "200"))
+
+
+def _run_python(*args):
+    # Run in a clean interpreter without the database environment, the same
+    # way a user calling `aval --help` would.
+    env = {
+        k: v
+        for k, v in os.environ.items()
+        if not k.startswith(("POSTGRES_", "AWS_"))
+    }
+    return subprocess.run(
+        [sys.executable, *args],
+        cwd=REPO_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+
+class TestStartup(unittest.TestCase):
+    def test_import_main_does_not_load_heavy_modules(self):
+        res = _run_python(
+            "-c", "import json, sys, main; print(json.dumps(list(sys.modules)))"
+        )
+        self.assertEqual(res.returncode, 0, res.stderr)
+
+        loaded = set(json.loads(res.stdout))
+        for module in HEAVY_MODULES:
+            with self.subTest(module=module):
+                self.assertNotIn(module, loaded)
+
+    def test_import_main_within_budget(self):
+        res = _run_python("-X", "importtime", "-c", "import main")
+        self.assertEqual(res.returncode, 0, res.stderr)
+
+        # -X importtime lines look like:
+        # "import time:   self [us] | cumulative | imported package"
+        cumulative_us = None
+        for line in res.stderr.splitlines():
+            fields = [f.strip() for f in line.split("|")]
+            if len(fields) == 3 and fields[2] == "main":
+                cumulative_us = int(fields[1])
+
+        self.assertIsNotNone(cumulative_us, res.stderr)
+        self.assertLess(cumulative_us / 1000, IMPORT_BUDGET_MS)
+
+    def test_help_without_database_environment(self):
+        res = _run_python("main.py", "--help")
+
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertIn("usage:", res.stdout)
+        self.assertNotIn("Traceback", res.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
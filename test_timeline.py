@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import timeline
+
+
+class TestTimeline(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("timeline.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        timeline.reset()
+        self.addCleanup(timeline.reset)
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_spans_nest_under_the_enclosing_span(self):
+        with timeline.span("update", device="uuid1") as update:
+            with timeline.span("update_launch"):
+                pass
+            update.set_attribute("build", "nightly-1000")
+
+        launch, parent = timeline.spans()[1], timeline.spans()[0]
+        self.assertEqual(parent.name, "update")
+        self.assertIsNone(parent.parent_id)
+        self.assertEqual(launch.parent_id, parent.span_id)
+        self.assertEqual(
+            parent.attributes, {"device": "uuid1", "build": "nightly-1000"}
+        )
+        self.assertGreaterEqual(parent.end_ns, launch.end_ns)
+
+    def test_span_records_errors(self):
+        with self.assertRaises(ValueError):
+            with timeline.span("command"):
+                raise ValueError("boom")
+
+        self.assertEqual(timeline.spans()[0].error, "ValueError: boom")
+
+    def test_successful_exit_is_not_an_error(self):
+        with self.assertRaises(SystemExit):
+            with timeline.span("aval"):
+                raise SystemExit(0)
+        with self.assertRaises(SystemExit):
+            with timeline.span("aval"):
+                raise SystemExit(69)
+
+        self.assertIsNone(timeline.spans()[0].error)
+        self.assertEqual(timeline.spans()[1].error, "SystemExit: 69")
+
+    def test_span_as_decorator(self):
+        @timeline.span("ssh_setup")
+        def connect():
+            return timeline.spans()
+
+        connect()
+        connect()
+
+        self.assertEqual(
+            [s.name for s in timeline.spans()], ["ssh_setup", "ssh_setup"]
+        )
+
+    def test_write_timeline(self):
+        timeline_path = os.path.join(self.tmp_dir, "timeline.json")
+        otlp_path = os.path.join(self.tmp_dir, "otlp.json")
+
+        with timeline.span("aval"):
+            with timeline.span("lock_wait", device="uuid1", locked=True):
+                pass
+
+        with patch.dict(
+            os.environ,
+            {"AVAL_TIMELINE_FILE": timeline_path, "AVAL_OTLP_FILE": otlp_path},
+        ):
+            timeline.write_timeline()
+
+        with open(timeline_path) as f:
+            written = json.load(f)
+        self.assertEqual(
+            [s["name"] for s in written["spans"]], ["aval", "lock_wait"]
+        )
+
+        with open(otlp_path) as f:
+            otlp = json.load(f)
+        spans = otlp["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        self.assertEqual(spans[1]["parentSpanId"], spans[0]["spanId"])
+        self.assertEqual(spans[1]["traceId"], written["trace_id"])
+        self.assertIn(
+            {"key": "locked", "value": {"boolValue": True}},
+            spans[1]["attributes"],
+        )
+
+    def test_nothing_written_without_spans(self):
+        timeline_path = os.path.join(self.tmp_dir, "timeline.json")
+
+        with patch.dict(os.environ, {"AVAL_TIMELINE_FILE": timeline_path}):
+            timeline.write_timeline()
+
+        self.assertFalse(os.path.exists(timeline_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,191 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from simulator.fake_clock import FakeClock
+
+with patch("logging_setup.setup_logging", return_value=MagicMock()):
+    import update_progress
+    from update_progress import UpdateProgress
+
+TARGET = "nightly-1000"
+
+
+def assignment(in_flight):
+    return [{"inFlight": in_flight}]
+
+
+def metadata(build):
+    return [
+        {
+            "installedPackages": [
+                {
+                    "component": "verdin-imx8mm",
+                    "installed": {"packageId": build},
+                }
+            ]
+        }
+    ]
+
+
+class TestUpdateProgress(unittest.TestCase):
+    def setUp(self):
+        patcher_logger = patch("update_progress.logger")
+        self.addCleanup(patcher_logger.stop)
+        self.logger = patcher_logger.start()
+
+        self.clock = FakeClock()
+        patcher_time = patch("update_progress.time", self.clock)
+        self.addCleanup(patcher_time.stop)
+        patcher_time.start()
+
+        self.cloud = MagicMock()
+        self.cloud.extract_in_flight.side_effect = lambda data: data[0].get(
+            "inFlight"
+        )
+
+    def progress(self, **kwargs):
+        return UpdateProgress(
+            self.cloud, "uuid1", "verdin-imx8mm", TARGET, **kwargs
+        )
+
+    def test_verified(self):
+        self.cloud.get_assigment_status_for_device.side_effect = [
+            assignment(False),
+            assignment(True),
+            assignment(True),
+            [],
+        ]
+        self.cloud.get_package_metadata_for_device.return_value = metadata(
+            TARGET
+        )
+        progress = self.progress()
+
+        self.assertEqual(progress.run(), update_progress.VERIFIED)
+        self.assertEqual(progress.polls, 4)
+        self.assertEqual(progress.current_build, TARGET)
+        # The build is only looked up once the update is over.
+        self.cloud.get_package_metadata_for_device.assert_called_once()
+
+    def test_updates_never_go_back(self):
+        self.cloud.get_assigment_status_for_device.side_effect = [
+            assignment(True),
+            assignment(False),
+        ]
+        progress = self.progress()
+
+        progress.poll()
+        self.assertEqual(progress.poll(), update_progress.IN_FLIGHT)
+
+    def test_installing_runs_the_hook_until_it_succeeds(self):
+        self.cloud.get_assigment_status_for_device.side_effect = [
+            assignment(True),
+            assignment(True),
+            assignment(True),
+            assignment(True),
+            [],
+        ]
+        self.cloud.get_package_metadata_for_device.side_effect = [
+            metadata("nightly-999"),
+            metadata(TARGET),
+            metadata(TARGET),
+            metadata(TARGET),
+            metadata(TARGET),
+        ]
+        on_installing = MagicMock(side_effect=[False, True])
+        progress = self.progress(watch_install=True)
+
+        self.assertEqual(
+            progress.run(on_installing=on_installing), update_progress.VERIFIED
+        )
+        self.assertEqual(on_installing.call_count, 2)
+
+    def test_the_hook_runs_when_installing_passes_between_two_polls(self):
+        self.cloud.get_assigment_status_for_device.side_effect = [
+            assignment(True),
+            [],
+            [],
+        ]
+        self.cloud.get_package_metadata_for_device.side_effect = [
+            metadata("nightly-999"),
+            metadata(TARGET),
+            metadata(TARGET),
+        ]
+        on_installing = MagicMock(return_value=True)
+        progress = self.progress(watch_install=True)
+
+        self.assertEqual(
+            progress.run(on_installing=on_installing), update_progress.VERIFIED
+        )
+        on_installing.assert_called_once()
+
+    def test_failed_when_the_hook_never_succeeds(self):
+        self.cloud.get_assigment_status_for_device.return_value = []
+        self.cloud.get_package_metadata_for_device.return_value = metadata(
+            TARGET
+        )
+        on_installing = MagicMock(return_value=False)
+        progress = self.progress(watch_install=True)
+
+        self.assertEqual(
+            progress.run(on_installing=on_installing), update_progress.FAILED
+        )
+        self.assertEqual(
+            on_installing.call_count, update_progress.INSTALL_HOOK_ATTEMPTS
+        )
+        self.assertIn("install hook failed", progress.reason)
+
+    def test_failed_when_the_device_stays_on_its_build(self):
+        self.cloud.get_assigment_status_for_device.return_value = []
+        self.cloud.get_package_metadata_for_device.return_value = metadata(
+            "nightly-999"
+        )
+        progress = self.progress()
+
+        self.assertEqual(progress.run(), update_progress.FAILED)
+        self.assertIn("still on nightly-999", progress.reason)
+        self.assertLessEqual(
+            self.clock.now - 1000.0,
+            update_progress.REBOOT_GRACE_SECONDS
+            + update_progress.POLL_SECONDS[update_progress.REBOOTING],
+        )
+
+    def test_a_device_reporting_no_build_is_polled_past_the_grace(self):
+        # OTA-2980: installedPackages can come back empty for a while after
+        # the update.
+        polls = (
+            2
+            * update_progress.REBOOT_GRACE_SECONDS
+            // (update_progress.POLL_SECONDS[update_progress.REBOOTING])
+        )
+        self.cloud.get_assigment_status_for_device.return_value = []
+        self.cloud.get_package_metadata_for_device.side_effect = [
+            [{"installedPackages": []}]
+        ] * polls + [metadata(TARGET)]
+        progress = self.progress()
+
+        self.assertEqual(progress.run(), update_progress.VERIFIED)
+        self.assertEqual(progress.polls, polls + 1)
+
+    def test_a_device_reporting_no_build_fails_after_the_timeout(self):
+        self.cloud.get_assigment_status_for_device.return_value = []
+        self.cloud.get_package_metadata_for_device.return_value = [
+            {"installedPackages": []}
+        ]
+        progress = self.progress(timeout=600)
+
+        self.assertEqual(progress.run(), update_progress.FAILED)
+        self.assertIn("not done after 600s, rebooting", progress.reason)
+
+    def test_failed_after_the_timeout(self):
+        self.cloud.get_assigment_status_for_device.return_value = assignment(
+            False
+        )
+        progress = self.progress(timeout=600)
+
+        self.assertEqual(progress.run(), update_progress.FAILED)
+        self.assertIn("not done after 600s, launched", progress.reason)
+        self.logger.error.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
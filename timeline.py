@@ -0,0 +1,168 @@
+import contextlib
+import contextvars
+import json
+import os
+import secrets
+import threading
+import time
+
+import logging_setup
+
+logger = logging_setup.setup_logging()
+
+DEFAULT_TIMELINE_PATH = "aval_timeline.json"
+
+_trace_id = secrets.token_hex(16)
+_spans = []
+_spans_lock = threading.Lock()
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    @property
+    def duration_seconds(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_unix_nano": self.start_ns,
+            "end_unix_nano": self.end_ns,
+            "duration_seconds": self.duration_seconds,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """Times the enclosed phase of the run, nested under the enclosing span.
+
+    Usable as a decorator too, for phases that span a whole function.
+    """
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            current.error = f"SystemExit: {e.code}"
+        raise
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current_span.reset(token)
+        with _spans_lock:
+            _spans.append(current)
+        logger.debug("%s took %.3fs", name, current.duration_seconds)
+
+
+def spans():
+    with _spans_lock:
+        return sorted(_spans, key=lambda s: s.start_ns)
+
+
+def reset():
+    global _trace_id
+
+    with _spans_lock:
+        _spans.clear()
+    _trace_id = secrets.token_hex(16)
+
+
+def to_json():
+    return {"trace_id": _trace_id, "spans": [s.to_json() for s in spans()]}
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp_json():
+    """The timeline in the OTLP/JSON trace format, for OpenTelemetry tooling."""
+    otlp_spans = []
+    for s in spans():
+        otlp_span = {
+            "traceId": _trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 1,
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in s.attributes.items()
+            ],
+            # STATUS_CODE_OK / STATUS_CODE_ERROR
+            "status": (
+                {"code": 2, "message": s.error} if s.error else {"code": 1}
+            ),
+        }
+        if s.parent_id:
+            otlp_span["parentSpanId"] = s.parent_id
+        otlp_spans.append(otlp_span)
+
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {
+                            "key": "service.name",
+                            "value": {"stringValue": "aval"},
+                        }
+                    ]
+                },
+                "scopeSpans": [
+                    {"scope": {"name": "aval"}, "spans": otlp_spans}
+                ],
+            }
+        ]
+    }
+
+
+def write_timeline():
+    """Writes the spans recorded so far, if any.
+
+    The timeline goes to AVAL_TIMELINE_FILE, `aval_timeline.json` by default.
+    An OTLP/JSON copy is written to AVAL_OTLP_FILE when set.
+    """
+    if not spans():
+        return
+
+    outputs = [
+        (os.getenv("AVAL_TIMELINE_FILE") or DEFAULT_TIMELINE_PATH, to_json)
+    ]
+    if os.getenv("AVAL_OTLP_FILE"):
+        outputs.append((os.environ["AVAL_OTLP_FILE"], to_otlp_json))
+
+    for path, serialize in outputs:
+        try:
+            with open(path, "w") as f:
+                json.dump(serialize(), f, indent=2)
+        except OSError as e:
+            logger.error(f"Failed to write the run timeline to {path}: {e}")
+        else:
+            logger.info(f"Run timeline written to {path}")
@@ -0,0 +1,182 @@
+import os
+import time
+
+import common
+import logging_setup
+import timeline
+
+logger = logging_setup.setup_logging()
+
+# The update was launched, the device hasn't fetched it yet.
+LAUNCHED = "launched"
+# The device fetched the update and is downloading and installing it.
+IN_FLIGHT = "in_flight"
+# The device reports the new build, its secondaries are still updating.
+# Only watched for when asked, it costs a lookup per poll.
+INSTALLING = "installing"
+# The update is over, the device hasn't reported the new build yet.
+REBOOTING = "rebooting"
+VERIFIED = "verified"
+FAILED = "failed"
+
+STATES = (LAUNCHED, IN_FLIGHT, INSTALLING, REBOOTING, VERIFIED, FAILED)
+POLL_SECONDS = {
+    LAUNCHED: 15,
+    IN_FLIGHT: 60,
+    INSTALLING: 30,
+    REBOOTING: 15,
+}
+# How long a device may take to report its new build once the update is over.
+# A device that reports no build at all (OTA-2980) is polled until the update
+# times out instead.
+REBOOT_GRACE_SECONDS = 120
+# How many times the hook run while installing may fail before the update does.
+INSTALL_HOOK_ATTEMPTS = 80
+UPDATE_TIMEOUT_SECONDS = int(os.getenv("AVAL_UPDATE_TIMEOUT", str(2 * 60 * 60)))
+
+
+class UpdateProgress:
+    """Follows the update of a device to `target_build`, from the Cloud.
+
+    The update goes launched -> in_flight -> installing -> rebooting ->
+    verified, skipping the states that pass between two polls, or ends up
+    failed: still on another build after the update, or not done within
+    `timeout` seconds. A device that reports no build is not on another one
+    yet, only the timeout fails it. Each poll costs one assignment lookup, plus one build
+    lookup once the device should report its new build.
+    """
+
+    def __init__(
+        self,
+        cloud_api,
+        uuid,
+        hardware_id,
+        target_build,
+        watch_install=False,
+        timeout=UPDATE_TIMEOUT_SECONDS,
+    ):
+        self._cloud_api = cloud_api
+        self._hardware_id = hardware_id
+        self._watch_install = watch_install
+        self._timeout = timeout
+
+        self.uuid = uuid
+        self.target_build = target_build
+        self.state = LAUNCHED
+        self.current_build = None
+        self.reason = None
+        self.polls = 0
+
+        self._hook_pending = False
+        self._hook_failures = 0
+
+        self._started = time.monotonic()
+        self._entered = self._started
+
+    def _lookup_current_build(self):
+        metadata = self._cloud_api.get_package_metadata_for_device(self.uuid)
+        self.current_build = common.find_installed_package(
+            metadata, self._hardware_id
+        )
+        return self.current_build
+
+    def _observe(self):
+        """The state the Cloud shows the update in."""
+        assignment = self._cloud_api.get_assigment_status_for_device(self.uuid)
+        if assignment:
+            if not self._cloud_api.extract_in_flight(assignment):
+                return LAUNCHED
+            if (
+                self._watch_install
+                and self._lookup_current_build() == self.target_build
+            ):
+                return INSTALLING
+            return IN_FLIGHT
+
+        if self._lookup_current_build() == self.target_build:
+            return VERIFIED
+        return REBOOTING
+
+    def _enter(self, state, reason=None):
+        logger.info(
+            f"Update of {self.uuid} to {self.target_build}: {self.state} -> {state}"
+        )
+        self.state = state
+        self.reason = reason
+        self._entered = time.monotonic()
+
+    def poll(self):
+        """Polls the Cloud once, returns the state the update is in now."""
+        self.polls += 1
+        observed = self._observe()
+
+        if observed == VERIFIED and self._hook_pending:
+            # Not verified before its hook ran, even when the device got
+            # through installing between two polls.
+            if self.state != INSTALLING:
+                self._enter(INSTALLING)
+        # The Cloud may briefly show an earlier state again, e.g. the old
+        # build while installing. Updates never go back.
+        elif STATES.index(observed) > STATES.index(self.state):
+            self._enter(observed)
+        elif (
+            self.state == REBOOTING
+            and self.current_build is not None
+            and time.monotonic() - self._entered > REBOOT_GRACE_SECONDS
+        ):
+            self._enter(
+                FAILED,
+                f"still on {self.current_build} {REBOOT_GRACE_SECONDS}s after the update",
+            )
+        return self.state
+
+    def _run_hook(self, on_installing):
+        if on_installing():
+            self._hook_pending = False
+            return
+
+        self._hook_failures += 1
+        if self._hook_failures >= INSTALL_HOOK_ATTEMPTS:
+            self._enter(
+                FAILED,
+                f"its install hook failed {self._hook_failures} times",
+            )
+
+    def run(self, on_installing=None):
+        """Polls until the update is verified or failed, returns its state.
+
+        `on_installing` is called on every poll while installing, until it
+        returns True. When installing is watched for, the update isn't
+        verified before it did, and fails if it never does.
+        """
+        self._hook_pending = self._watch_install and on_installing is not None
+
+        while self.state not in (VERIFIED, FAILED):
+            with timeline.span(f"update_{self.state}") as span:
+                state = self.state
+                while self.state == state:
+                    if self.polls:
+                        time.sleep(POLL_SECONDS[state])
+                    if time.monotonic() - self._started > self._timeout:
+                        self._enter(
+                            FAILED,
+                            f"not done after {self._timeout}s, {state}",
+                        )
+                        break
+
+                    self.poll()
+                    if self.state == INSTALLING and self._hook_pending:
+                        self._run_hook(on_installing)
+                span.set_attribute("next_state", self.state)
+
+        if self.state == FAILED:
+            logger.error(
+                f"Update of {self.uuid} to {self.target_build} failed: {self.reason}"
+            )
+        logger.debug(
+            "Update of %s took %d polls over %.0fs",
+            self.uuid,
+            self.polls,
+            time.monotonic() - self._started,
+        )
+        return self.state